@@ -0,0 +1,373 @@
+"""Load test tornadose handlers with many concurrent local clients.
+
+Each scenario starts a server process running one store type behind an
+:class:`~tornadose.handlers.EventSource` and a
+:class:`~tornadose.handlers.WebSocketSubscriber`, connects the requested
+number of clients from one or more client processes, publishes
+timestamped messages at a fixed rate and reports:
+
+* delivered messages per second over all clients,
+* p50/p99/max delivery latency,
+* server CPU time during publishing and memory per subscriber.
+
+Results are printed (or written with ``--output``) as a JSON list with
+one object per scenario so runs can be compared across releases::
+
+    PYTHONPATH=. python benchmarks/bench.py --clients 2000 --messages 200 \\
+        --store data queue redis --transport sse ws --output results.json
+
+The Redis scenario runs :class:`~tornadose.testing.FakeRedisServer` on a
+thread of the server process, so no Redis installation is required.
+
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import platform
+import resource
+import socket
+import sys
+import threading
+import time
+
+import tornado
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.tcpclient import TCPClient
+from tornado.web import Application, RequestHandler
+from tornado.websocket import websocket_connect
+
+import tornadose
+from tornadose.handlers import EventSource, WebSocketSubscriber
+from tornadose.stores import DataStore, QueueStore, RedisStore
+from tornadose.testing import FakeRedisServer
+
+STORES = ("data", "queue", "redis")
+TRANSPORTS = ("sse", "ws")
+HOST = "127.0.0.1"
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss():
+    """Return the resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Peak rather than current usage; kB on Linux but bytes on macOS.
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return None
+    rank = math.ceil(fraction * len(values))
+    return values[min(len(values), max(rank, 1)) - 1]
+
+
+# Server process
+# --------------
+
+
+def start_fake_redis():
+    """Run a fake Redis server on its own thread and return its port.
+
+    :class:`~tornadose.stores.RedisStore` uses blocking calls, so the
+    server cannot share the IOLoop with the store.
+
+    """
+    started = threading.Event()
+    ports = []
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server = FakeRedisServer()
+        ports.append(server.listen_unused())
+        started.set()
+        IOLoop.current().start()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return ports[0]
+
+
+def make_store(name):
+    if name == "data":
+        return DataStore()
+    elif name == "queue":
+        return QueueStore()
+    elif name == "redis":
+        return RedisStore(port=start_fake_redis())
+    raise ValueError("Unknown store {!r}".format(name))
+
+
+class StatsHandler(RequestHandler):
+    def initialize(self, store):
+        self.store = store
+
+    def get(self):
+        subscribers = len(self.store.subscribers)
+        self.write(dict(cpu=cpu_time(), rss=rss(), subscribers=subscribers))
+
+
+class PublishHandler(RequestHandler):
+    """Submit ``count`` timestamped messages at ``rate`` per second."""
+
+    def initialize(self, store):
+        self.store = store
+
+    async def post(self):
+        count = int(self.get_argument("count"))
+        rate = float(self.get_argument("rate"))
+        start = time.monotonic()
+        for seq in range(count):
+            delay = start + seq / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            result = self.store.submit("{} {!r}".format(seq, time.time()))
+            if asyncio.iscoroutine(result):
+                await result
+        self.write(dict(published=count, duration=time.monotonic() - start))
+
+
+def serve(store_name, ports):
+    raise_fd_limit()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    store = make_store(store_name)
+    app = Application(
+        [
+            (r"/sse", EventSource, dict(store=store)),
+            (r"/ws", WebSocketSubscriber, dict(store=store)),
+            (r"/stats", StatsHandler, dict(store=store)),
+            (r"/publish", PublishHandler, dict(store=store)),
+        ]
+    )
+    sockets = bind_sockets(0, HOST, family=socket.AF_INET, backlog=4096)
+    HTTPServer(app).add_sockets(sockets)
+    ports.put(sockets[0].getsockname()[1])
+    IOLoop.current().start()
+
+
+# Client processes
+# ----------------
+
+
+def parse(data):
+    seq, sent = data.split()
+    return int(seq), float(sent)
+
+
+async def sse_client(port, last, latencies):
+    stream = await TCPClient().connect(HOST, port)
+    # HTTP/1.0 avoids chunked encoding, so events can be read directly.
+    stream.write(b"GET /sse HTTP/1.0\r\n\r\n")
+    await stream.read_until(b"\r\n\r\n")
+    seq = -1
+    while seq < last:
+        event = await stream.read_until(b"\n\n")
+        now = time.time()
+        for line in event.split(b"\n"):
+            if line.startswith(b"data: "):
+                seq, sent = parse(line[6:].decode())
+                latencies.append(now - sent)
+    stream.close()
+    return now
+
+
+async def ws_client(port, last, latencies):
+    connection = await websocket_connect("ws://{}:{}/ws".format(HOST, port))
+    seq = -1
+    while seq < last:
+        message = await connection.read_message()
+        if message is None:
+            raise RuntimeError("Connection closed")
+        now = time.time()
+        seq, sent = parse(json.loads(message)["data"])
+        latencies.append(now - sent)
+    connection.close()
+    return now
+
+
+def run_clients(transport, port, clients, messages, timeout, results):
+    raise_fd_limit()
+    client = sse_client if transport == "sse" else ws_client
+
+    async def main():
+        latencies = []
+        tasks = [
+            asyncio.ensure_future(client(port, messages - 1, latencies))
+            for _ in range(clients)
+        ]
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        finished = [task.result() for task in done if task.exception() is None]
+        return dict(
+            latencies=latencies,
+            finished=max(finished, default=None),
+            errors=len(done) - len(finished),
+            timeouts=len(pending),
+        )
+
+    results.put(asyncio.run(main()))
+
+
+# Driver
+# ------
+
+
+async def run_scenario(store_name, transport, args):
+    context = multiprocessing.get_context("spawn")
+    ports, results = context.Queue(), context.Queue()
+    server = context.Process(target=serve, args=(store_name, ports))
+    server.start()
+    workers = []
+    loop = asyncio.get_running_loop()
+    try:
+        port = await loop.run_in_executor(None, ports.get, True, 30)
+        base_url = "http://{}:{}".format(HOST, port)
+        http_client = AsyncHTTPClient()
+
+        async def stats():
+            response = await http_client.fetch(base_url + "/stats")
+            return json.loads(response.body)
+
+        idle = await stats()
+        for index in range(args.processes):
+            clients = args.clients // args.processes
+            if index < args.clients % args.processes:
+                clients += 1
+            worker = context.Process(
+                target=run_clients,
+                args=(transport, port, clients, args.messages, args.timeout, results),
+            )
+            worker.start()
+            workers.append(worker)
+
+        deadline = time.monotonic() + args.timeout
+        while (await stats())["subscribers"] < args.clients:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for clients to subscribe")
+            await asyncio.sleep(0.1)
+
+        before = await stats()
+        start = time.time()
+        response = await http_client.fetch(
+            "{}/publish?count={}&rate={}".format(base_url, args.messages, args.rate),
+            method="POST",
+            body=b"",
+            request_timeout=args.timeout,
+        )
+        published = json.loads(response.body)
+        reports = []
+        for _ in workers:
+            reports.append(await loop.run_in_executor(None, results.get))
+        after = await stats()
+    finally:
+        for worker in workers:
+            worker.join(5)
+        server.terminate()
+        server.join()
+
+    latencies = sorted(t for report in reports for t in report["latencies"])
+    finished = [r["finished"] for r in reports if r["finished"] is not None]
+    elapsed = (max(finished) if finished else time.time()) - start
+    cpu = after["cpu"] - before["cpu"]
+    return dict(
+        store=store_name,
+        transport=transport,
+        clients=args.clients,
+        published=published["published"],
+        rate=args.rate,
+        delivered=len(latencies),
+        errors=sum(report["errors"] for report in reports),
+        timeouts=sum(report["timeouts"] for report in reports),
+        duration=elapsed,
+        throughput=len(latencies) / elapsed if elapsed > 0 else None,
+        latency_ms=dict(
+            (name, None if value is None else value * 1000)
+            for name, value in (
+                ("p50", percentile(latencies, 0.5)),
+                ("p99", percentile(latencies, 0.99)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        ),
+        server_cpu_seconds=cpu,
+        server_cpu_percent=100 * cpu / elapsed if elapsed > 0 else None,
+        memory_per_subscriber=(before["rss"] - idle["rss"]) / args.clients,
+    )
+
+
+async def main(args):
+    results = []
+    for store_name in args.store:
+        for transport in args.transport:
+            result = await run_scenario(store_name, transport, args)
+            result.update(
+                tornadose=tornadose.__version__,
+                tornado=tornado.version,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                timestamp=time.time(),
+            )
+            print(
+                "{store}/{transport}: {delivered} delivered, "
+                "{throughput:.0f} msg/s, p50 {p50:.2f} ms, p99 {p99:.2f} ms".format(
+                    p50=result["latency_ms"]["p50"] or 0,
+                    p99=result["latency_ms"]["p99"] or 0,
+                    **dict(result, throughput=result["throughput"] or 0)
+                ),
+                file=sys.stderr,
+            )
+            results.append(result)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument(
+        "--rate", type=float, default=100, help="messages published per second"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=min(4, multiprocessing.cpu_count()),
+        help="number of client processes",
+    )
+    parser.add_argument("--store", nargs="+", choices=STORES, default=STORES)
+    parser.add_argument(
+        "--transport", nargs="+", choices=TRANSPORTS, default=TRANSPORTS
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -1,14 +1,20 @@
+from unittest.mock import Mock
+
 import pytest
+from tornado.httputil import HTTPServerRequest
+from tornado.web import Application
 
 from tornadose.handlers import BaseHandler
+from tornadose.messages import Message
 from tornadose.stores import BaseStore
+from tornadose.testing import FakeRedisServer
 
 
 class DummyStore(BaseStore):
     """Special store for testing handlers."""
 
     def submit(self, message):
-        self.message = message
+        self.message = Message(message)
 
     async def publish(self):
         for subscriber in self.subscribers:
@@ -32,3 +38,27 @@ def handler_class():
             assert self.message is not None
 
     yield MyHandler
+
+
+@pytest.fixture
+def make_subscriber():
+    """Factory for creating subscribers which only queue messages."""
+
+    class Subscriber(BaseHandler):
+        def publish(self, message):
+            pass
+
+    def factory(store, uri="/", **kwargs):
+        request = HTTPServerRequest(uri=uri, connection=Mock())
+        return Subscriber(Application(), request, store=store, **kwargs)
+
+    yield factory
+
+
+@pytest.fixture
+def redis_server(io_loop):
+    server = FakeRedisServer()
+    server.listen_unused()
+    yield server
+    server.stop()
+    server.disconnect_all()
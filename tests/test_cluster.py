@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+from tornado import gen
+
+from tornadose.cluster import (
+    FrameParser,
+    LocalClusterStore,
+    TCPClusterStore,
+    encode_frame,
+)
+from tornadose.messages import BULK, CONTROL, Message
+
+
+@pytest.mark.parametrize("data", ["text", b"\x00bytes", {"key": [1, 2]}, 1.5])
+def test_frames(data):
+    parser = FrameParser()
+    frame = encode_frame(7, 42, Message(data, topic="topic"))
+    for byte in frame:
+        parser.feed(bytes([byte]))
+    parser.feed(encode_frame(7, 43, Message("next")))
+    first, second = parser.frames()
+    origin, seq, message = first
+    assert (origin, seq, message.data, message.topic) == (7, 42, data, "topic")
+    assert second[1] == 43
+    assert second[2].topic is None
+    assert (message.priority, second[2].priority) == (BULK, BULK)
+
+
+def test_frame_priority():
+    parser = FrameParser()
+    parser.feed(encode_frame(7, 42, Message({"a": 1}, priority=CONTROL)))
+    ((_, _, message),) = parser.frames()
+    assert (message.data, message.priority) == ({"a": 1}, CONTROL)
+
+
+class TestLocalClusterStore:
+    @pytest.mark.gen_test
+    async def test_broadcast(self, tmp_path, make_subscriber):
+        stores = [LocalClusterStore(path=str(tmp_path)) for _ in range(3)]
+        subscribers = [make_subscriber(store) for store in stores]
+        try:
+            while not all(len(store.links) == 2 for store in stores):
+                await gen.sleep(0.01)
+            await stores[0].submit("first")
+            await stores[2].submit("second")
+            # Messages from different origins may arrive in any order.
+            for subscriber in subscribers:
+                received = set()
+                for _ in range(2):
+                    message = await asyncio.wait_for(subscriber.messages.get(), 1)
+                    received.add(message.data)
+                assert received == {"first", "second"}
+        finally:
+            for store in stores:
+                store.shutdown()
+        assert list(tmp_path.iterdir()) == []
+
+    @pytest.mark.gen_test
+    async def test_stale_socket(self, tmp_path):
+        store = LocalClusterStore(path=str(tmp_path))
+        other = LocalClusterStore(path=str(tmp_path))
+        other.server.stop()
+        stale = tmp_path / "999999999-0.sock"
+        (tmp_path / other.address.split("/")[-1]).rename(stale)
+        try:
+            await store.discover()
+            assert not stale.exists()
+            assert store.links == {}
+        finally:
+            store.shutdown()
+            other.shutdown()
+
+
+async def receive_all(subscriber, count):
+    received = set()
+    for _ in range(count):
+        message = await asyncio.wait_for(subscriber.messages.get(), 1)
+        received.add(message.data)
+    return received
+
+
+class TestTCPClusterStore:
+    @pytest.fixture
+    def stores(self, io_loop):
+        stores = [TCPClusterStore(address="127.0.0.1") for _ in range(3)]
+        peers = ["127.0.0.1:{}".format(store.port) for store in stores]
+        for store in stores:
+            for peer in peers:
+                store.add_peer(peer)
+        yield stores
+        for store in stores:
+            store.shutdown()
+
+    @pytest.mark.gen_test
+    async def test_broadcast(self, stores, make_subscriber):
+        subscribers = [make_subscriber(store) for store in stores]
+        while not all(len(store.links) == 3 for store in stores):
+            await gen.sleep(0.01)
+        await stores[0].submit("first")
+        await stores[1].submit("second")
+        for subscriber in subscribers:
+            assert await receive_all(subscriber, 2) == {"first", "second"}
+        # Frames sent to a node's own address are ignored
+        await gen.sleep(0.01)
+        assert [store.duplicates for store in stores] == [1, 1, 0]
+        assert all(subscriber.messages.empty() for subscriber in subscribers)
+
+    @pytest.mark.gen_test
+    async def test_reconnect(self, stores, make_subscriber):
+        first, second = stores[:2]
+        subscriber = make_subscriber(second)
+        while len(first.links) < 3:
+            await gen.sleep(0.01)
+        peer = "127.0.0.1:{}".format(second.port)
+        await first.submit("before")
+        assert await receive_all(subscriber, 1) == {"before"}
+        first.links[peer].close()
+        await first.submit("during")
+        await first.submit("after")
+        assert await receive_all(subscriber, 2) == {"during", "after"}
+        await gen.sleep(0.01)
+        assert subscriber.messages.empty()
+        # Only the frames the peer missed are sent again
+        assert second.duplicates == 0
+
+    @pytest.mark.gen_test
+    async def test_restart(self, stores, make_subscriber):
+        first, second = stores[:2]
+        while len(first.links) < 3:
+            await gen.sleep(0.01)
+        for i in range(5):
+            await first.submit(i)
+        await gen.sleep(0.05)
+        peer = "127.0.0.1:{}".format(second.port)
+        link = first.links[peer]
+        second.shutdown()
+        restarted = stores[1] = TCPClusterStore(port=second.port, address="127.0.0.1")
+        subscriber = make_subscriber(restarted)
+        while first.links.get(peer) in (None, link):
+            await gen.sleep(0.01)
+        await first.submit("new")
+        assert await receive_all(subscriber, 1) == {"new"}
+        await gen.sleep(0.05)
+        # Messages from before the restart are not sent to the new node
+        assert subscriber.messages.empty()
+        assert restarted.duplicates == 0
+
+    def test_dedup(self, stores):
+        store = stores[0]
+        store.receive(1, 1, Message("a"))
+        store.receive(1, 1, Message("a"))
+        store.receive(store.node_id, 5, Message("own"))
+        assert store.messages.qsize() == 1
+        assert store.duplicates == 2
@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+from tornado.httpclient import HTTPClientError
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from tornadose.codecs import JSON, RAW, MsgpackCodec, get_codec
+from tornadose.handlers import WebSocketSubscriber
+from tornadose.messages import Message
+from tornadose.stores import QueueStore
+
+
+def test_codecs():
+    assert json.loads(JSON.encode(b"data", "topic")) == dict(data="data", topic="topic")
+    assert RAW.encode("text") == b"text"
+    assert RAW.encode(b"\x00\xff") == b"\x00\xff"
+    with pytest.raises(TypeError):
+        RAW.encode(1.5)
+    assert get_codec("raw") is RAW
+    with pytest.raises(ValueError):
+        get_codec("unknown")
+
+
+def test_msgpack():
+    msgpack = pytest.importorskip("msgpack")
+    payload = MsgpackCodec().encode(1.5, "topic")
+    assert msgpack.unpackb(payload) == dict(data=1.5, topic="topic")
+
+
+def test_frames():
+    message = Message(b"\x00\x01")
+    assert message.frame(RAW) == b"\x82\x02\x00\x01"
+    assert message.frame(RAW) is message.frame(RAW)
+    assert message.frame(JSON)[0] == 0x81
+    assert message.frame(RAW, compressed=True)[0] == 0xC2
+
+
+class TestNegotiation:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        return Application([(r"/", WebSocketSubscriber, dict(store=store))])
+
+    @pytest.fixture
+    def url(self, http_server, base_url):
+        return base_url.replace("http://", "ws://") + "/"
+
+    async def receive(self, store, conn, data):
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        await store.submit(data)
+        return await conn.read_message()
+
+    @pytest.mark.gen_test
+    async def test_default(self, url, store):
+        conn = await websocket_connect(url)
+        assert json.loads(await self.receive(store, conn, "data")) == {"data": "data"}
+
+    @pytest.mark.gen_test
+    async def test_subprotocol(self, url, store):
+        conn = await websocket_connect(url, subprotocols=["unknown", "raw"])
+        assert conn.selected_subprotocol == "raw"
+        assert await self.receive(store, conn, b"\x00\x01") == b"\x00\x01"
+
+    @pytest.mark.gen_test
+    async def test_query_argument(self, url, store):
+        conn = await websocket_connect(url + "?codec=raw")
+        assert await self.receive(store, conn, "text") == b"text"
+
+    @pytest.mark.gen_test
+    async def test_unknown(self, url, store):
+        with pytest.raises(HTTPClientError) as exc_info:
+            await websocket_connect(url + "?codec=unknown")
+        assert exc_info.value.code == 400
+        assert not store.subscribers
+
+    @pytest.mark.gen_test
+    async def test_unsupported_data(self, url, store):
+        conn = await websocket_connect(url + "?codec=raw")
+        assert await self.receive(store, conn, {"key": "value"}) is None
+        assert conn.close_code == 1003
+        while store.subscribers:
+            await asyncio.sleep(0.01)
+
+    @pytest.mark.gen_test
+    async def test_refused(self, url, store):
+        store.broadcast(Message({"key": "value"}))
+        with pytest.raises(HTTPClientError) as exc_info:
+            await websocket_connect(url + "?codec=raw")
+        assert exc_info.value.code == 400
+        conn = await websocket_connect(url, subprotocols=["raw", "json"])
+        assert conn.selected_subprotocol == "json"
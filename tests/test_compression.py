@@ -0,0 +1,93 @@
+import asyncio
+import gzip
+import json
+import zlib
+
+import pytest
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from tornadose.codecs import JSON
+from tornadose.compression import GzipStream, deflate
+from tornadose.handlers import EventSource, WebSocketSubscriber
+from tornadose.messages import Message
+from tornadose.stores import QueueStore
+
+
+def test_shared_blocks():
+    messages = [Message("message {}".format(i) * 10) for i in range(3)]
+    early, late = GzipStream(), GzipStream()
+    streams = {early: b"", late: b""}
+    for i, message in enumerate(messages):
+        for stream in streams:
+            if stream is late and i == 0:
+                continue
+            streams[stream] += stream.block(message.sse, message.sse_deflate)
+    assert messages[0].sse_deflate is messages[0].sse_deflate
+
+    # A stream cut off at any message boundary can be decoded
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    expected = b"".join(message.sse for message in messages[1:])
+    assert decompressor.decompress(streams[late]) == expected
+
+    for stream, data in streams.items():
+        data += stream.trailer()
+        start = 0 if stream is early else 1
+        assert gzip.decompress(data) == b"".join(m.sse for m in messages[start:])
+    assert gzip.decompress(GzipStream().trailer()) == b""
+
+
+def test_deflate():
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    assert decompressor.decompress(deflate(b"data")) == b"data"
+
+
+class TestHandlers:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        options = dict(store=store, compress=True)
+        return Application(
+            [(r"/sse", EventSource, options), (r"/ws", WebSocketSubscriber, options)]
+        )
+
+    async def wait_for_subscriber(self, store):
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+
+    @pytest.mark.gen_test
+    async def test_event_source(self, http_client, base_url, store):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        events = asyncio.Queue()
+        http_client.fetch(
+            base_url + "/sse",
+            headers={"Accept-Encoding": "gzip"},
+            decompress_response=False,
+            streaming_callback=lambda chunk: events.put_nowait(
+                decompressor.decompress(chunk)
+            ),
+        )
+        await self.wait_for_subscriber(store)
+        data = "x" * 1000
+        await store.submit(data)
+        event = await events.get()
+        assert event.endswith(b"data: " + data.encode() + b"\n\n")
+
+    @pytest.mark.gen_test
+    async def test_websocket(self, http_server, base_url, store):
+        url = base_url.replace("http://", "ws://") + "/ws"
+        conn = await websocket_connect(url, compression_options={})
+        extensions = conn.headers["Sec-WebSocket-Extensions"]
+        assert "server_no_context_takeover" in extensions
+        await self.wait_for_subscriber(store)
+
+        for data in ("short", "long" * 100):
+            await store.submit(data)
+            assert json.loads(await conn.read_message()) == {"data": data}
+        message = store.history[-1]
+        assert (JSON, True) in message._encoded
+        assert len(message.ws_deflate_frame) < len(message.ws_frame)
+        conn.close()
@@ -0,0 +1,28 @@
+import pytest
+
+from tornadose.diff import apply_patch, diff
+
+
+@pytest.mark.parametrize(
+    "old,new",
+    [
+        ({"a": 1, "b": 2}, {"a": 1, "b": 3, "c": 4}),
+        ({"a": {"b": [1, 2, 3]}}, {"a": {"b": [1, 5]}}),
+        ({"a": [1, 2]}, {"a": [1, 2, 3, 4]}),
+        ({"a/b": 1, "~": 2}, {"a/b": 2}),
+        ([1, 2, 3], [0, 1, 2, 3]),
+        ({"a": 1}, {"a": 1.0}),
+        ({"a": 1}, [1]),
+    ],
+)
+def test_round_trip(old, new):
+    assert apply_patch(old, diff(old, new)) == new
+
+
+def test_minimal():
+    shared = {"large": list(range(100))}
+    old = {"shared": shared, "count": 1}
+    new = {"shared": shared, "count": 2}
+    assert diff(old, new) == [dict(op="replace", path="/count", value=2)]
+    assert diff(new, dict(new)) == []
+    assert diff({"a": [1, 2, 3]}, {"a": [1, 2]}) == [dict(op="remove", path="/a/2")]
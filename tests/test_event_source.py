@@ -1,9 +1,15 @@
+import asyncio
+from asyncio import Queue
+
 import pytest
 
 from tornado import escape
+from tornado.httpclient import HTTPClientError
 from tornado.web import Application
 
 from tornadose.handlers import EventSource
+from tornadose.messages import Message
+from tornadose.stores import QueueStore
 
 
 @pytest.fixture()
@@ -22,3 +28,149 @@ class TestEventSource:
         dummy_store.submit("test")
         io_loop.add_callback(dummy_store.publish)
         http_client.fetch(base_url, streaming_callback=callback)
+
+    async def test_publish(self, http_client, base_url, dummy_store):
+        chunks = Queue()
+        http_client.fetch(base_url, streaming_callback=chunks.put_nowait)
+        while not dummy_store.subscribers:
+            await asyncio.sleep(0.01)
+        dummy_store.submit("test")
+        await dummy_store.publish()
+        assert await chunks.get() == b"data: test\n\n"
+
+
+class TestReplay:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        return Application([(r"/", EventSource, {"store": store})])
+
+    @pytest.mark.gen_test
+    async def test_last_event_id(self, http_client, base_url, store):
+        for i in range(3):
+            store.broadcast(Message(i))
+        last_id = store.last_id - 1
+
+        chunks = Queue()
+        headers = {"Last-Event-ID": str(last_id)}
+        http_client.fetch(
+            base_url, headers=headers, streaming_callback=chunks.put_nowait
+        )
+        expected = "id: {}\ndata: 2\n\n".format(store.last_id).encode()
+        assert await chunks.get() == expected
+
+        await store.submit(3)
+        expected = "id: {}\ndata: 3\n\n".format(store.last_id + 1).encode()
+        assert await chunks.get() == expected
+
+
+class TestBatching:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        options = {"store": store, "batch_size": 10, "batch_delay": 0.01}
+        return Application([(r"/", EventSource, options)])
+
+    @pytest.mark.gen_test
+    async def test_single_flush(self, http_client, base_url, store):
+        chunks = Queue()
+        http_client.fetch(base_url, streaming_callback=chunks.put_nowait)
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        handler = next(iter(store.subscribers))
+        flushes = []
+        flush = handler.flush
+
+        def counting_flush():
+            flushes.append(None)
+            return flush()
+
+        handler.flush = counting_flush
+        for i in range(3):
+            await store.submit(i)
+
+        received = b""
+        while received.count(b"data:") < 3:
+            received += await chunks.get()
+        assert len(flushes) == 1
+
+
+class TestReconnect:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        options = {"store": store, "retry": 2, "retry_jitter": 1}
+        return Application([(r"/", EventSource, options)])
+
+    @pytest.mark.gen_test
+    async def test_retry(self, http_client, base_url, store):
+        chunks = Queue()
+        http_client.fetch(base_url, streaming_callback=chunks.put_nowait)
+        chunk = await chunks.get()
+        assert chunk.startswith(b"retry: ") and chunk.endswith(b"\n\n")
+        assert 2000 <= int(chunk[7:]) <= 3000
+
+    @pytest.mark.gen_test
+    async def test_drain(self, http_client, base_url, store):
+        chunks = Queue()
+        responses = [
+            http_client.fetch(base_url, streaming_callback=chunks.put_nowait)
+            for _ in range(4)
+        ]
+        for _ in range(4):
+            await chunks.get()
+        while len(store.subscribers) < 4:
+            await asyncio.sleep(0.01)
+
+        await store.drain(window=0.2, waves=2)
+        delays = []
+        for response in responses:
+            await response
+        while not chunks.empty():
+            delays.append(int(chunks.get_nowait()[7:]))
+        assert len(delays) == 4
+        assert all(0 <= delay <= 100 for delay in delays)
+        assert not store.subscribers
+
+
+class TestRateLimit:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        return Application([(r"/", EventSource, {"store": store, "max_rate": 100})])
+
+    @pytest.mark.gen_test
+    async def test_conflate(self, http_client, base_url, store):
+        chunks = Queue()
+        http_client.fetch(
+            base_url + "/?max_rate=10", streaming_callback=chunks.put_nowait
+        )
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        handler = next(iter(store.subscribers))
+        assert handler.max_rate == 10
+        store.broadcast(Message("first"))
+        assert (await chunks.get()).endswith(b"data: first\n\n")
+        for i in range(50):
+            store.broadcast(Message(i))
+        assert len(handler.messages) == 1
+        assert (await chunks.get()).endswith(b"data: 49\n\n")
+        assert handler.messages.conflated == 49
+
+    @pytest.mark.gen_test
+    async def test_invalid_rate(self, http_client, base_url, store):
+        with pytest.raises(HTTPClientError) as error:
+            await http_client.fetch(base_url + "/?max_rate=0")
+        assert error.value.code == 400
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+from tornado.httpclient import HTTPClientError
+from tornado.web import Application
+
+from tornadose.filters import Filter, FilterIndex
+from tornadose.handlers import EventSource
+from tornadose.messages import Message
+from tornadose.stores import BaseStore, QueueStore, TopicStore
+
+
+def test_parse():
+    filter = Filter.parse(["symbol=AAPL|MSFT", "price>=10", "quote.size<5"])
+    assert [c.op for c in filter.conditions] == ["=", ">=", "<"]
+    assert filter.conditions[0].values == {"AAPL", "MSFT"}
+    assert filter.matches(dict(symbol="AAPL", price=10, quote=dict(size=1)))
+    assert not filter.matches(dict(symbol="AAPL", price=9, quote=dict(size=1)))
+    assert not filter.matches(dict(symbol="IBM", price=10, quote=dict(size=1)))
+    assert not filter.matches(dict(symbol="AAPL", price=10))
+    assert not filter.matches("not a dict")
+
+
+def test_parse_values():
+    filter = Filter.parse(["n=1", "x=1.5", "flag=true", "none=null"])
+    assert filter.matches(dict(n=1, x=1.5, flag=True, none=None))
+    assert not filter.matches(dict(n="1", x=1.5, flag=True, none=None))
+
+
+@pytest.mark.parametrize("expression", ["symbol", "=AAPL", "price>cheap"])
+def test_parse_invalid(expression):
+    with pytest.raises(ValueError):
+        Filter.parse([expression])
+
+
+def test_index():
+    index = FilterIndex()
+    subscribers = {
+        "aapl": Filter.parse(["symbol=AAPL"]),
+        "tech": Filter.parse(["symbol=AAPL|MSFT", "price>100"]),
+        "cheap": Filter.parse(["price<10"]),
+        "mid": Filter.parse(["price>=10", "price<=100"]),
+    }
+    for name, filter in subscribers.items():
+        index.add(name, filter)
+    assert len(index) == 4
+
+    def match(**data):
+        return sorted(index.match(data))
+
+    assert match(symbol="AAPL", price=150) == ["aapl", "tech"]
+    assert match(symbol="MSFT", price=50) == ["mid"]
+    assert match(symbol="IBM", price=5) == ["cheap"]
+    assert match(symbol="IBM", price="5") == []
+    assert match(volume=10) == []
+
+    index.discard("aapl")
+    index.discard("mid")
+    assert match(symbol="AAPL", price=50) == []
+    assert index._equal.keys() == {"symbol"}
+    assert index._lower == {}
+
+
+@pytest.mark.asyncio
+class TestStores:
+    async def test_recipients(self, make_subscriber):
+        store = BaseStore()
+        everything = make_subscriber(store)
+        aapl = make_subscriber(store, uri="/?filter=symbol=AAPL")
+        assert store.filters.filter_of(aapl) is aapl.filter
+        store.deliver(Message(dict(symbol="AAPL")))
+        store.deliver(Message(dict(symbol="MSFT")))
+        assert len(everything.messages) == 2
+        assert aapl.messages.get_nowait().data == dict(symbol="AAPL")
+        assert aapl.messages.empty()
+        assert not store.accepts(aapl, Message(dict(symbol="MSFT")))
+        store.deregister(aapl)
+        assert not store.filters
+
+    async def test_shards(self, make_subscriber):
+        store = BaseStore(shards=2)
+        everything = make_subscriber(store)
+        aapl = make_subscriber(store, uri="/?filter=symbol=AAPL")
+        assert sum(len(shard) for shard in store._shards) == 1
+        store.deliver(Message(dict(symbol="AAPL")))
+        store.deliver(Message(dict(symbol="MSFT")))
+        await asyncio.sleep(0.01)
+        assert len(everything.messages) == 2
+        assert len(aapl.messages) == 1
+
+    async def test_topics(self, make_subscriber):
+        store = TopicStore()
+        subscriber = make_subscriber(store, uri="/?filter=price>10")
+        subscriber.subscribe("prices.*")
+        assert store.match("prices.AAPL") == []
+        store.deliver(Message(dict(price=20), topic="prices.AAPL"))
+        store.deliver(Message(dict(price=5), topic="prices.AAPL"))
+        store.deliver(Message(dict(price=20), topic="volumes.AAPL"))
+        assert subscriber.messages.get_nowait().data == dict(price=20)
+        assert subscriber.messages.empty()
+        store.deregister(subscriber)
+        assert not store._filtered and not store._patterns
+
+
+class TestHandlers:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store):
+        return Application([(r"/", EventSource, {"store": store})])
+
+    @pytest.mark.gen_test
+    async def test_invalid_filter(self, http_client, base_url, store):
+        with pytest.raises(HTTPClientError) as error:
+            await http_client.fetch(base_url + "/?filter=price")
+        assert error.value.code == 400
+        assert not store.subscribers
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPClientError
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from tornadose.handlers import EventSource, WebSocketSubscriber
+from tornadose.heartbeat import Heartbeat
+from tornadose.messages import Message
+from tornadose.stores import QueueStore
+
+
+class Pinged(object):
+    def __init__(self):
+        self.pings = []
+
+    def heartbeat(self, now):
+        self.pings.append(now)
+
+
+@pytest.mark.asyncio
+async def test_wheel():
+    heartbeat = Heartbeat(interval=60, slots=4)
+    subscribers = [Pinged() for _ in range(3)]
+    for subscriber in subscribers:
+        heartbeat.add(subscriber)
+    heartbeat.tick()
+    heartbeat.add(subscribers[0])
+    late = Pinged()
+    heartbeat.add(late)
+    for _ in range(3):
+        heartbeat.tick()
+    assert [len(s.pings) for s in subscribers] == [1, 1, 1]
+    assert late.pings == []
+    heartbeat.discard(subscribers[1])
+    for _ in range(4):
+        heartbeat.tick()
+    assert [len(s.pings) for s in subscribers + [late]] == [2, 1, 2, 1]
+    heartbeat.stop()
+
+
+def test_spread():
+    heartbeat = Heartbeat(interval=60, slots=4)
+    subscribers = [Pinged() for _ in range(10)]
+    for subscriber in subscribers:
+        heartbeat.add(subscriber)
+    assert sorted(len(slot) for slot in heartbeat.slots) == [2, 2, 3, 3]
+    for _ in range(4):
+        heartbeat.tick()
+    assert all(len(subscriber.pings) == 1 for subscriber in subscribers)
+    heartbeat.stop()
+
+
+class TestHandlers:
+    @pytest.fixture
+    def heartbeat(self, io_loop):
+        heartbeat = Heartbeat(interval=0.25, slots=2)
+        yield heartbeat
+        heartbeat.stop()
+
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore()
+
+    @pytest.fixture
+    def app(self, store, heartbeat):
+        options = dict(store=store, heartbeat=heartbeat)
+        return Application(
+            [(r"/sse", EventSource, options), (r"/ws", WebSocketSubscriber, options)]
+        )
+
+    async def subscriber(self, store):
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        return next(iter(store.subscribers))
+
+    @pytest.mark.gen_test
+    async def test_websocket(self, http_server, base_url, store, heartbeat):
+        url = base_url.replace("http://", "ws://") + "/ws"
+        conn = await websocket_connect(url)
+        subscriber = await self.subscriber(store)
+        await asyncio.sleep(0.6)
+        assert store.subscribers == {subscriber}
+        assert subscriber._last_pong > 0
+
+        subscriber.on_pong = lambda data: None
+        assert await conn.read_message() is None
+        assert not store.subscribers
+        assert len(heartbeat) == 0
+        assert store.metrics.evicted == 1
+
+    @pytest.mark.gen_test
+    async def test_event_source(self, http_client, base_url, store, heartbeat):
+        chunks = []
+        response = http_client.fetch(
+            base_url + "/sse", streaming_callback=chunks.append, request_timeout=5
+        )
+        subscriber = await self.subscriber(store)
+        await asyncio.sleep(0.6)
+        assert b": ping\n\n" in chunks
+
+        # A flush pending for a whole interval means the client is gone
+        subscriber._flushing = Future()
+        subscriber._flush_started = 0
+        with pytest.raises(HTTPClientError):
+            await response
+        while store.subscribers:
+            await asyncio.sleep(0.01)
+        assert len(heartbeat) == 0
+        assert store.metrics.evicted == 1
+
+    @pytest.mark.gen_test(timeout=10)
+    async def test_event_source_slow_client(
+        self, http_server, http_port, store, heartbeat
+    ):
+        heartbeat.interval = 60
+        stream = await TCPClient().connect("127.0.0.1", http_port)
+        await stream.write(b"GET /sse HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        subscriber = await self.subscriber(store)
+        count = 300
+        for i in range(count):
+            store.broadcast(Message("{:06d}".format(i) + "x" * 100000))
+        # Wait for the socket buffers to fill up
+        delivered = -1
+        while store.metrics.delivered != delivered:
+            delivered = store.metrics.delivered
+            await asyncio.sleep(0.05)
+        assert subscriber.messages.qsize()
+
+        # Pinging while data is being flushed must not stall the stream
+        for _ in range(3):
+            subscriber.heartbeat(IOLoop.current().time())
+            await asyncio.sleep(0.01)
+        assert store.subscribers == {subscriber}
+
+        events = []
+        while len(events) < count:
+            chunk = await stream.read_until(b"\n\n", max_bytes=1 << 20)
+            events.append(chunk.rsplit(b"data: ", 1)[-1][:6])
+        assert events == ["{:06d}".format(i).encode() for i in range(count)]
+        assert store.metrics.delivered == count
+        stream.close()
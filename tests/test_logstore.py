@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+import pytest
+
+from tornadose.logstore import LogStore, SegmentedLog
+from tornadose.messages import Message
+
+
+def fill(log, ids):
+    for id in ids:
+        log.append(id, Message(dict(n=id), topic="t"))
+
+
+def test_segments(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_size=100)
+    fill(log, range(1, 11))
+    assert len(log.segments) > 1
+    assert [m.id for m in log.read_after(0)] == list(range(1, 11))
+    messages = list(log.read_after(6))
+    assert [m.id for m in messages] == [7, 8, 9, 10]
+    assert messages[0].data == dict(n=7)
+    assert messages[0].topic == "t"
+    with pytest.raises(ValueError):
+        log.append(10, Message("old"))
+
+
+def test_recover(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_size=100)
+    fill(log, range(1, 11))
+    log.close()
+    last = log.segments[-1].path
+    with open(last, "ab") as f:
+        f.write(b"\x00\x00\x01")
+
+    log = SegmentedLog(str(tmp_path), segment_size=100)
+    assert log.last_id == 10
+    assert os.path.getsize(last) == log.segments[-1].size
+    fill(log, [11])
+    assert [m.id for m in log.read_after(9)] == [10, 11]
+
+
+def test_retention(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_size=100)
+    fill(log, range(1, 21))
+    count = len(log.segments)
+    assert log.enforce_retention(max_bytes=250) > 0
+    assert log.size <= 250
+    assert len(os.listdir(str(tmp_path))) == len(log.segments) < count
+    log.enforce_retention(max_age=-1)
+    assert len(log.segments) == 1
+    assert list(log.read_after(0))[-1].id == 20
+
+
+@pytest.mark.asyncio
+class TestLogStore:
+    async def test_restart(self, tmp_path, make_subscriber):
+        store = LogStore(str(tmp_path), replay_size=2)
+        for i in range(5):
+            await store.submit(i)
+        await asyncio.sleep(0.01)
+        last_id = store.last_id
+        subscriber = make_subscriber(store)
+        assert [m.data for m in store.replay(subscriber, last_id - 4)] == [1, 2, 3, 4]
+        store.shutdown()
+
+        store = LogStore(str(tmp_path))
+        assert store.last_id >= last_id
+        subscriber = make_subscriber(store)
+        replayed = store.replay(subscriber, last_id - 2)
+        assert [m.data for m in replayed] == [3, 4]
+        await store.submit(5)
+        await asyncio.sleep(0.01)
+        assert subscriber.messages.get_nowait().id > last_id
+        store.shutdown()
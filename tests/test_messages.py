@@ -0,0 +1,54 @@
+import json
+import struct
+
+import pytest
+
+from tornadose.messages import CONTROL, Message, websocket_frame
+
+
+class TestMessage:
+    def test_sse(self):
+        assert Message("test").sse == b"data: test\n\n"
+        assert Message(1.5).sse == b"data: 1.5\n\n"
+        assert Message(b"bytes").sse == b"data: bytes\n\n"
+
+    def test_sse_id(self):
+        message = Message("test")
+        message.id = 42
+        assert message.sse == b"id: 42\ndata: test\n\n"
+
+    def test_sse_priority(self):
+        message = Message("test", priority=CONTROL)
+        message.id = 42
+        assert message.sse == b"data: test\n\n"
+
+    def test_sse_multiline(self):
+        assert Message("a\nb\r\nc").sse == b"data: a\ndata: b\ndata: c\n\n"
+
+    def test_ws_payload(self):
+        assert json.loads(Message("test").ws_payload) == {"data": "test"}
+        assert json.loads(Message(b"test").ws_payload) == {"data": "test"}
+
+    def test_encoded_once(self):
+        message = Message("test")
+        assert message.sse is message.sse
+        assert message.ws_frame is message.ws_frame
+
+
+@pytest.mark.parametrize("length", [0, 125, 126, 0xFFFF, 0x10000])
+def test_websocket_frame(length):
+    payload = b"x" * length
+    frame = websocket_frame(payload)
+    assert frame[0] == 0x81
+    if length < 126:
+        assert frame[1] == length
+        header = 2
+    elif length <= 0xFFFF:
+        assert frame[1] == 126
+        assert struct.unpack("!H", frame[2:4])[0] == length
+        header = 4
+    else:
+        assert frame[1] == 127
+        assert struct.unpack("!Q", frame[2:10])[0] == length
+        header = 10
+    assert frame[header:] == payload
@@ -0,0 +1,71 @@
+import asyncio
+from asyncio import Queue
+
+import pytest
+from tornado.web import Application
+
+from tornadose.handlers import EventSource
+from tornadose.messages import Message
+from tornadose.metrics import DEPTH_BUCKETS, Histogram, MetricsHandler, collect
+from tornadose.queues import DROP_OLDEST
+from tornadose.stores import QueueStore
+
+
+def test_histogram():
+    histogram = Histogram(DEPTH_BUCKETS)
+    for value in (0, 1, 3, 3, 5000):
+        histogram.observe(value)
+    cumulative = dict(histogram.cumulative())
+    assert cumulative[0] == 1
+    assert cumulative[5] == 4
+    assert cumulative[float("inf")] == 5
+    assert histogram.sum == 5007
+
+
+@pytest.mark.asyncio
+async def test_collect(make_subscriber):
+    store = QueueStore(name="test", max_queue_size=2, overflow_policy=DROP_OLDEST)
+    subscribers = [make_subscriber(store) for _ in range(3)]
+    for i in range(3):
+        store.broadcast(Message(i))
+    subscribers[0].messages.get_nowait()
+
+    lines = collect([store]).splitlines()
+    assert 'tornadose_subscribers{store="test"} 3' in lines
+    assert 'tornadose_messages_submitted_total{store="test"} 3' in lines
+    assert 'tornadose_overflows_total{store="test",policy="drop-oldest"} 3' in lines
+    assert 'tornadose_fanout_seconds_count{store="test"} 3' in lines
+    assert 'tornadose_messages_rejected_total{store="test"} 0' in lines
+    assert 'tornadose_queue_depth_bucket{store="test",le="1.0"} 1' in lines
+    assert 'tornadose_queue_depth_bucket{store="test",le="2.0"} 3' in lines
+    assert "# TYPE tornadose_queue_depth histogram" in lines
+
+
+class TestMetricsHandler:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore(name="stream")
+
+    @pytest.fixture
+    def app(self, store):
+        return Application(
+            [
+                (r"/stream", EventSource, {"store": store}),
+                (r"/metrics", MetricsHandler, {"stores": [store]}),
+            ]
+        )
+
+    @pytest.mark.gen_test
+    async def test_get(self, http_client, base_url, store):
+        chunks = Queue()
+        http_client.fetch(base_url + "/stream", streaming_callback=chunks.put_nowait)
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        await store.submit("test")
+        await chunks.get()
+
+        response = await http_client.fetch(base_url + "/metrics")
+        assert response.headers["Content-Type"].startswith("text/plain")
+        lines = response.body.decode().splitlines()
+        assert 'tornadose_subscribers{store="stream"} 1' in lines
+        assert 'tornadose_messages_delivered_total{store="stream"} 1' in lines
@@ -0,0 +1,148 @@
+import asyncio
+from asyncio import QueueFull
+
+import pytest
+
+from tornadose.messages import CONTROL, Message
+from tornadose.queues import (
+    ConflatingQueue,
+    DISCONNECT,
+    DROP_NEWEST,
+    DROP_OLDEST,
+    KEEP_LATEST,
+    QueueClosed,
+    SubscriberQueue,
+)
+
+
+def fill(queue, n):
+    return [queue.put_nowait(i) for i in range(n)]
+
+
+class TestSubscriberQueue:
+    def test_unbounded(self):
+        queue = SubscriberQueue()
+        assert fill(queue, 100) == [None] * 100
+        assert len(queue) == 100
+        assert not queue.counts
+
+    def test_invalid_policy(self):
+        with pytest.raises(ValueError):
+            SubscriberQueue(1, "nope")
+
+    def test_drop_oldest(self):
+        queue = SubscriberQueue(2, DROP_OLDEST)
+        assert fill(queue, 4) == [None, None, DROP_OLDEST, DROP_OLDEST]
+        assert [queue.get_nowait(), queue.get_nowait()] == [2, 3]
+        assert queue.counts[DROP_OLDEST] == 2
+        assert queue.dropped == 2
+
+    def test_drop_newest(self):
+        queue = SubscriberQueue(2, DROP_NEWEST)
+        fill(queue, 4)
+        assert [queue.get_nowait(), queue.get_nowait()] == [0, 1]
+        assert queue.counts[DROP_NEWEST] == 2
+        assert queue.dropped == 2
+
+    def test_keep_latest(self):
+        queue = SubscriberQueue(2, KEEP_LATEST)
+        fill(queue, 3)
+        assert len(queue) == 1
+        assert queue.get_nowait() == 2
+        assert queue.counts[KEEP_LATEST] == 1
+        assert queue.dropped == 2
+
+    @pytest.mark.asyncio
+    async def test_disconnect(self):
+        queue = SubscriberQueue(1, DISCONNECT)
+        queue.put_nowait(0)
+        with pytest.raises(QueueFull):
+            queue.put_nowait(1)
+        assert queue.closed
+        assert queue.counts[DISCONNECT] == 1
+        assert queue.put_nowait(2) is None
+        with pytest.raises(QueueClosed):
+            await queue.get()
+
+    @pytest.mark.asyncio
+    async def test_get_waits(self):
+        queue = SubscriberQueue()
+        asyncio.get_running_loop().call_soon(queue.put_nowait, "data")
+        assert await queue.get() == "data"
+
+    @pytest.mark.asyncio
+    async def test_get_batch(self):
+        queue = SubscriberQueue()
+        fill(queue, 5)
+        assert await queue.get_batch(3) == [0, 1, 2]
+        assert await queue.get_batch(3) == [3, 4]
+
+    @pytest.mark.asyncio
+    async def test_get_batch_delay(self):
+        queue = SubscriberQueue()
+        loop = asyncio.get_running_loop()
+        queue.put_nowait(0)
+        loop.call_later(0.01, queue.put_nowait, 1)
+        loop.call_later(0.02, queue.put_nowait, 2)
+        loop.call_later(0.2, queue.put_nowait, 3)
+        assert await queue.get_batch(3, delay=0.1) == [0, 1, 2]
+        assert await queue.get_batch(3, delay=0.05) == [3]
+
+    def test_priority_lanes(self):
+        queue = SubscriberQueue(2, DROP_OLDEST)
+        fill(queue, 2)
+        queue.put_nowait(Message("control", priority=CONTROL))
+        queue.put_nowait(Message("urgent", priority=CONTROL + 1))
+        assert queue.put_nowait(2) == DROP_OLDEST
+        assert queue.put_nowait(Message("later", priority=CONTROL)) is None
+        assert len(queue) == 5
+        received = [queue.get_nowait() for _ in range(5)]
+        assert [getattr(m, "data", m) for m in received] == [
+            "urgent",
+            "control",
+            "later",
+            1,
+            2,
+        ]
+        assert queue.dropped == 1
+
+    def test_clear_keeps_priority(self):
+        queue = SubscriberQueue()
+        fill(queue, 3)
+        queue.put_nowait(Message("control", priority=CONTROL))
+        queue.clear()
+        assert queue.get_nowait().data == "control"
+        assert queue.empty()
+
+
+class TestConflatingQueue:
+    def test_latest_per_topic(self):
+        queue = ConflatingQueue()
+        for i in range(3):
+            queue.put_nowait(Message(i, topic="a"))
+            queue.put_nowait(Message(i, topic="b"))
+        queue.put_nowait(Message("untagged"))
+        assert len(queue) == 3
+        assert queue.conflated == 4
+        received = [queue.get_nowait() for _ in range(3)]
+        assert [(m.topic, m.data) for m in received] == [
+            ("a", 2),
+            ("b", 2),
+            (None, "untagged"),
+        ]
+        assert queue.empty()
+
+    def test_full(self):
+        queue = ConflatingQueue(1, DROP_OLDEST)
+        queue.put_nowait(Message(0, topic="a"))
+        assert queue.put_nowait(Message(1, topic="a")) is None
+        assert queue.put_nowait(Message(2, topic="b")) == DROP_OLDEST
+        assert queue.get_nowait().data == 2
+
+    def test_priority_not_conflated(self):
+        queue = ConflatingQueue()
+        queue.put_nowait(Message(0, topic="a"))
+        queue.put_nowait(Message(1, topic="a", priority=CONTROL))
+        queue.put_nowait(Message(2, topic="a", priority=CONTROL))
+        assert queue.conflated == 0
+        assert [queue.get_nowait().data for _ in range(3)] == [1, 2, 0]
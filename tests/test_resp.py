@@ -0,0 +1,47 @@
+import pytest
+
+from tornadose.resp import RedisConnection, RedisError, RespParser, encode_command
+
+
+def test_encode_command():
+    assert encode_command("SET", b"key", 1) == (
+        b"*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$1\r\n1\r\n"
+    )
+
+
+class TestRespParser:
+    def test_reply_types(self):
+        parser = RespParser()
+        parser.feed(b"+OK\r\n-ERR bad\r\n:42\r\n$3\r\nfoo\r\n$-1\r\n")
+        parser.feed(b"*2\r\n$1\r\na\r\n*1\r\n:1\r\n")
+        ok, error, number, bulk, null, array = parser.replies()
+        assert ok == b"OK"
+        assert isinstance(error, RedisError)
+        assert number == 42
+        assert bulk == b"foo"
+        assert null is None
+        assert array == [b"a", [1]]
+
+    def test_partial(self):
+        parser = RespParser()
+        data = b"*3\r\n$7\r\nmessage\r\n$2\r\nch\r\n$5\r\nhello\r\n:1\r\n"
+        replies = []
+        for i in range(len(data)):
+            parser.feed(data[i : i + 1])  # noqa: E203
+            replies.extend(parser.replies())
+        assert replies == [[b"message", b"ch", b"hello"], 1]
+
+
+class TestRedisConnection:
+    @pytest.mark.gen_test
+    async def test_pipeline(self, redis_server):
+        connection = RedisConnection(port=redis_server.port, password="secret")
+        await connection.ensure_connected()
+        futures = connection.execute_many([("SET", "a", "1"), ("GET", "a"), ("NOPE",)])
+        assert await futures[0] == b"OK"
+        assert await futures[1] == b"1"
+        with pytest.raises(RedisError):
+            await futures[2]
+        assert redis_server.commands[0] == [b"AUTH", b"secret"]
+        connection.close()
+        await connection.wait_closed()
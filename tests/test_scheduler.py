@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+from tornado.ioloop import IOLoop
+
+from tornadose.scheduler import Scheduler
+
+
+@pytest.mark.asyncio
+async def test_wait():
+    scheduler = Scheduler(resolution=0.005, slots=4)
+    start = IOLoop.current().time()
+    short = scheduler.wait(0.01)
+    long = scheduler.wait(0.05)
+    assert len(scheduler) == 2
+    await short
+    assert not long.done()
+    await long
+    assert IOLoop.current().time() - start >= 0.045
+    assert len(scheduler) == 0
+    assert scheduler._timer is None
+
+
+@pytest.mark.asyncio
+async def test_current():
+    assert Scheduler.current() is Scheduler.current()
+    await asyncio.wait_for(Scheduler.current().wait(0), 1)
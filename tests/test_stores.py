@@ -1,8 +1,20 @@
-from unittest.mock import patch
+import asyncio
+import threading
+from unittest.mock import Mock, patch
 
 import pytest
 
-from tornadose.stores import BaseStore, DataStore, QueueStore, RedisStore
+from tornadose.diff import apply_patch
+from tornadose.messages import CONTROL, Message
+from tornadose.stores import (
+    AsyncRedisStore,
+    BaseStore,
+    DataStore,
+    DeltaDataStore,
+    QueueStore,
+    RedisStore,
+    TopicStore,
+)
 
 
 @pytest.fixture
@@ -37,6 +49,115 @@ class TestBaseStore:
             base_store.publish()
 
 
+@pytest.mark.asyncio
+class TestShards:
+    async def test_balanced(self, make_subscriber):
+        store = BaseStore(shards=4)
+        subscribers = [make_subscriber(store) for _ in range(10)]
+        assert sorted(len(shard) for shard in store._shards) == [2, 2, 3, 3]
+        for subscriber in subscribers[:3]:
+            store.deregister(subscriber)
+        assert sum(len(shard) for shard in store._shards) == 7
+
+    async def test_deliver(self, make_subscriber):
+        store = BaseStore(shards=3)
+        subscribers = [make_subscriber(store) for _ in range(7)]
+        store.broadcast(Message("first"))
+        store.broadcast(Message("second"))
+        assert all(s.messages.empty() for s in subscribers)
+        await asyncio.sleep(0.01)
+        for subscriber in subscribers:
+            batch = await subscriber.messages.get_batch(10)
+            assert [m.data for m in batch] == ["first", "second"]
+
+    async def test_topic_store(self):
+        with pytest.raises(ValueError):
+            TopicStore(shards=2)
+
+
+@pytest.mark.asyncio
+class TestSubmitThreadsafe:
+    async def test_threads(self, make_subscriber):
+        store = QueueStore()
+        subscriber = make_subscriber(store)
+        store._io_loop = Mock(wraps=store._io_loop)
+
+        def produce(n):
+            for i in range(500):
+                store.submit_threadsafe((n, i))
+
+        threads = [threading.Thread(target=produce, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        await asyncio.sleep(0.05)
+
+        received = await subscriber.messages.get_batch(2000)
+        assert len(received) == 2000
+        for n in range(4):
+            assert [m.data[1] for m in received if m.data[0] == n] == list(range(500))
+        assert store._io_loop.add_callback.call_count < 2000
+
+    async def test_data_store(self, make_subscriber):
+        store = DataStore()
+        subscriber = make_subscriber(store)
+        thread = threading.Thread(target=store.submit_threadsafe, args=("data",))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0.01)
+        assert subscriber.messages.get_nowait().data == "data"
+
+
+@pytest.mark.asyncio
+class TestReplay:
+    async def test_ids(self, base_store):
+        messages = [Message(i) for i in range(3)]
+        first = base_store.last_id
+        for message in messages:
+            base_store.broadcast(message)
+        assert [m.id for m in messages] == [first + 1, first + 2, first + 3]
+
+    async def test_replay(self, make_subscriber):
+        store = BaseStore(replay_size=3)
+        subscriber = make_subscriber(store)
+        for i in range(5):
+            store.broadcast(Message(i))
+        last_id = store.last_id
+
+        def replayed(since):
+            return [m.data for m in store.replay(subscriber, since)]
+
+        assert replayed(last_id) == []
+        assert replayed(last_id - 1) == [4]
+        assert replayed(last_id - 3) == [2, 3, 4]
+        assert replayed(last_id - 4) == [2, 3, 4]
+        assert replayed(last_id + 10) == []
+
+    async def test_replay_disabled(self, make_subscriber):
+        store = BaseStore(replay_size=0)
+        store.broadcast(Message("data"))
+        assert store.replay(make_subscriber(store), 0) == []
+
+    async def test_replay_topics(self, make_subscriber):
+        store = TopicStore()
+        subscriber = make_subscriber(store, topic="a*")
+        subscriber.subscribe()
+        last_id = store.last_id
+        for topic in ["a", "b", "ab"]:
+            store.broadcast(Message(topic, topic=topic))
+        assert [m.data for m in store.replay(subscriber, last_id)] == ["a", "ab"]
+
+    async def test_replay_data_store(self, make_subscriber):
+        store = DataStore()
+        subscriber = make_subscriber(store)
+        assert store.replay(subscriber, 0) == []
+        store.set_data("data")
+        await asyncio.sleep(0.01)
+        assert [m.data for m in store.replay(subscriber, 0)] == ["data"]
+        assert store.replay(subscriber, store.last_id) == []
+
+
 @pytest.mark.asyncio
 class TestDataStore:
     async def test_data_property(self, data_store):
@@ -44,16 +165,277 @@ class TestDataStore:
         data_store.data = "data"
         assert data_store.data == "data"
 
+    async def test_version(self, data_store):
+        assert data_store.version == 0
+        data_store.set_data("data")
+        data_store.set_data("".join(["da", "ta"]))
+        assert data_store.version == 1
+        data_store.set_data("new")
+        assert data_store.version == 2
+
+    async def test_publish_on_change(self, make_subscriber):
+        store = DataStore("initial")
+        await asyncio.sleep(0.01)
+        subscriber = make_subscriber(store)
+        assert subscriber.messages.get_nowait().data == "initial"
+        await asyncio.sleep(0.01)
+        assert subscriber.messages.empty()
+
+        late = make_subscriber(store)
+        store.set_data("first")
+        store.set_data("second")
+        await asyncio.sleep(0.01)
+        assert len(subscriber.messages) == 1
+        assert subscriber.messages.get_nowait().data == "second"
+        assert late.messages.get_nowait().data == "second"
+        await asyncio.sleep(0.01)
+        assert subscriber.messages.empty()
+
 
 @pytest.mark.asyncio
 class TestQueueStore:
     async def test_submit(self, queue_store):
-        queue_store.submit("data")
+        await queue_store.submit("data")
+        assert queue_store.messages.get_nowait().data == "data"
+
+    async def test_water_marks(self, make_subscriber):
+        store = QueueStore(high_water_mark=4, low_water_mark=1)
+        make_subscriber(store)
+        for i in range(4):
+            assert store.try_submit(i)
+        assert store.saturated
+        assert not store.try_submit(4)
+        assert store.metrics.rejected == 1
+
+        submitted = asyncio.ensure_future(store.submit(5))
+        await asyncio.sleep(0)
+        assert not submitted.done()
+        while not submitted.done():
+            await asyncio.sleep(0.001)
+        assert not store.saturated
+        assert store.messages.qsize() <= 2
+        assert store.metrics.blocked.count == 1
+        assert store.metrics.blocked.sum > 0
+
+    async def test_invalid_water_marks(self):
+        with pytest.raises(ValueError):
+            QueueStore(high_water_mark=2, low_water_mark=2)
+
+    async def test_priority(self, make_subscriber):
+        store = QueueStore(high_water_mark=2)
+        subscriber = make_subscriber(store)
+        assert store.try_submit("bulk")
+        assert store.try_submit("bulk")
+        assert store.saturated
+        assert store.try_submit("control", priority=CONTROL)
+        await asyncio.wait_for(store.submit("urgent", priority=CONTROL), 1)
+        while store.messages.qsize():
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.01)
+        received = [subscriber.messages.get_nowait() for _ in range(4)]
+        assert [m.data for m in received] == ["control", "urgent", "bulk", "bulk"]
+
+
+@pytest.mark.asyncio
+class TestTopicStore:
+    async def test_match(self, make_subscriber):
+        store = TopicStore()
+        subscribers = {}
+        for topic in ["a.b", "a.c", "a.*", "*", "b*", None]:
+            subscribers[topic] = make_subscriber(store)
+            subscribers[topic].subscribe(topic)
+
+        def matching(topic):
+            found = set()
+            for subset in store.match(topic):
+                found.update(s.topic for s in subset)
+            return found
+
+        assert matching("a.b") == {"a.b", "a.*", "*"}
+        assert matching("a.d") == {"a.*", "*"}
+        assert matching("b") == {"b*", "*"}
+        assert matching("c") == {"*"}
+
+        store.deregister(subscribers["*"])
+        subscribers["a.b"].subscribe("a.c")
+        assert matching("a.b") == {"a.*"}
+        assert matching("a.c") == {"a.c", "a.*"}
+        assert sum(len(subset) for subset in store.match("a.c")) == 3
+        assert matching("c") == set()
+
+    async def test_publish(self, make_subscriber):
+        store = TopicStore()
+        aapl = make_subscriber(store)
+        aapl.subscribe("AAPL")
+        msft = make_subscriber(store)
+        msft.subscribe("MSFT")
+        await store.submit("AAPL", 1)
+        await store.submit("MSFT", 2)
+        await asyncio.sleep(0.01)
+        assert len(aapl.messages) == 1
+        message = aapl.messages.get_nowait()
+        assert (message.topic, message.data) == ("AAPL", 1)
+        assert msft.messages.get_nowait().data == 2
 
 
 @pytest.mark.asyncio
 class TestRedisStore:
     async def test_submit(self, redis_store):
-        with patch.object(redis_store._redis, "publish") as publish:
-            redis_store.submit("data", debug=True)
-            publish.assert_called_once_with(redis_store.channel, "data")
+        pipeline = redis_store._redis.pipeline.return_value
+        pipeline.execute.return_value = [1, True, 2]
+        first = redis_store.submit("data", debug=True)
+        second = redis_store.submit("more")
+        assert await first == 1
+        assert await second == 2
+        pipeline.publish.assert_any_call(redis_store.channel, "data")
+        pipeline.publish.assert_any_call(redis_store.channel, "more")
+        pipeline.setex.assert_called_once_with(redis_store.channel, 5, "data")
+        pipeline.execute.assert_called_once()
+
+    async def test_submit_batch_size(self, redis_store):
+        redis_store._outgoing.max_size = 2
+        pipeline = redis_store._redis.pipeline.return_value
+        pipeline.execute.side_effect = lambda **kwargs: [1, 1]
+        futures = [redis_store.submit(str(i)) for i in range(4)]
+        assert len(redis_store._outgoing) == 0
+        assert await asyncio.gather(*futures) == [1] * 4
+        assert pipeline.execute.call_count == 2
+
+    async def test_shutdown(self, redis_store):
+        pipeline = redis_store._redis.pipeline.return_value
+        pipeline.execute.return_value = [1]
+        future = redis_store.submit("last")
+        redis_store.shutdown()
+        assert await future == 1
+        pipeline.publish.assert_called_once_with(redis_store.channel, "last")
+        await asyncio.sleep(0)
+        assert redis_store._publish_executor._shutdown
+
+
+class TestAsyncRedisStore:
+    @pytest.fixture
+    def store(self, redis_server):
+        store = AsyncRedisStore(
+            channels=["prices"], patterns=["news.*"], port=redis_server.port
+        )
+        store.reconnect_delay = 0.01
+        yield store
+        store.shutdown()
+
+    async def wait_subscribed(self, redis_server):
+        while not redis_server.channels.get(b"prices"):
+            await asyncio.sleep(0.01)
+
+    @pytest.mark.gen_test
+    async def test_publish(self, store, redis_server, make_subscriber):
+        everything = make_subscriber(store, topic="*")
+        everything.subscribe()
+        news = make_subscriber(store, topic="news.*")
+        news.subscribe()
+        await self.wait_subscribed(redis_server)
+
+        results = [
+            store.submit("prices", "1"),
+            store.submit("news.tech", "2"),
+            store.submit("other", "3"),
+        ]
+        assert await asyncio.gather(*results) == [1, 1, 0]
+        commands = [c for c in redis_server.commands if c[0] == b"PUBLISH"]
+        assert len(commands) == 3
+        while len(everything.messages) < 2:
+            await asyncio.sleep(0.01)
+
+        message = everything.messages.get_nowait()
+        assert (message.topic, message.data) == ("prices", b"1")
+        message = everything.messages.get_nowait()
+        assert (message.topic, message.data) == ("news.tech", b"2")
+        assert news.messages.get_nowait() is message
+
+    @pytest.mark.gen_test
+    async def test_reconnect(self, store, redis_server, make_subscriber):
+        subscriber = make_subscriber(store, topic="prices")
+        subscriber.subscribe()
+        await self.wait_subscribed(redis_server)
+        redis_server.disconnect_all()
+        while redis_server.channels.get(b"prices"):
+            await asyncio.sleep(0.01)
+        await self.wait_subscribed(redis_server)
+        await store.submit("prices", "data")
+        while subscriber.messages.empty():
+            await asyncio.sleep(0.01)
+        assert subscriber.messages.get_nowait().data == b"data"
+
+    @pytest.mark.gen_test
+    async def test_try_submit(self, store, redis_server, make_subscriber):
+        subscriber = make_subscriber(store, topic="prices")
+        subscriber.subscribe()
+        await self.wait_subscribed(redis_server)
+        assert store.try_submit("prices", "data")
+        while subscriber.messages.empty():
+            await asyncio.sleep(0.01)
+        assert subscriber.messages.get_nowait().data == b"data"
+        assert store.messages.empty()
+
+
+@pytest.mark.asyncio
+class TestDeltaDataStore:
+    async def test_patches(self, make_subscriber):
+        store = DeltaDataStore({"a": 1, "b": [1, 2]})
+        await asyncio.sleep(0.01)
+        subscriber = make_subscriber(store)
+        snapshot = subscriber.messages.get_nowait().data
+        assert snapshot == dict(version=1, snapshot={"a": 1, "b": [1, 2]})
+
+        document = snapshot["snapshot"]
+        for data in ({"a": 2, "b": [1, 2]}, {"a": 2, "b": [1, 2, 3], "c": None}):
+            store.set_data(data)
+            await asyncio.sleep(0.01)
+            message = subscriber.messages.get_nowait().data
+            assert message["base"] == message["version"] - 1
+            document = apply_patch(document, message["patch"])
+            assert document == data
+
+    async def test_resync(self, make_subscriber):
+        store = DeltaDataStore({"count": 0})
+        store.max_lag = 2
+        await asyncio.sleep(0.01)
+        subscriber = make_subscriber(store)
+        # The initial snapshot and one patch are queued before the resync
+        for i in range(1, 3):
+            store.set_data({"count": i})
+            await asyncio.sleep(0.01)
+        assert len(subscriber.messages) == 1
+        message = subscriber.messages.get_nowait()
+        assert message.data == dict(version=3, snapshot={"count": 2})
+        assert message.id == store.last_id
+
+        assert store.replay(subscriber, store.last_id) == []
+        assert store.replay(subscriber, store.last_id - 1) == [message]
+
+    async def test_max_rate(self, make_subscriber):
+        store = DeltaDataStore({"count": 0})
+        await asyncio.sleep(0.01)
+        subscriber = make_subscriber(store, max_rate=1)
+        assert subscriber.messages.get_nowait().data["version"] == 1
+        for i in range(1, 4):
+            store.set_data({"count": i})
+            await asyncio.sleep(0.01)
+        assert len(subscriber.messages) == 1
+        message = subscriber.messages.get_nowait()
+        assert message.data == dict(version=4, snapshot={"count": 3})
+
+        store.set_data({"count": 4})
+        await asyncio.sleep(0.01)
+        message = subscriber.messages.get_nowait()
+        assert (message.data["base"], message.data["version"]) == (4, 5)
+
+    async def test_modified_in_place(self, make_subscriber):
+        data = {"count": 0}
+        store = DeltaDataStore(data)
+        await asyncio.sleep(0.01)
+        subscriber = make_subscriber(store)
+        subscriber.messages.get_nowait()
+        data["count"] = 1
+        store.set_data(data)
+        await asyncio.sleep(0.01)
+        assert subscriber.messages.get_nowait().data["snapshot"] == {"count": 1}
@@ -0,0 +1,136 @@
+import asyncio
+from asyncio import Queue
+import json
+
+import pytest
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+from tornadose.handlers import EventSource, WebSocketSubscriber
+from tornadose.messages import Message
+from tornadose.metrics import Histogram, collect
+from tornadose.stores import DataStore, QueueStore
+from tornadose.tracing import Tracer, TraceHandler
+
+
+def test_sample_rate():
+    tracer = Tracer(0.1)
+    messages = [Message(i) for i in range(10000)]
+    for message in messages:
+        tracer.sample(message)
+    sampled = sum(1 for message in messages if message.trace)
+    assert sampled == tracer.sampled
+    assert 700 < sampled < 1300
+    assert all(message.trace is False for message in messages if not message.trace)
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        Tracer(0)
+
+
+def test_quantile():
+    histogram = Histogram((1, 2, 3))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 2.5, 10):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == float("inf")
+
+
+def test_slowest():
+    tracer = Tracer(1, slowest=2)
+    for total in (0.3, 0.1, 0.5):
+        tracer.record(object(), Message(total), {"total": total})
+    assert [entry["stages"]["total"] for entry in tracer.slowest] == [0.5, 0.3]
+    assert tracer.histograms["total"].count == 3
+    tracer.clear()
+    assert not tracer.slowest
+
+
+@pytest.mark.asyncio
+async def test_stages(make_subscriber):
+    store = QueueStore(trace_rate=1)
+    subscriber = make_subscriber(store)
+    await store.submit("data")
+    while not subscriber.messages.qsize():
+        await asyncio.sleep(0.001)
+    message = subscriber.messages.get_nowait()
+    trace = message.trace
+    assert trace.submitted <= trace.published <= trace.queued[subscriber]
+    trace.finish(subscriber, message, trace.published + 1, trace.published + 3)
+    assert not trace.queued
+    (entry,) = store.tracer.slowest
+    assert entry["id"] == message.id
+    assert entry["stages"]["queue"] > 0
+    assert entry["stages"]["flush"] == 2
+    assert set(entry["stages"]) == {"store", "fanout", "queue", "flush", "total"}
+
+
+@pytest.mark.asyncio
+async def test_sampled_on_broadcast(make_subscriber):
+    store = DataStore(trace_rate=1)
+    subscriber = make_subscriber(store)
+    store.broadcast(Message("data"))
+    message = subscriber.messages.get_nowait()
+    assert message.trace.submitted is None
+    assert message.trace.published is not None
+
+
+class TestTraceHandler:
+    @pytest.fixture
+    def store(self, io_loop):
+        return QueueStore(name="traced", trace_rate=1)
+
+    @pytest.fixture
+    def app(self, store):
+        return Application(
+            [
+                (r"/stream", EventSource, {"store": store}),
+                (r"/socket", WebSocketSubscriber, {"store": store}),
+                (r"/traces", TraceHandler, {"stores": [store, QueueStore()]}),
+            ]
+        )
+
+    @pytest.mark.gen_test
+    async def test_get(self, http_client, http_server, base_url, store):
+        chunks = Queue()
+        http_client.fetch(base_url + "/stream", streaming_callback=chunks.put_nowait)
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        await store.submit("test")
+        await chunks.get()
+        await asyncio.sleep(0.01)
+
+        response = await http_client.fetch(base_url + "/traces")
+        assert response.headers["Content-Type"].startswith("application/json")
+        traces = json.loads(response.body)
+        assert list(traces) == ["traced"]
+        summary = traces["traced"]
+        assert summary["sampled"] == 1
+        assert summary["stages"]["total"]["count"] == 1
+        assert summary["stages"]["queue"]["quantiles"]["0.99"] is not None
+        (entry,) = summary["slowest"]
+        assert entry["subscriber"] == "EventSource"
+
+        response = await http_client.fetch(base_url + "/traces?store=other")
+        assert json.loads(response.body) == {}
+
+        lines = collect([store]).splitlines()
+        assert (
+            'tornadose_trace_stage_seconds_count{store="traced",stage="total"} 1'
+            in lines
+        )
+
+    @pytest.mark.gen_test
+    async def test_websocket(self, http_client, http_server, base_url, store):
+        url = base_url.replace("http://", "ws://") + "/socket"
+        conn = await websocket_connect(url, connect_timeout=1)
+        while not store.subscribers:
+            await asyncio.sleep(0.01)
+        await store.submit("test")
+        assert json.loads(await conn.read_message()) == {"data": "test"}
+        await asyncio.sleep(0.01)
+        (entry,) = store.tracer.slowest
+        assert entry["subscriber"] == "WebSocketSubscriber"
+        conn.close()
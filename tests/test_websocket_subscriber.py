@@ -1,5 +1,6 @@
 """Tests for the WebSocketSubscriber handlers."""
 
+import asyncio
 import json
 
 import pytest
@@ -8,6 +9,8 @@ from tornado.web import Application
 from tornado.websocket import websocket_connect
 
 from tornadose.handlers import WebSocketSubscriber
+from tornadose.queues import DISCONNECT
+from tornadose.stores import TopicStore
 
 
 @pytest.fixture
@@ -27,3 +30,84 @@ class TestWebSocketSubscriber:
         msg = json.loads(msg)
         assert msg["data"] == "test"
         conn.close()
+
+
+class TestSlowSubscriber:
+    @pytest.fixture
+    def app(self, dummy_store) -> Application:
+        options = dict(store=dummy_store, max_queue_size=1, overflow_policy=DISCONNECT)
+        return Application([(r"/", WebSocketSubscriber, options)])
+
+    @pytest.mark.gen_test
+    async def test_disconnect(self, http_server, base_url, dummy_store):
+        url = base_url.replace("http://", "ws://")
+        conn = await websocket_connect(url, connect_timeout=1)
+        handler = next(iter(dummy_store.subscribers))
+        handler.submit("first")
+        handler.submit("second")
+        assert await conn.read_message() is None
+        assert conn.close_code == 1013
+        assert dummy_store.overflows[DISCONNECT] == 1
+        assert not dummy_store.subscribers
+
+
+def publish_loops(store):
+    return [
+        task
+        for task in asyncio.all_tasks()
+        if getattr(task.get_coro(), "__qualname__", "").endswith("_publish_loop")
+        and task.get_coro().cr_frame.f_locals["self"].store is store
+    ]
+
+
+class TestClose:
+    @pytest.mark.gen_test
+    async def test_publish_loop_ends(self, http_server, base_url, dummy_store):
+        url = base_url.replace("http://", "ws://")
+        connections = [await websocket_connect(url) for _ in range(5)]
+        assert len(publish_loops(dummy_store)) == 5
+        for handler in list(dummy_store.subscribers):
+            handler.submit("data")
+        for conn in connections:
+            assert json.loads(await conn.read_message()) == {"data": "data"}
+            conn.close()
+        while dummy_store.subscribers:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        assert publish_loops(dummy_store) == []
+
+
+class TestReconnect:
+    @pytest.mark.gen_test
+    async def test_reconnect(self, http_server, base_url, dummy_store):
+        url = base_url.replace("http://", "ws://")
+        conn = await websocket_connect(url, connect_timeout=1)
+        await dummy_store.drain(window=0.1)
+        assert await conn.read_message() is None
+        assert conn.close_code == 1012
+        assert 0 <= int(conn.close_reason.split("=")[1]) <= 10
+        assert not dummy_store.subscribers
+
+
+class TestTopics:
+    @pytest.fixture
+    def store(self, io_loop):
+        return TopicStore()
+
+    @pytest.fixture
+    def app(self, store) -> Application:
+        handlers = [(r"/(?P<topic>.+)", WebSocketSubscriber, dict(store=store))]
+        return Application(handlers)
+
+    @pytest.mark.gen_test
+    async def test_topic(self, http_server, base_url, store):
+        url = base_url.replace("http://", "ws://")
+        aapl = await websocket_connect(url + "/AAPL", connect_timeout=1)
+        prices = await websocket_connect(url + "/*", connect_timeout=1)
+        await store.submit("MSFT", 1)
+        await store.submit("AAPL", 2)
+        assert json.loads(await aapl.read_message()) == {"data": 2, "topic": "AAPL"}
+        assert json.loads(await prices.read_message())["topic"] == "MSFT"
+        assert json.loads(await prices.read_message())["topic"] == "AAPL"
+        aapl.close()
+        prices.close()
@@ -0,0 +1,457 @@
+"""Stores which broadcast messages between several tornadose processes."""
+
+from collections import deque
+import errno
+from inspect import isawaitable
+import json
+import logging
+import os
+import random
+import socket
+import struct
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets, bind_unix_socket
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+
+from .messages import BULK, Message
+from .stores import QueueStore
+
+logger = logging.getLogger("tornadose.cluster")
+
+#: Number of bytes to read from a peer at once.
+READ_CHUNK_SIZE = 65536
+
+# Frame length (excluding itself), origin node, sequence number, data
+# kind (message priority in the high nibble) and topic length. The
+# topic and data follow the header.
+_header = struct.Struct("!IQQBH")
+_no_topic = 0xFFFF
+
+# Handshake sent by both ends of a TCP link before any frames: the
+# sender's node id and the last sequence number it received from the
+# other end.
+_hello = struct.Struct("!QQ")
+
+
+def encode_frame(origin, seq, message):
+    """Encode a message for sending to peers.
+
+    :param int origin: id of the node the message was submitted on
+    :param int seq: sequence number of the message on its origin node
+    :param message: a :class:`tornadose.messages.Message`
+
+    """
+    data = message.data
+    if isinstance(data, bytes):
+        kind, payload = 0, data
+    elif isinstance(data, str):
+        kind, payload = 1, data.encode("utf-8")
+    else:
+        kind, payload = 2, json.dumps(data).encode("utf-8")
+    if message.topic is None:
+        topic, topic_length = b"", _no_topic
+    else:
+        topic = message.topic.encode("utf-8")
+        topic_length = len(topic)
+    kind |= message.priority << 4
+    length = _header.size - 4 + len(topic) + len(payload)
+    header = _header.pack(length, origin, seq, kind, topic_length)
+    return b"".join((header, topic, payload))
+
+
+def decode_frame(buffer, pos=0):
+    """Decode the frame starting at ``pos`` of ``buffer``.
+
+    :returns: ``(end, origin, seq, message)`` where ``end`` is the
+        position following the frame, or ``None`` if the buffer does not
+        hold the complete frame
+
+    """
+    if len(buffer) - pos < _header.size:
+        return None
+    length, origin, seq, kind, topic_length = _header.unpack_from(buffer, pos)
+    end = pos + 4 + length
+    if len(buffer) < end:
+        return None
+    start = pos + _header.size
+    if topic_length == _no_topic:
+        topic = None
+    else:
+        topic_end = start + topic_length
+        topic = bytes(buffer[start:topic_end]).decode("utf-8")
+        start = topic_end
+    data = bytes(buffer[start:end])
+    priority = kind >> 4
+    kind &= 0x0F
+    if kind == 1:
+        data = data.decode("utf-8")
+    elif kind == 2:
+        data = json.loads(data.decode("utf-8"))
+    return end, origin, seq, Message(data, topic=topic, priority=priority)
+
+
+def frame_header(buffer, pos=0):
+    """Return ``(end, origin, seq)`` for the frame starting at ``pos``
+    without decoding it, or ``None`` if the frame is incomplete.
+
+    """
+    if len(buffer) - pos < _header.size:
+        return None
+    length, origin, seq, _, _ = _header.unpack_from(buffer, pos)
+    end = pos + 4 + length
+    if len(buffer) < end:
+        return None
+    return end, origin, seq
+
+
+class FrameParser(object):
+    """Incremental parser for frames created by :func:`encode_frame`.
+
+    :meth:`frames` returns a list of ``(origin, seq, message)`` tuples
+    for all complete frames fed so far.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+
+    def frames(self):
+        buffer = self._buffer
+        frames = []
+        pos = 0
+        while True:
+            frame = decode_frame(buffer, pos)
+            if frame is None:
+                break
+            pos = frame[0]
+            frames.append(frame[1:])
+        if pos:
+            del buffer[:pos]
+        return frames
+
+
+class _PeerServer(TCPServer):
+    """Accepts connections from peers and feeds their frames to a store."""
+
+    def __init__(self, store):
+        super(_PeerServer, self).__init__()
+        self.store = store
+        self.streams = set()
+
+    def stop(self):
+        super(_PeerServer, self).stop()
+        for stream in list(self.streams):
+            stream.close()
+
+    async def handle_stream(self, stream, address):
+        parser = FrameParser()
+        self.streams.add(stream)
+        try:
+            connected = self.store.peer_connected(stream)
+            if isawaitable(connected):
+                await connected
+            while True:
+                parser.feed(await stream.read_bytes(READ_CHUNK_SIZE, partial=True))
+                for origin, seq, message in parser.frames():
+                    self.store.receive(origin, seq, message)
+        except StreamClosedError:
+            pass
+        except Exception:
+            logger.exception("Error reading from peer")
+            stream.close()
+        finally:
+            self.streams.discard(stream)
+
+
+class ClusterStore(QueueStore):
+    """Base class for stores which forward messages to peer processes.
+
+    Messages submitted to any node are published to its own subscribers
+    and forwarded once to every connected peer, which publishes them to
+    its subscribers in turn. Frames submitted during one iteration of
+    the IOLoop are written to each peer together.
+
+    Subclasses are responsible for accepting peer connections with
+    :attr:`server` and for opening outgoing connections with
+    :meth:`add_link`.
+
+    Every frame carries the random id of the node it was submitted on
+    and a sequence number. Frames from this node or which were already
+    received from their origin are dropped and counted in
+    :attr:`duplicates`, so frames may safely be sent more than once.
+
+    Message ids (see :class:`tornadose.stores.BaseStore`) are assigned
+    independently by each process.
+
+    """
+
+    def initialize(self, **kwargs):
+        self.node_id = random.getrandbits(64)
+        self.links = {}
+        self.server = _PeerServer(self)
+        self.duplicates = 0
+        self._seq = 0
+        self._seen = {}
+        self._outgoing = []
+        super(ClusterStore, self).initialize(**kwargs)
+
+    async def submit(self, message, priority=BULK):
+        """Publish a message to subscribers of this node and all peers."""
+        await super(ClusterStore, self).submit(message, priority)
+
+    def _put(self, message):
+        self._seq += 1
+        self.forward(encode_frame(self.node_id, self._seq, message))
+        super(ClusterStore, self)._put(message)
+
+    def forward(self, frame):
+        """Queue an encoded frame for sending to all peers."""
+        if not self._outgoing:
+            IOLoop.current().add_callback(self._flush)
+        self._outgoing.append(frame)
+
+    def _flush(self):
+        data = b"".join(self._outgoing)
+        self._outgoing = []
+        for key, stream in list(self.links.items()):
+            try:
+                stream.write(data)
+            except StreamClosedError:
+                self.remove_link(key)
+
+    def receive(self, origin, seq, message):
+        """Handle a message received from a peer."""
+        if origin == self.node_id or seq <= self._seen.get(origin, 0):
+            self.duplicates += 1
+            return
+        self._seen[origin] = seq
+        self.messages.put_nowait(message)
+
+    def peer_connected(self, stream):
+        """Called when a peer connects to this node, before reading any
+        frames from ``stream``. May be a coroutine.
+
+        """
+
+    def add_link(self, key, stream):
+        """Start forwarding messages to a peer over ``stream``."""
+        self.links[key] = stream
+        stream.set_close_callback(lambda: self.remove_link(key, stream))
+
+    def remove_link(self, key, stream=None):
+        """Stop forwarding messages to a peer."""
+        if stream is None or self.links.get(key) is stream:
+            stream = self.links.pop(key, None)
+            if stream is not None:
+                logger.debug("Lost link to peer %s", key)
+                stream.close()
+
+    def shutdown(self):
+        """Stop accepting peer connections and close all links and
+        connections from peers.
+
+        """
+        self.server.stop()
+        for key in list(self.links):
+            self.remove_link(key)
+
+
+class LocalClusterStore(ClusterStore):
+    """Broadcast messages between worker processes on the same host.
+
+    This is intended for running several Tornado processes behind
+    ``SO_REUSEPORT`` without an external broker. Every process creates a
+    store with the same ``path``, a directory in which each store binds
+    a Unix domain socket. Stores find each other by scanning the
+    directory every :attr:`discovery_interval` seconds and whenever a
+    new peer connects. Messages can be submitted in any process and
+    every process fans them out to its own clients.
+
+    :param str path: directory shared by all processes
+
+    """
+
+    #: Seconds between scans for new peers.
+    discovery_interval = 1.0
+
+    def initialize(self, path, **kwargs):
+        super(LocalClusterStore, self).initialize(**kwargs)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        name = "{}-{:016x}.sock".format(os.getpid(), self.node_id)
+        self.address = os.path.join(path, name)
+        self.server.add_socket(bind_unix_socket(self.address))
+        self._connecting = set()
+        self._discovery = PeriodicCallback(
+            self.discover, self.discovery_interval * 1000
+        )
+        self._discovery.start()
+        IOLoop.current().add_callback(self.discover)
+
+    def peer_connected(self, stream):
+        IOLoop.current().add_callback(self.discover)
+
+    async def discover(self):
+        """Connect to any peers that are not yet linked."""
+        for name in os.listdir(self.path):
+            address = os.path.join(self.path, name)
+            if (
+                not name.endswith(".sock")
+                or address == self.address
+                or address in self.links
+                or address in self._connecting
+            ):
+                continue
+            self._connecting.add(address)
+            try:
+                await self._connect(address)
+            finally:
+                self._connecting.discard(address)
+
+    async def _connect(self, address):
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        try:
+            await stream.connect(address)
+        except StreamClosedError as e:
+            error = getattr(e.real_error, "errno", None)
+            if error in (errno.ECONNREFUSED, errno.ENOENT) and self._is_stale(address):
+                logger.debug("Removing stale socket %s", address)
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+            return
+        logger.debug("Linked to peer %s", address)
+        self.add_link(address, stream)
+
+    def _is_stale(self, address):
+        try:
+            pid = int(os.path.basename(address).split("-")[0])
+        except ValueError:
+            return False
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def shutdown(self):
+        """Stop discovering peers, close all links and remove the socket."""
+        self._discovery.stop()
+        super(LocalClusterStore, self).shutdown()
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+
+
+class TCPClusterStore(ClusterStore):
+    """Broadcast messages between nodes on different hosts over TCP.
+
+    Each node listens on ``port`` and connects to every address in
+    ``peers``, so every node must list all others. A node's own address
+    may be included, which lets all nodes share one list. Connections
+    are re-established after random delays starting at
+    :attr:`reconnect_delay` and doubling up to
+    :attr:`max_reconnect_delay` seconds.
+
+    The last :attr:`resend_size` forwarded frames are kept. When a link
+    is established, both ends exchange their node ids and the peer
+    reports the last sequence number it received from this node. If the
+    peer is the same process as before, the kept frames it missed during
+    the outage are sent again; a new or restarted peer only receives
+    messages submitted from then on.
+
+    :param int port: port to listen on (0 picks a free port, see
+        :attr:`port`)
+    :param peers: addresses of the other nodes as ``"host:port"``
+    :param str address: address to listen on (all interfaces by default)
+
+    """
+
+    #: Initial delay in seconds before reconnecting to a peer.
+    reconnect_delay = 0.1
+
+    #: Maximum delay in seconds between reconnection attempts.
+    max_reconnect_delay = 10.0
+
+    #: Number of recently forwarded frames sent again on reconnection.
+    resend_size = 1024
+
+    def initialize(self, port=0, peers=(), address=None, **kwargs):
+        super(TCPClusterStore, self).initialize(**kwargs)
+        sockets = bind_sockets(port, address)
+        self.port = sockets[0].getsockname()[1]
+        self.server.add_sockets(sockets)
+        self.peers = set()
+        self._recent = deque(maxlen=self.resend_size)
+        self._closed = False
+        for peer in peers:
+            self.add_peer(peer)
+
+    def add_peer(self, peer):
+        """Start forwarding messages to the node at ``"host:port"``."""
+        if peer not in self.peers:
+            self.peers.add(peer)
+            IOLoop.current().add_callback(self._maintain, peer)
+
+    def remove_peer(self, peer):
+        """Stop forwarding messages to a node."""
+        self.peers.discard(peer)
+        self.remove_link(peer)
+
+    async def peer_connected(self, stream):
+        node_id, _ = _hello.unpack(await stream.read_bytes(_hello.size))
+        stream.write(_hello.pack(self.node_id, self._seen.get(node_id, 0)))
+
+    async def _maintain(self, peer):
+        host, port = peer.rsplit(":", 1)
+        delay = self.reconnect_delay
+        peer_id = None
+        while not self._closed and peer in self.peers:
+            try:
+                stream = await TCPClient().connect(host, int(port))
+                stream.write(_hello.pack(self.node_id, 0))
+                node_id, seen = _hello.unpack(await stream.read_bytes(_hello.size))
+            except (StreamClosedError, OSError):
+                await gen.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(2 * delay, self.max_reconnect_delay)
+                continue
+            if self._closed or peer not in self.peers:
+                stream.close()
+                break
+            delay = self.reconnect_delay
+            stream.set_nodelay(True)
+            if node_id == peer_id:
+                missed = [frame for seq, frame in self._recent if seq > seen]
+                if missed:
+                    stream.write(b"".join(missed))
+            peer_id = node_id
+            logger.debug("Linked to peer %s", peer)
+            self.add_link(peer, stream)
+            try:
+                # Peers write nothing but the handshake to this connection
+                await stream.read_until_close()
+            except StreamClosedError:
+                pass
+            self.remove_link(peer, stream)
+
+    def _flush(self):
+        self._recent.extend((frame_header(frame)[2], frame) for frame in self._outgoing)
+        super(TCPClusterStore, self)._flush()
+
+    def shutdown(self):
+        """Stop reconnecting, close all links and stop listening."""
+        self._closed = True
+        super(TCPClusterStore, self).shutdown()
@@ -0,0 +1,124 @@
+"""Codecs for encoding messages sent to websocket clients.
+
+A codec turns the data and topic of a message into the payload of a
+websocket frame. Binary codecs are sent in binary frames. Every message
+is encoded at most once per codec regardless of the number of
+subscribers using it.
+
+Clients choose a codec when connecting, either by offering its
+:attr:`Codec.name` as a websocket subprotocol or with a ``codec`` query
+argument. Additional codecs can be made available with
+:func:`register`.
+
+"""
+
+from tornado.escape import json_encode, to_unicode, utf8
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#: Registered codecs by name.
+codecs = {}
+
+
+class Codec(object):
+    """Base class for codecs."""
+
+    #: Name used by clients to select the codec.
+    name = None
+
+    #: Whether payloads are sent in binary rather than text frames.
+    binary = False
+
+    def encode(self, data, topic=None):
+        """Return the encoded payload as ``bytes``. This method must be
+        implemented by child classes.
+
+        """
+        raise NotImplementedError("encode must be implemented!")
+
+
+class JSONCodec(Codec):
+    """Sends a JSON object with the data under the key ``data`` and the
+    topic, if any, under the key ``topic``. Bytes are decoded as UTF-8.
+    This is the default codec.
+
+    """
+
+    name = "json"
+
+    def encode(self, data, topic=None):
+        if isinstance(data, bytes):
+            data = to_unicode(data)
+        payload = dict(data=data)
+        if topic is not None:
+            payload["topic"] = topic
+        return utf8(json_encode(payload))
+
+
+class RawCodec(Codec):
+    """Sends the data unchanged in binary frames. Strings are encoded as
+    UTF-8; other types are not supported.
+
+    """
+
+    name = "raw"
+    binary = True
+
+    def encode(self, data, topic=None):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return bytes(data)
+        if isinstance(data, str):
+            return data.encode("utf-8")
+        raise TypeError("Cannot send {} as raw data".format(type(data).__name__))
+
+
+class MsgpackCodec(Codec):
+    """Sends a MessagePack map with the same keys as :class:`JSONCodec`.
+    Numbers and bytes are packed natively.
+
+    :raises RuntimeError: when the msgpack module is not installed
+
+    """
+
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("The msgpack module is required to use MsgpackCodec")
+
+    def encode(self, data, topic=None):
+        payload = dict(data=data)
+        if topic is not None:
+            payload["topic"] = topic
+        return msgpack.packb(payload, use_bin_type=True)
+
+
+def register(codec):
+    """Make ``codec`` available to clients under its name."""
+    codecs[codec.name] = codec
+    return codec
+
+
+def get_codec(codec):
+    """Return a codec given either a registered name or a
+    :class:`Codec` instance.
+
+    :raises ValueError: when no codec with the given name is registered
+
+    """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return codecs[codec]
+    except KeyError:
+        raise ValueError("Unknown codec {!r}".format(codec))
+
+
+JSON = register(JSONCodec())
+RAW = register(RawCodec())
+if msgpack is not None:
+    register(MsgpackCodec())
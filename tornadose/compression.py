@@ -0,0 +1,74 @@
+"""Compression of messages shared between connections.
+
+Compressing the same message separately for every subscriber is
+usually the largest cost of compressed streams. Instead, each message
+is compressed on its own, without any history from earlier messages,
+and flushed to a byte boundary. The result is cached on the
+:class:`tornadose.messages.Message` and can be spliced into the deflate
+stream of any connection:
+
+* server-sent events are sent as a gzip stream made of these blocks;
+  only the gzip checksum is computed per connection;
+* websocket messages use ``permessage-deflate`` with
+  ``server_no_context_takeover``, under which every message is
+  compressed independently anyway.
+
+"""
+
+import struct
+import zlib
+
+#: zlib compression level used for shared payloads.
+COMPRESSION_LEVEL = 6
+
+#: Header of a gzip stream without file name or modification time.
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# Marker ending a sync flush (an empty stored block).
+SYNC_MARKER = b"\x00\x00\xff\xff"
+
+# An empty final block using fixed Huffman codes.
+_FINAL_BLOCK = b"\x03\x00"
+
+
+def deflate(data, level=COMPRESSION_LEVEL):
+    """Compress ``data`` as raw deflate blocks which do not refer to any
+    earlier data and end with a sync flush. Such blocks can be
+    concatenated in any order to form a valid deflate stream.
+
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class GzipStream(object):
+    """The per-connection state of a gzip stream built from shared
+    blocks created by :func:`deflate`.
+
+    """
+
+    def __init__(self):
+        self.crc = 0
+        self.size = 0
+        self.started = False
+
+    def block(self, data, compressed):
+        """Return the bytes to send for ``data`` given its shared
+        compressed form. The gzip header is prepended to the first
+        block.
+
+        """
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if not self.started:
+            self.started = True
+            return GZIP_HEADER + compressed
+        return compressed
+
+    def trailer(self):
+        """Return the bytes ending the stream."""
+        trailer = _FINAL_BLOCK + struct.pack("<II", self.crc, self.size & 0xFFFFFFFF)
+        if not self.started:
+            self.started = True
+            return GZIP_HEADER + trailer
+        return trailer
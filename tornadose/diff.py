@@ -0,0 +1,93 @@
+"""Structural diffs of JSON-like data in the JSON Patch format.
+
+Only the ``add``, ``remove`` and ``replace`` operations of `RFC 6902`__
+are produced, so patches can be applied by any JSON Patch library or
+with :func:`apply_patch`.
+
+__ https://tools.ietf.org/html/rfc6902
+
+"""
+
+import copy
+
+
+def _escape(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def diff(old, new):
+    """Return a list of JSON Patch operations turning ``old`` into
+    ``new``. Unchanged values which are the same object in both are not
+    compared, so reusing unchanged parts of a document keeps diffing
+    cheap.
+
+    """
+    ops = []
+    _diff(old, new, "", ops)
+    return ops
+
+
+def _diff(old, new, path, ops):
+    if old is new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append(dict(op="remove", path=path + "/" + _escape(key)))
+        for key, value in new.items():
+            child = path + "/" + _escape(key)
+            if key in old:
+                _diff(old[key], value, child, ops)
+            else:
+                ops.append(dict(op="add", path=child, value=value))
+    elif isinstance(old, list) and isinstance(new, list):
+        changes = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            _diff(old[i], new[i], "{}/{}".format(path, i), changes)
+        for i in reversed(range(common, len(old))):
+            changes.append(dict(op="remove", path="{}/{}".format(path, i)))
+        for i in range(common, len(new)):
+            changes.append(dict(op="add", path="{}/{}".format(path, i), value=new[i]))
+        if len(changes) > len(new):
+            # e.g. an item inserted at the front: just send the new list
+            ops.append(dict(op="replace", path=path, value=new))
+        else:
+            ops.extend(changes)
+    elif type(old) is not type(new) or old != new:
+        ops.append(dict(op="replace", path=path, value=new))
+
+
+def apply_patch(document, patch):
+    """Return a copy of ``document`` with the operations of ``patch``
+    applied. Only ``add``, ``remove`` and ``replace`` are supported.
+
+    """
+    document = copy.deepcopy(document)
+    for op in patch:
+        if op["path"] == "":
+            if op["op"] == "remove":
+                document = None
+            else:
+                document = copy.deepcopy(op["value"])
+            continue
+        tokens = [_unescape(token) for token in op["path"].split("/")[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+        key = tokens[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == "-" else int(key)
+        if op["op"] == "remove":
+            del parent[key]
+        elif op["op"] == "add" and isinstance(parent, list):
+            parent.insert(key, copy.deepcopy(op["value"]))
+        elif op["op"] in ("add", "replace"):
+            parent[key] = copy.deepcopy(op["value"])
+        else:
+            raise ValueError("Unsupported operation {!r}".format(op["op"]))
+    return document
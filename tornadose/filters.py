@@ -0,0 +1,249 @@
+"""Server-side filtering of messages for individual subscribers.
+
+Subscribers can restrict the messages they receive with one or more
+``filter`` query arguments, all of which must match::
+
+    /stream?filter=symbol=AAPL|MSFT&filter=price>=100
+
+Each expression compares a field of the message data, which must be a
+dictionary, with a value. Nested fields are separated by dots.
+Supported operators are ``=`` (with alternatives separated by ``|``),
+``<``, ``<=``, ``>`` and ``>=``. Values which look like numbers,
+``true``, ``false`` or ``null`` are compared as such.
+
+Stores keep filtered subscribers in a :class:`FilterIndex` keyed by one
+condition of each filter, so a message is only checked against the
+subscribers whose indexed condition it satisfies.
+
+"""
+
+from bisect import bisect_right
+import re
+
+_expression = re.compile(r"^\s*([\w.\-]+)\s*(<=|>=|=|<|>)(.*)$")
+_constants = {"true": True, "false": False, "null": None}
+_missing = object()
+
+
+def _parse_value(text):
+    text = text.strip()
+    if text in _constants:
+        return _constants[text]
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def lookup(data, field):
+    """Return the value of a dotted ``field`` of ``data`` or a sentinel
+    if it does not exist.
+
+    """
+    for key in field.split("."):
+        if not isinstance(data, dict):
+            return _missing
+        data = data.get(key, _missing)
+    return data
+
+
+class Condition(object):
+    """A single comparison of a field with one or more values."""
+
+    __slots__ = ("field", "op", "values")
+
+    def __init__(self, field, op, values):
+        self.field = field
+        self.op = op
+        self.values = values
+
+    def __repr__(self):
+        return "<Condition {} {} {!r}>".format(self.field, self.op, self.values)
+
+    @property
+    def bound(self):
+        """The value of a comparison."""
+        return self.values[0]
+
+    def matches(self, data):
+        value = lookup(data, self.field)
+        if value is _missing:
+            return False
+        if self.op == "=":
+            try:
+                return value in self.values
+            except TypeError:
+                return False
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        if self.op == "<":
+            return value < self.bound
+        elif self.op == "<=":
+            return value <= self.bound
+        elif self.op == ">":
+            return value > self.bound
+        return value >= self.bound
+
+
+class Filter(object):
+    """A conjunction of :class:`Condition` instances."""
+
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+
+    @classmethod
+    def parse(cls, expressions):
+        """Create a filter from a list of expressions.
+
+        :raises ValueError: if an expression is invalid
+
+        """
+        conditions = []
+        for expression in expressions:
+            match = _expression.match(expression)
+            if match is None:
+                raise ValueError("Invalid filter {!r}".format(expression))
+            field, op, value = match.groups()
+            if op == "=":
+                values = frozenset(_parse_value(v) for v in value.split("|"))
+            else:
+                values = (_parse_value(value),)
+                if isinstance(values[0], bool) or not isinstance(
+                    values[0], (int, float)
+                ):
+                    raise ValueError("{!r} requires a number".format(expression))
+            conditions.append(Condition(field, op, values))
+        return cls(conditions)
+
+    def matches(self, data):
+        return all(condition.matches(data) for condition in self.conditions)
+
+
+class FilterIndex(object):
+    """Subscribers indexed by their filters.
+
+    Each subscriber is indexed by one condition of its filter: the
+    first equality if there is one, or else the first lower or upper
+    bound. Matching a message looks up the value of every indexed field
+    once and only evaluates the filters of subscribers whose indexed
+    condition holds.
+
+    """
+
+    def __init__(self):
+        self._filters = {}
+        # field -> value -> subscribers
+        self._equal = {}
+        # field -> (sorted bounds, subscribers) for lower and upper bounds
+        self._lower = {}
+        self._upper = {}
+
+    def __len__(self):
+        return len(self._filters)
+
+    def __contains__(self, subscriber):
+        return subscriber in self._filters
+
+    def filter_of(self, subscriber):
+        return self._filters.get(subscriber)
+
+    def accepts(self, subscriber, data):
+        """Return whether ``subscriber`` would receive ``data``."""
+        filter = self._filters.get(subscriber)
+        return filter is None or filter.matches(data)
+
+    def add(self, subscriber, filter):
+        """Index ``subscriber`` by ``filter``, replacing any previous
+        filter.
+
+        """
+        self.discard(subscriber)
+        anchor = self._anchor(filter)
+        self._filters[subscriber] = filter
+        if anchor is None:
+            return
+        if anchor.op == "=":
+            values = self._equal.setdefault(anchor.field, {})
+            for value in anchor.values:
+                values.setdefault(value, set()).add(subscriber)
+        else:
+            bounds, subscribers = self._ranges(anchor).setdefault(
+                anchor.field, ([], [])
+            )
+            key = self._key(anchor)
+            index = bisect_right(bounds, key)
+            bounds.insert(index, key)
+            subscribers.insert(index, subscriber)
+
+    def discard(self, subscriber):
+        filter = self._filters.pop(subscriber, None)
+        if filter is None:
+            return
+        anchor = self._anchor(filter)
+        if anchor is None:
+            return
+        if anchor.op == "=":
+            values = self._equal[anchor.field]
+            for value in anchor.values:
+                subscribers = values[value]
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del values[value]
+            if not values:
+                del self._equal[anchor.field]
+        else:
+            ranges = self._ranges(anchor)
+            bounds, subscribers = ranges[anchor.field]
+            index = subscribers.index(subscriber)
+            del bounds[index]
+            del subscribers[index]
+            if not bounds:
+                del ranges[anchor.field]
+
+    def _anchor(self, filter):
+        for condition in filter.conditions:
+            if condition.op == "=":
+                return condition
+        return filter.conditions[0] if filter.conditions else None
+
+    def _ranges(self, condition):
+        return self._lower if condition.op in (">", ">=") else self._upper
+
+    def _key(self, condition):
+        # Upper bounds are stored negated so both indexes hold the
+        # candidates for a value at the start of the list.
+        if condition.op in (">", ">="):
+            return condition.bound
+        return -condition.bound
+
+    def match(self, data):
+        """Return a list of the subscribers whose filters match
+        ``data``.
+
+        """
+        matches = []
+        candidates = []
+        for field, values in self._equal.items():
+            value = lookup(data, field)
+            if value is _missing:
+                continue
+            try:
+                subscribers = values.get(value)
+            except TypeError:
+                continue
+            if subscribers:
+                candidates.append(subscribers)
+        for ranges, sign in ((self._lower, 1), (self._upper, -1)):
+            for field, (bounds, subscribers) in ranges.items():
+                value = lookup(data, field)
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                candidates.append(subscribers[: bisect_right(bounds, sign * value)])
+        filters = self._filters
+        for subscribers in candidates:
+            for subscriber in subscribers:
+                if filters[subscriber].matches(data):
+                    matches.append(subscriber)
+        return matches
@@ -1,17 +1,36 @@
 """Custom request handlers for pushing data to connected clients."""
 
-from asyncio import Queue
+from asyncio import QueueFull
+from itertools import islice
 import logging
+import random
+import socket
+from time import perf_counter
+import zlib
 
-from tornado.web import RequestHandler
-from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from tornado.ioloop import IOLoop
+from tornado.web import HTTPError, RequestHandler
+from tornado.websocket import (
+    WebSocketClosedError,
+    WebSocketHandler,
+    WebSocketProtocol13,
+)
 from tornado.iostream import StreamClosedError
 from tornado.log import access_log
 
 from . import stores
+from .codecs import codecs as registered_codecs, get_codec
+from .compression import GzipStream, deflate
+from .filters import Filter
+from .messages import BULK, Message
+from .queues import ConflatingQueue, DISCONNECT, QueueClosed, SubscriberQueue
+from .scheduler import Scheduler
 
 logger = logging.getLogger("tornadose.handlers")
 
+_PING = b": ping\n\n"
+_PING_DEFLATE = deflate(_PING)
+
 
 class BaseHandler(RequestHandler):
     """Base handler for subscribers. To be compatible with data stores
@@ -20,21 +39,189 @@ class BaseHandler(RequestHandler):
 
     """
 
-    def initialize(self, store):
+    def initialize(
+        self,
+        store,
+        max_queue_size=None,
+        overflow_policy=None,
+        topic=None,
+        heartbeat=None,
+        max_rate=None,
+    ):
         """Common initialization of handlers happens here. If additional
         initialization is required, this method must either be called with
         ``super`` or the child class must assign the ``store`` attribute and
         register itself with the store.
 
+        Messages waiting to be published are kept in a
+        :class:`tornadose.queues.SubscriberQueue`. Its ``max_queue_size``
+        and ``overflow_policy`` default to those of the store. ``topic``
+        is the topic to subscribe to when none is given in the URL.
+        Subscribers are pinged by the
+        :class:`tornadose.heartbeat.Heartbeat` service ``heartbeat``, if
+        given, and evicted when they stop responding. Messages are
+        filtered by :meth:`get_filter`.
+
+        With a ``max_rate``, at most that many messages per second are
+        sent (see :meth:`get_max_rate`). Messages arriving faster are
+        conflated in a :class:`tornadose.queues.ConflatingQueue` so that
+        only the latest one per topic is sent.
+
         """
         assert isinstance(store, stores.BaseStore)
-        self.messages = Queue()
+        if max_queue_size is None:
+            max_queue_size = store.max_queue_size
+        if overflow_policy is None:
+            overflow_policy = store.overflow_policy
+        self.last_submitted = 0
+        self.default_topic = topic
+        self.topic = None
+        self.heartbeat_service = heartbeat
+        self.argument_error = None
+        try:
+            self.filter = self.get_filter()
+            self.max_rate = self.get_max_rate(max_rate)
+        except ValueError as error:
+            self.filter = None
+            self.max_rate = None
+            self.argument_error = error
+        if self.max_rate:
+            self.messages = ConflatingQueue(max_queue_size, overflow_policy)
+        else:
+            self.messages = SubscriberQueue(max_queue_size, overflow_policy)
         self.store = store
         self.store.register(self)
 
-    async def submit(self, message):
-        """Submit a new message to be published."""
-        await self.messages.put(message)
+    def prepare(self):
+        """Reject requests with invalid filters or rates."""
+        if self.argument_error is not None:
+            self.unsubscribe()
+            raise HTTPError(400, str(self.argument_error))
+
+    def get_max_rate(self, max_rate):
+        """Return the maximum number of messages per second to send or
+        ``None`` for no limit. Clients can ask for a lower rate than the
+        configured ``max_rate`` with the ``max_rate`` query argument.
+
+        :raises ValueError: if the requested rate is not a positive number
+
+        """
+        requested = self.get_query_argument("max_rate", None)
+        if requested is None:
+            return max_rate
+        try:
+            requested = float(requested)
+        except ValueError:
+            requested = 0
+        if not requested > 0:
+            raise ValueError("max_rate must be a positive number")
+        return requested if max_rate is None else min(requested, max_rate)
+
+    async def throttle(self):
+        """Wait until the next message may be sent under
+        :attr:`max_rate`. Waiting is driven by the
+        :class:`tornadose.scheduler.Scheduler` shared by all handlers.
+
+        """
+        if self.max_rate:
+            await Scheduler.current().wait(1.0 / self.max_rate)
+
+    def get_filter(self):
+        """Return the :class:`tornadose.filters.Filter` restricting the
+        messages sent to this subscriber or ``None`` to receive all
+        messages. By default it is built from the ``filter`` query
+        arguments (see :mod:`tornadose.filters`).
+
+        :raises ValueError: if a filter expression is invalid
+
+        """
+        expressions = self.get_query_arguments("filter")
+        if not expressions:
+            return None
+        return Filter.parse(expressions)
+
+    def get_topic(self, *args, **kwargs):
+        """Return the topic to subscribe to given the arguments captured
+        from the URL. This is used by topic-aware stores such as
+        :class:`tornadose.stores.TopicStore`. By default the ``topic``
+        named group is used if present, otherwise the first positional
+        argument or the ``topic`` the handler was initialized with.
+
+        """
+        if "topic" in kwargs:
+            return kwargs["topic"]
+        if args:
+            return args[0]
+        return self.default_topic
+
+    def subscribe(self, *args, **kwargs):
+        """Register with the store under the topic given by the URL
+        arguments.
+
+        """
+        self.topic = self.get_topic(*args, **kwargs)
+        self.store.register(self)
+        if self.heartbeat_service is not None:
+            self.heartbeat_service.add(self)
+
+    def unsubscribe(self):
+        """Deregister from the store and stop receiving heartbeats."""
+        self.store.deregister(self)
+        if self.heartbeat_service is not None:
+            self.heartbeat_service.discard(self)
+
+    def heartbeat(self, now):
+        """Ping the client. This is called once per interval by the
+        heartbeat service; implementations should call :meth:`evict` if
+        the previous ping was not answered.
+
+        :param float now: the current IOLoop time
+
+        """
+
+    def evict(self):
+        """Drop a subscriber which stopped responding to heartbeats."""
+        logger.info("Evicting unresponsive subscriber %r", self)
+        self.store.metrics.evicted += 1
+        self.unsubscribe()
+        self.messages.close()
+
+    def reconnect(self, delay):
+        """Stop the subscription, discarding any queued messages, and
+        ask the client to reconnect after ``delay`` seconds. This is
+        used by :meth:`tornadose.stores.BaseStore.drain`.
+
+        """
+        self.unsubscribe()
+        self.messages.close()
+
+    def submit(self, message):
+        """Submit a new message to be published. Stores should pass
+        :class:`tornadose.messages.Message` instances; any other object
+        is wrapped in one.
+
+        This never blocks. If the queue is full, its overflow policy is
+        applied; with the ``disconnect`` policy the queue is closed and
+        the subscriber is dropped once it tries to read the next message.
+        A message with an id not greater than that of the previously
+        submitted one is ignored.
+
+        """
+        if not isinstance(message, Message):
+            message = Message(message)
+        elif message.id is not None:
+            if message.id <= self.last_submitted:
+                return
+            self.last_submitted = message.id
+            if message.trace:
+                message.trace.queued[self] = perf_counter()
+        try:
+            policy = self.messages.put_nowait(message)
+        except QueueFull:
+            policy = DISCONNECT
+            logger.info("Disconnecting slow subscriber %r", self)
+        if policy is not None:
+            self.store.overflows[policy] += 1
 
     def publish(self):
         """Push a message to the subscriber. This method must be
@@ -56,72 +243,449 @@ class EventSource(BaseHandler):
     * The publish/subscribe pattern is better suited to some applications
       than the full duplex model of websockets.
 
+    Events include the id the store assigned to the message. When a
+    client reconnects with a ``Last-Event-ID`` header, the messages it
+    missed are replayed from the store's history before any new ones
+    (see :meth:`tornadose.stores.BaseStore.replay`).
+
+    With a heartbeat service, a comment line is sent as a ping whenever
+    nothing is being flushed. A client is evicted if a flush, of data or
+    of the previous ping, has been pending for a whole heartbeat
+    interval. Where supported,
+    ``TCP_USER_TIMEOUT`` is set to twice the heartbeat interval so that
+    the kernel gives up on connections which do not acknowledge the
+    pings.
+
+    With ``compress`` enabled, clients accepting gzip are sent a gzip
+    stream. Every message is compressed only once per broadcast and the
+    compressed bytes are shared by all subscribers (see
+    :mod:`tornadose.compression`).
+
+    A ``retry`` delay in seconds, plus a random share of
+    ``retry_jitter`` seconds chosen per client, is sent when a client
+    connects so that clients losing their connection at the same time
+    do not all reconnect at once.
+
+    By default every message is written and flushed on its own. Setting
+    ``batch_size`` enables batching: all queued messages, up to
+    ``batch_size``, are written together and flushed once. With a
+    ``batch_delay`` (in seconds) the handler also waits up to that long
+    for a batch to fill, trading a little latency for fewer writes.
+
     __ https://developer.mozilla.org/en-US/docs/Web/API/EventSource
     __ http://curl.haxx.se/
     __ https://github.com/jkbrzt/httpie
 
     """
 
-    def initialize(self, store):
-        super(EventSource, self).initialize(store)
+    #: Maximum number of replayed messages written before flushing.
+    replay_batch_size = 256
+
+    #: Reconnection delay in seconds sent to clients (``None`` leaves
+    #: the browser default).
+    retry = None
+
+    #: Maximum random delay in seconds added to :attr:`retry`.
+    retry_jitter = 0.0
+
+    def initialize(
+        self,
+        store,
+        batch_size=1,
+        batch_delay=0,
+        compress=False,
+        retry=None,
+        retry_jitter=None,
+        **kwargs
+    ):
+        super(EventSource, self).initialize(store, **kwargs)
+        if retry is not None:
+            self.retry = retry
+        if retry_jitter is not None:
+            self.retry_jitter = retry_jitter
         self.finished = False
+        self.last_id = None
+        self._flushing = None
+        self._flush_started = None
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
         self.set_header("content-type", "text/event-stream")
         self.set_header("cache-control", "no-cache")
+        self.gzip = None
+        if compress:
+            self.set_header("vary", "Accept-Encoding")
+            if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+                self.set_header("content-encoding", "gzip")
+                self.gzip = GzipStream()
 
     def prepare(self):
         """Log access."""
+        super(EventSource, self).prepare()
         request_time = 1000.0 * self.request.request_time()
         access_log.info(
             "%d %s %.2fms", self.get_status(), self._request_summary(), request_time
         )
 
+    def get_last_event_id(self):
+        """Return the ``Last-Event-ID`` sent by a reconnecting client or
+        ``None``.
+
+        """
+        try:
+            return int(self.request.headers["Last-Event-ID"])
+        except (KeyError, ValueError):
+            return None
+
+    def write_event(self, message):
+        """Write a message to the output buffer without flushing. The
+        pre-encoded event is shared with all other subscribers of the
+        store. Messages the client has already seen are skipped.
+        Priority messages overtake older ones, so they are always
+        written and do not advance :attr:`last_id`.
+
+        :returns: whether the message was written
+
+        """
+        if message.id is not None and message.priority == BULK:
+            if self.last_id is not None and message.id <= self.last_id:
+                return False
+            self.last_id = message.id
+        if self.gzip is None:
+            self.write(message.sse)
+        else:
+            self.write(self.gzip.block(message.sse, message.sse_deflate))
+        return True
+
+    def subscribe(self, *args, **kwargs):
+        super(EventSource, self).subscribe(*args, **kwargs)
+        option = getattr(socket, "TCP_USER_TIMEOUT", None)
+        stream = getattr(self.request.connection, "stream", None)
+        if self.heartbeat_service is None or option is None or stream is None:
+            return
+        timeout = int(2000 * self.heartbeat_service.interval)
+        try:
+            stream.socket.setsockopt(socket.IPPROTO_TCP, option, timeout)
+        except (AttributeError, OSError):
+            pass
+
+    def heartbeat(self, now):
+        # The connection only keeps track of one flush, so pinging while
+        # another is pending would leave that one unresolved forever.
+        if self._flushing is not None:
+            if now - self._flush_started >= self.heartbeat_service.interval:
+                self.evict()
+            return
+        if self.gzip is None:
+            self.write(_PING)
+        else:
+            self.write(self.gzip.block(_PING, _PING_DEFLATE))
+        self._start_flush()
+
+    def _start_flush(self):
+        future = self._flushing = self.flush()
+        self._flush_started = IOLoop.current().time()
+        future.add_done_callback(self._flushed)
+        return future
+
+    def _flushed(self, future):
+        if self._flushing is future:
+            self._flushing = None
+        # Errors are handled by the caller or when the connection is closed.
+        future.exception()
+
+    async def _flush(self):
+        """Flush the output buffer once the flush in progress, if any,
+        is done.
+
+        """
+        if self._flushing is not None:
+            await self._flushing
+        await self._start_flush()
+
+    def evict(self):
+        super(EventSource, self).evict()
+        self.finished = True
+        self.request.connection.close()
+
+    def write_retry(self, delay):
+        """Write a ``retry`` field telling the client to wait ``delay``
+        seconds before reconnecting.
+
+        """
+        field = "retry: {}\n\n".format(int(1000 * delay)).encode("ascii")
+        if self.gzip is None:
+            self.write(field)
+        else:
+            self.write(self.gzip.block(field, deflate(field)))
+
+    def reconnect(self, delay):
+        self.write_retry(delay)
+        super(EventSource, self).reconnect(delay)
+
+    def on_connection_close(self):
+        self.finished = True
+        self.messages.close()
+
     async def publish(self, message):
         """Pushes data to a listener."""
-        try:
-            self.write("data: {}\n\n".format(message))
-            await self.flush()
-        except StreamClosedError:
-            self.finished = True
+        await self.publish_batch([message])
+
+    async def publish_batch(self, messages):
+        """Push several messages to a listener with a single flush."""
+        written = 0
+        traced = []
+        for message in messages:
+            written += self.write_event(message)
+            if message.trace:
+                traced.append(message)
+        if written:
+            written_at = perf_counter() if traced else None
+            try:
+                await self._flush()
+            except StreamClosedError:
+                self.finished = True
+            else:
+                self.store.metrics.delivered += written
+                if traced:
+                    flushed_at = perf_counter()
+                    for message in traced:
+                        message.trace.finish(self, message, written_at, flushed_at)
+
+    async def replay(self, last_id):
+        """Send the messages published after ``last_id`` that are still
+        in the store's history, flushing after every
+        :attr:`replay_batch_size` messages.
+
+        """
+        missed = iter(self.store.replay(self, last_id))
+        # An id newer than any known to the store comes from elsewhere
+        self.last_id = min(last_id, self.store.last_id)
+        while not self.finished:
+            batch = list(islice(missed, self.replay_batch_size))
+            if not batch:
+                break
+            await self.publish_batch(batch)
 
     async def get(self, *args, **kwargs):
+        self.subscribe(*args, **kwargs)
         try:
+            if self.retry is not None:
+                self.write_retry(self.retry + random.uniform(0, self.retry_jitter))
+                await self._flush()
+            last_id = self.get_last_event_id()
+            if last_id is not None:
+                await self.replay(last_id)
             while not self.finished:
-                message = await self.messages.get()
-                await self.publish(message)
+                if self.batch_size > 1:
+                    batch = await self.messages.get_batch(
+                        self.batch_size, self.batch_delay
+                    )
+                    await self.publish_batch(batch)
+                else:
+                    message = await self.messages.get()
+                    await self.publish(message)
+                await self.throttle()
         except Exception:
             pass
         finally:
-            self.store.deregister(self)
-            self.finish()
+            self.unsubscribe()
+            if not self.request.connection.stream.closed():
+                if self.gzip is not None:
+                    self.write(self.gzip.trailer())
+                self.finish()
+
+
+class _SharedDeflateProtocol(WebSocketProtocol13):
+    """Negotiates ``permessage-deflate`` without server context
+    takeover so that compressed frames can be shared between
+    connections.
+
+    """
+
+    shared_compression = False
+
+    def _create_compressors(self, side, agreed_parameters, compression_options=None):
+        if side == "server":
+            # The server may always decline context takeover. The
+            # parameters are echoed back to the client.
+            agreed_parameters["server_no_context_takeover"] = None
+            bits = agreed_parameters.get("server_max_window_bits")
+            self.shared_compression = bits is None or int(bits) == zlib.MAX_WBITS
+        super(_SharedDeflateProtocol, self)._create_compressors(
+            side, agreed_parameters, compression_options
+        )
 
 
 class WebSocketSubscriber(BaseHandler, WebSocketHandler):
-    """A Websocket-based subscription handler."""
+    """A Websocket-based subscription handler.
 
-    def initialize(self, store):
-        super(WebSocketSubscriber, self).initialize(store)
+    With a heartbeat service, a websocket ping is sent every interval
+    and the connection is dropped if no pong arrived since the previous
+    one.
+
+    With ``compress`` enabled, ``permessage-deflate`` is offered to
+    clients without server context takeover. Every message of at least
+    :attr:`compress_min_size` bytes is then compressed once per
+    broadcast and the compressed frame is shared by all subscribers.
+    Smaller messages are sent uncompressed.
+
+    Messages are encoded with ``codec`` (see :mod:`tornadose.codecs`),
+    which defaults to that of the store. Clients can pick another codec
+    from ``codecs`` (by default all registered codecs) by offering its
+    name as a websocket subprotocol or with the ``codec`` query
+    argument. Codecs which cannot encode the latest message of the store
+    are refused. Binary codecs are sent in binary frames. If a message
+    cannot be encoded with the subscriber's codec, the connection is
+    closed with status 1003 (unsupported data).
+
+    """
+
+    #: Messages shorter than this many bytes are not compressed.
+    compress_min_size = 128
+
+    def initialize(self, store, compress=False, codec=None, codecs=None, **kwargs):
+        super(WebSocketSubscriber, self).initialize(store, **kwargs)
+        self.compress = compress
+        self.codec = get_codec(codec or store.codec)
+        if codecs is None:
+            self.codecs = dict(registered_codecs)
+        else:
+            self.codecs = {c.name: c for c in map(get_codec, codecs)}
         self.finished = False
+        self._last_ping = None
+        self._last_pong = 0
+
+    def prepare(self):
+        super(WebSocketSubscriber, self).prepare()
+        name = self.get_query_argument("codec", None)
+        if name is not None:
+            if name not in self.codecs or not self.can_encode(self.codecs[name]):
+                self.unsubscribe()
+                raise HTTPError(400, "Unsupported codec {!r}".format(name))
+            self.codec = self.codecs[name]
+
+    def select_subprotocol(self, subprotocols):
+        for name in subprotocols:
+            if name in self.codecs and self.can_encode(self.codecs[name]):
+                self.codec = self.codecs[name]
+                return name
+        return None
+
+    def can_encode(self, codec):
+        """Whether ``codec`` can encode the latest message in the
+        store's history. Any codec is accepted while the history is
+        empty.
+
+        """
+        if not self.store.history:
+            return True
+        try:
+            self.store.history[-1].payload(codec)
+        except (TypeError, ValueError):
+            return False
+        return True
 
-    async def open(self):
+    def open(self, *args, **kwargs):
         """Register with the publisher."""
-        self.store.register(self)
-        while not self.finished:
-            message = await self.messages.get()
-            await self.publish(message)
+        self.subscribe(*args, **kwargs)
+        # Publish from a separate callback: Tornado does not read
+        # incoming frames (including pongs) until ``open`` returns.
+        IOLoop.current().add_callback(self._publish_loop)
+
+    async def _publish_loop(self):
+        try:
+            while not self.finished:
+                message = await self.messages.get()
+                await self.publish(message)
+                await self.throttle()
+        except QueueClosed:
+            if not self.finished:
+                self._close()
+                self.close(1013, "Subscriber queue overflow")
 
     def on_close(self):
         self._close()
 
+    def get_compression_options(self):
+        return {} if self.compress else None
+
+    def get_websocket_protocol(self):
+        protocol = super(WebSocketSubscriber, self).get_websocket_protocol()
+        if self.compress and isinstance(protocol, WebSocketProtocol13):
+            protocol = _SharedDeflateProtocol(self, False, protocol.params)
+        return protocol
+
+    def on_pong(self, data):
+        self._last_pong = IOLoop.current().time()
+
+    def heartbeat(self, now):
+        if self._last_ping is not None and self._last_pong < self._last_ping:
+            self.evict()
+            return
+        self._last_ping = now
+        try:
+            self.ping()
+        except WebSocketClosedError:
+            self._close()
+
+    def evict(self):
+        self.finished = True
+        super(WebSocketSubscriber, self).evict()
+        if self.ws_connection is not None:
+            # No point in a closing handshake with an unresponsive client
+            self.ws_connection.stream.close()
+
     def _close(self):
-        self.store.deregister(self)
+        self.unsubscribe()
         self.finished = True
+        # Wake up the publish loop so that it ends
+        self.messages.close()
+
+    def reconnect(self, delay):
+        """Close the connection with status 1012 (service restart) and
+        the reason ``retry=<milliseconds>``.
+
+        """
+        super(WebSocketSubscriber, self).reconnect(delay)
+        self.finished = True
+        self.close(1012, "retry={}".format(int(1000 * delay)))
 
     async def publish(self, message):
-        """Push a new message to the client. The data will be
-        available as a JSON object with the key ``data``.
+        """Push a new message to the client, encoded with the
+        subscriber's codec.
+
+        Pre-built frames shared by all subscribers are written directly
+        to the connection unless compression with parameters preventing
+        this was negotiated.
 
         """
+        connection = self.ws_connection
+        trace = message.trace
+        written_at = perf_counter() if trace else None
+        codec = self.codec
         try:
-            self.write_message(dict(data=message))
-        except WebSocketClosedError:
+            payload = message.payload(codec)
+        except (TypeError, ValueError) as e:
+            logger.warning(
+                "Cannot encode message as %s for %r: %s", codec.name, self, e
+            )
+            self._close()
+            self.close(1003, "Cannot encode data as {}".format(codec.name))
+            return
+        try:
+            if connection is None or connection.is_closing():
+                raise WebSocketClosedError()
+            if getattr(connection, "_compressor", None) is None:
+                await connection.stream.write(message.frame(codec))
+            elif len(payload) < self.compress_min_size:
+                await connection.stream.write(message.frame(codec))
+            elif getattr(connection, "shared_compression", False):
+                await connection.stream.write(message.frame(codec, compressed=True))
+            else:
+                await self.write_message(payload, codec.binary)
+        except (WebSocketClosedError, StreamClosedError):
             self._close()
+        else:
+            self.store.metrics.delivered += 1
+            if trace:
+                trace.finish(self, message, written_at, perf_counter())
@@ -0,0 +1,82 @@
+"""Detecting dead connections with periodic pings."""
+
+import logging
+
+from tornado.ioloop import IOLoop
+
+from .scheduler import TimerWheel
+
+logger = logging.getLogger("tornadose.heartbeat")
+
+
+class Heartbeat(TimerWheel):
+    """A single service sending periodic pings to any number of
+    subscribers.
+
+    Rather than one timer per connection, subscribers are spread over
+    the ``slots`` of a :class:`tornadose.scheduler.TimerWheel` which
+    advances one slot every ``interval / slots`` seconds. Each
+    subscriber's :meth:`heartbeat` method is therefore called once per
+    ``interval`` and the pings of many connections are spread evenly
+    over time. Subscribers which did not answer the previous ping by
+    then are evicted. The timer stops while no subscriber is added.
+
+    Pass the same instance to every handler which should be pinged::
+
+        heartbeat = Heartbeat(interval=15)
+        app = Application([
+            (r"/events", EventSource, {"store": store, "heartbeat": heartbeat}),
+            (r"/ws", WebSocketSubscriber, {"store": store, "heartbeat": heartbeat}),
+        ])
+
+    :param float interval: seconds between pings to each subscriber
+    :param int slots: number of slots in the timer wheel
+
+    """
+
+    slot_type = set
+
+    def __init__(self, interval=15.0, slots=16):
+        super(Heartbeat, self).__init__(interval / slots, slots)
+        self.interval = interval
+        self._slot_of = {}
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def add(self, subscriber):
+        """Start pinging ``subscriber``. It is put in the slot with the
+        fewest subscribers, so that clients connecting at the same time
+        are still pinged at different times. Its first ping is sent
+        within one ``interval``.
+
+        """
+        if subscriber in self._slot_of:
+            return
+        # The slot after the current one is expired next; on ties prefer
+        # the slots reached last so that new subscribers are not pinged
+        # at once.
+        count = len(self.slots)
+        index = min(
+            ((self._position - i) % count for i in range(count)),
+            key=lambda i: len(self.slots[i]),
+        )
+        self.slots[index].add(subscriber)
+        self._slot_of[subscriber] = index
+        self.start()
+
+    def discard(self, subscriber):
+        """Stop pinging ``subscriber``."""
+        index = self._slot_of.pop(subscriber, None)
+        if index is not None:
+            self.slots[index].discard(subscriber)
+
+    def expire(self, index):
+        """Ping the subscribers in the slot at ``index``."""
+        now = IOLoop.current().time()
+        for subscriber in list(self.slots[index]):
+            try:
+                subscriber.heartbeat(now)
+            except Exception:
+                logger.exception("Error sending heartbeat to %r", subscriber)
+                self.discard(subscriber)
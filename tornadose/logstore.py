@@ -0,0 +1,313 @@
+"""A store keeping its messages in an append-only log on disk."""
+
+from array import array
+from bisect import bisect_right
+import logging
+import mmap
+import os
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+from .cluster import decode_frame, encode_frame, frame_header
+from .stores import QueueStore
+
+logger = logging.getLogger("tornadose.logstore")
+
+_suffix = ".log"
+
+
+class Segment(object):
+    """A file of a :class:`SegmentedLog`, named after the id of its
+    first message.
+
+    Every ``index_interval``-th record is kept in a sparse in-memory
+    index of ids and file positions, so reading from an id only scans a
+    few record headers before the first record returned.
+
+    """
+
+    def __init__(self, path, first_id, index_interval=64):
+        self.path = path
+        self.first_id = first_id
+        self.last_id = None
+        self.size = 0
+        self.count = 0
+        self.index_interval = index_interval
+        self.ids = array("Q")
+        self.positions = array("Q")
+
+    def recover(self):
+        """Index the records of an existing file. A partially written
+        last record is truncated.
+
+        """
+        size = os.path.getsize(self.path)
+        pos = 0
+        if size:
+            with open(self.path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    while True:
+                        header = frame_header(buffer, pos)
+                        if header is None:
+                            break
+                        end, _, id = header
+                        self.record(id, pos)
+                        pos = end
+        if pos < size:
+            logger.warning("Truncating incomplete record in %s", self.path)
+            os.truncate(self.path, pos)
+        self.size = pos
+
+    def record(self, id, pos):
+        """Note that the record for ``id`` was written at ``pos``."""
+        if self.count % self.index_interval == 0:
+            self.ids.append(id)
+            self.positions.append(pos)
+        self.count += 1
+        self.last_id = id
+
+    def read_after(self, last_id):
+        """Yield the messages of this segment with an id greater than
+        ``last_id``. Records are decoded one at a time from a memory map
+        of the segment as it was when reading started.
+
+        """
+        size = self.size
+        if not size or self.last_id <= last_id:
+            return
+        index = bisect_right(self.ids, last_id) - 1
+        pos = self.positions[index] if index >= 0 else 0
+        with open(self.path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            while pos < size:
+                end, _, id = frame_header(buffer, pos)
+                if id > last_id:
+                    message = decode_frame(buffer, pos)[3]
+                    message.id = id
+                    yield message
+                pos = end
+        finally:
+            buffer.close()
+
+
+class SegmentedLog(object):
+    """An append-only log of messages split into segment files.
+
+    Records use the frame format of :func:`tornadose.cluster.encode_frame`
+    with the message id as sequence number. A new segment is started
+    once the current one reaches ``segment_size`` bytes; retention
+    deletes whole segments, oldest first.
+
+    :param str path: directory holding the segments
+    :param int segment_size: size in bytes after which a new segment is
+        started
+    :param bool fsync: whether to ``fsync`` after every record
+
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(_suffix):
+                first_id = int(name[: -len(_suffix)])
+                segment = Segment(os.path.join(path, name), first_id)
+                segment.recover()
+                if segment.size:
+                    self.segments.append(segment)
+                else:
+                    os.remove(segment.path)
+        self._file = None
+
+    @property
+    def first_id(self):
+        return self.segments[0].first_id if self.segments else None
+
+    @property
+    def last_id(self):
+        return self.segments[-1].last_id if self.segments else None
+
+    @property
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, id, message):
+        """Append a :class:`tornadose.messages.Message` under ``id``,
+        which must be greater than that of the previous message.
+
+        """
+        last_id = self.last_id
+        if last_id is not None and id <= last_id:
+            raise ValueError("Log ids must increase: {} <= {}".format(id, last_id))
+        if self._file is None or self.segments[-1].size >= self.segment_size:
+            self._roll(id)
+        segment = self.segments[-1]
+        record = encode_frame(0, id, message)
+        self._file.write(record)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        segment.record(id, segment.size)
+        segment.size += len(record)
+
+    def _roll(self, first_id):
+        if self._file is not None:
+            self._file.close()
+        if self.segments and self.segments[-1].size < self.segment_size:
+            # Keep appending to the last segment after a restart
+            segment = self.segments[-1]
+        else:
+            name = "{:020d}{}".format(first_id, _suffix)
+            segment = Segment(os.path.join(self.path, name), first_id)
+            self.segments.append(segment)
+        self._file = open(segment.path, "ab")
+
+    def read_after(self, last_id):
+        """Yield the messages with an id greater than ``last_id``, in
+        order, starting from the oldest retained message.
+
+        """
+        first_ids = [segment.first_id for segment in self.segments]
+        start = max(bisect_right(first_ids, last_id) - 1, 0)
+        for segment in self.segments[start:]:
+            for message in segment.read_after(last_id):
+                yield message
+
+    def enforce_retention(self, max_bytes=None, max_age=None):
+        """Delete the oldest segments while the log is larger than
+        ``max_bytes`` or their last record was written more than
+        ``max_age`` seconds ago. The segment being written is kept.
+
+        :returns: the number of deleted segments
+
+        """
+        size = self.size
+        cutoff = time.time() - max_age if max_age is not None else None
+        deleted = 0
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            too_big = max_bytes is not None and size > max_bytes
+            too_old = cutoff is not None and os.path.getmtime(segment.path) < cutoff
+            if not (too_big or too_old):
+                break
+            os.remove(segment.path)
+            self.segments.pop(0)
+            size -= segment.size
+            deleted += 1
+        return deleted
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LogStore(QueueStore):
+    """A :class:`tornadose.stores.QueueStore` which appends every
+    message to a :class:`SegmentedLog` in the directory ``path`` before
+    publishing it.
+
+    Messages are logged even when nobody is subscribed. Reconnecting
+    clients are replayed the messages they missed from memory when
+    possible and otherwise from the log, so after a restart clients
+    catch up from disk. Replay decodes messages from memory-mapped
+    segments one at a time instead of loading them.
+
+    Message ids continue from the last logged id after a restart.
+    Segments are deleted, oldest first, once the log exceeds
+    ``retention_bytes`` or they are older than ``retention_seconds``.
+
+    :param str path: directory of the log
+    :param int segment_size: size of segment files in bytes
+    :param int retention_bytes: maximum size of the log
+    :param float retention_seconds: maximum age of logged messages
+    :param bool fsync: whether to ``fsync`` every message
+
+    """
+
+    #: Size in bytes after which a new segment is started.
+    segment_size = 64 * 1024 * 1024
+
+    #: Maximum size of the log in bytes (``None`` keeps everything).
+    retention_bytes = None
+
+    #: Maximum age of segments in seconds (``None`` keeps everything).
+    retention_seconds = None
+
+    #: Seconds between retention checks.
+    retention_interval = 60.0
+
+    #: Whether to ``fsync`` the log after every message.
+    fsync = False
+
+    def initialize(
+        self,
+        path,
+        segment_size=None,
+        retention_bytes=None,
+        retention_seconds=None,
+        fsync=None,
+        **kwargs
+    ):
+        if segment_size is not None:
+            self.segment_size = segment_size
+        if retention_bytes is not None:
+            self.retention_bytes = retention_bytes
+        if retention_seconds is not None:
+            self.retention_seconds = retention_seconds
+        if fsync is not None:
+            self.fsync = fsync
+        self.log = SegmentedLog(path, self.segment_size, self.fsync)
+        if self.log.last_id is not None:
+            self.last_id = max(self.last_id, self.log.last_id)
+        self._retention = None
+        if self.retention_bytes is not None or self.retention_seconds is not None:
+            self.enforce_retention()
+            self._retention = PeriodicCallback(
+                self.enforce_retention, self.retention_interval * 1000
+            )
+            self._retention.start()
+        super(LogStore, self).initialize(**kwargs)
+
+    def enforce_retention(self):
+        """Delete segments beyond the retention limits."""
+        deleted = self.log.enforce_retention(
+            self.retention_bytes, self.retention_seconds
+        )
+        if deleted:
+            logger.info("Deleted %d log segments", deleted)
+
+    def deliver(self, message):
+        self.log.append(message.id, message)
+        super(LogStore, self).deliver(message)
+
+    def replay(self, subscriber, last_id):
+        """Return the messages after ``last_id`` from the in-memory
+        history if it has all of them or else an iterator reading them
+        from the log.
+
+        """
+        if last_id >= self.last_id:
+            return []
+        if self.history and self.history[0].id <= last_id + 1:
+            return super(LogStore, self).replay(subscriber, last_id)
+        return (
+            message
+            for message in self.log.read_after(last_id)
+            if self.accepts(subscriber, message)
+        )
+
+    async def publish(self):
+        while True:
+            self.broadcast(await self._get())
+
+    def shutdown(self):
+        """Stop retention checks and close the log."""
+        if self._retention is not None:
+            self._retention.stop()
+        self.log.close()
@@ -0,0 +1,181 @@
+"""Messages shared between all subscribers of a store."""
+
+import re
+import struct
+
+from tornado.escape import json_encode, to_unicode, utf8
+
+from .codecs import JSON
+from .compression import SYNC_MARKER, deflate
+
+_line_breaks = re.compile(r"\r\n|\r|\n")
+
+#: Priority of ordinary data, subject to queue overflow policies.
+BULK = 0
+
+#: Priority of control messages delivered ahead of queued data.
+CONTROL = 1
+
+
+def websocket_frame(payload, opcode=0x1, flags=0):
+    """Build a complete, unmasked websocket frame for ``payload``.
+
+    Frames sent by a server are never masked, so the same bytes can be
+    written to any number of connections.
+
+    """
+    length = len(payload)
+    first = 0x80 | flags | opcode
+    if length < 126:
+        header = struct.pack("!BB", first, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+    return header + payload
+
+
+class Message(object):
+    """A single piece of data broadcast by a store.
+
+    Stores wrap new data in a :class:`Message` before handing it to
+    subscribers. The wire formats used by the handlers in
+    :mod:`tornadose.handlers` are computed the first time they are
+    requested and cached on the message, so each message is encoded at
+    most once per transport regardless of the number of subscribers.
+    The encoded payloads are immutable ``bytes`` and are written to
+    every connection as-is.
+
+    :param data: the data to publish
+    :param str topic: the topic the message was published to, if any
+    :param int priority: messages with a priority above :data:`BULK`
+        skip ahead of queued bulk data and are never dropped by overflow
+        policies (see :class:`tornadose.queues.SubscriberQueue`)
+
+    Websocket payloads are encoded once per codec (see
+    :mod:`tornadose.codecs`). Compressed forms (see
+    :mod:`tornadose.compression`) are likewise computed once and shared
+    by all connections using compression.
+
+    The ``id`` attribute is assigned by the store when the message is
+    broadcast. Since priority messages overtake older ones, their ids
+    are not included in server-sent events. ``trace`` is ``None`` until
+    a store with tracing enabled has decided whether to sample the
+    message, and then either a :class:`tornadose.tracing.Trace` or
+    ``False``.
+
+    """
+
+    __slots__ = (
+        "data",
+        "topic",
+        "priority",
+        "id",
+        "trace",
+        "_sse",
+        "_sse_deflate",
+        "_encoded",
+    )
+
+    def __init__(self, data, topic=None, priority=BULK):
+        self.data = data
+        self.topic = topic
+        self.priority = priority
+        self.id = None
+        self.trace = None
+        self._sse = None
+        self._sse_deflate = None
+        self._encoded = {}
+
+    def __repr__(self):
+        return "<Message data={!r}>".format(self.data)
+
+    @property
+    def text(self):
+        """The data as a string. Dictionaries and lists are encoded as
+        JSON.
+
+        """
+        if isinstance(self.data, bytes):
+            return to_unicode(self.data)
+        if isinstance(self.data, (dict, list)):
+            return json_encode(self.data)
+        return str(self.data)
+
+    @property
+    def sse(self):
+        """The message framed as a server-sent event. The event includes
+        the message ``id`` if it has one, unless it is a priority
+        message.
+
+        """
+        if self._sse is None:
+            lines = ["data: " + line for line in _line_breaks.split(self.text)]
+            if self.id is not None and self.priority == BULK:
+                lines.insert(0, "id: {}".format(self.id))
+            self._sse = utf8("\n".join(lines) + "\n\n")
+        return self._sse
+
+    @property
+    def sse_deflate(self):
+        """:attr:`sse` as self-contained deflate blocks."""
+        if self._sse_deflate is None:
+            self._sse_deflate = deflate(self.sse)
+        return self._sse_deflate
+
+    def payload(self, codec=JSON):
+        """The message encoded with ``codec`` (see
+        :mod:`tornadose.codecs`).
+
+        """
+        key = (codec, "payload")
+        try:
+            return self._encoded[key]
+        except KeyError:
+            payload = self._encoded[key] = codec.encode(self.data, self.topic)
+            return payload
+
+    def frame(self, codec=JSON, compressed=False):
+        """A complete websocket frame containing :meth:`payload`. Binary
+        codecs are sent in binary frames. If ``compressed``, the payload
+        is compressed for ``permessage-deflate`` without context
+        takeover.
+
+        """
+        key = (codec, compressed)
+        try:
+            return self._encoded[key]
+        except KeyError:
+            pass
+        payload = self.payload(codec)
+        opcode = 0x2 if codec.binary else 0x1
+        if compressed:
+            payload = deflate(payload)
+            payload = payload[: -len(SYNC_MARKER)]
+            frame = websocket_frame(payload, opcode, flags=0x40)
+        else:
+            frame = websocket_frame(payload, opcode)
+        self._encoded[key] = frame
+        return frame
+
+    @property
+    def ws_payload(self):
+        """The JSON-encoded text sent over websockets by default. The
+        data is available to clients under the key ``data`` and the
+        topic, if any, under the key ``topic``.
+
+        """
+        return self.payload(JSON)
+
+    @property
+    def ws_frame(self):
+        """A complete websocket text frame containing :attr:`ws_payload`."""
+        return self.frame(JSON)
+
+    @property
+    def ws_deflate_frame(self):
+        """A websocket text frame containing :attr:`ws_payload`
+        compressed for ``permessage-deflate`` without context takeover.
+
+        """
+        return self.frame(JSON, compressed=True)
@@ -0,0 +1,273 @@
+"""Metrics for stores and subscribers in the Prometheus text format.
+
+Every store keeps a :class:`StoreMetrics` instance as its ``metrics``
+attribute. Only a few counters and a fan-out duration histogram are
+updated while publishing, once per message rather than once per
+subscriber. Subscriber counts and queue depths are read when the
+metrics are collected, so they cost nothing until scraped.
+
+To expose the metrics of all stores, add a :class:`MetricsHandler` to
+the application::
+
+    app = Application([
+        (r"/stream", EventSource, {"store": store}),
+        (r"/metrics", MetricsHandler),
+    ])
+
+"""
+
+from bisect import bisect_left
+import weakref
+
+from tornado.web import RequestHandler
+
+#: Default histogram buckets for durations in seconds.
+DURATION_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+#: Histogram buckets for subscriber queue depths.
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_stores = weakref.WeakSet()
+
+
+class Histogram(object):
+    """A histogram with fixed upper bucket bounds.
+
+    :param buckets: sorted upper bounds; an implicit ``+Inf`` bucket is
+        added
+
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return ``(upper bound, cumulative count)`` pairs including
+        the ``+Inf`` bucket.
+
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """Estimate the ``q`` quantile as the upper bound of the bucket
+        containing it, or ``None`` if nothing was observed.
+
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+
+class StoreMetrics(object):
+    """Counters updated by a store and its subscribers.
+
+    :ivar submitted: messages broadcast by the store
+    :ivar delivered: messages written to clients by the built-in handlers
+    :ivar evicted: subscribers dropped for not answering heartbeats
+    :ivar fanout: :class:`Histogram` of the time taken to hand a message
+        to every subscriber (with sharded fan-out, each shard's share is
+        observed separately)
+    :ivar blocked: :class:`Histogram` of the time producers waited for a
+        saturated store
+    :ivar rejected: messages refused by a saturated store
+
+    """
+
+    __slots__ = ("submitted", "delivered", "evicted", "fanout", "blocked", "rejected")
+
+    def __init__(self):
+        self.submitted = 0
+        self.delivered = 0
+        self.evicted = 0
+        self.fanout = Histogram()
+        self.blocked = Histogram()
+        self.rejected = 0
+
+
+def track(store):
+    """Include ``store`` in the stores reported by :func:`collect` by
+    default. Stores call this themselves when created.
+
+    """
+    _stores.add(store)
+
+
+def tracked():
+    """Return the stores passed to :func:`track`, sorted by name."""
+    return sorted(_stores, key=lambda store: store.name)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Family(object):
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.lines = [
+            "# HELP {} {}".format(name, help),
+            "# TYPE {} {}".format(name, kind),
+        ]
+
+    def add(self, value, labels=(), suffix=""):
+        self.lines.append(
+            "{}{}{} {}".format(
+                self.name, suffix, _format_labels(labels), _format_value(value)
+            )
+        )
+
+    def add_histogram(self, histogram, labels):
+        for bound, count in histogram.cumulative():
+            bucket_labels = tuple(labels) + (("le", _format_value(float(bound))),)
+            self.add(count, bucket_labels, "_bucket")
+        self.add(histogram.sum, labels, "_sum")
+        self.add(histogram.count, labels, "_count")
+
+
+def collect(stores=None):
+    """Return the metrics of ``stores`` (by default all stores) in the
+    Prometheus text exposition format.
+
+    """
+    if stores is None:
+        stores = tracked()
+    subscribers = _Family(
+        "tornadose_subscribers", "gauge", "Number of registered subscribers."
+    )
+    submitted = _Family(
+        "tornadose_messages_submitted_total",
+        "counter",
+        "Messages broadcast by the store.",
+    )
+    delivered = _Family(
+        "tornadose_messages_delivered_total",
+        "counter",
+        "Messages written to clients.",
+    )
+    overflows = _Family(
+        "tornadose_overflows_total",
+        "counter",
+        "Messages dropped or subscribers disconnected by queue overflow policies.",
+    )
+    evicted = _Family(
+        "tornadose_subscribers_evicted_total",
+        "counter",
+        "Subscribers dropped for not answering heartbeats.",
+    )
+    fanout = _Family(
+        "tornadose_fanout_seconds",
+        "histogram",
+        "Time taken to hand a message to all subscribers.",
+    )
+    blocked = _Family(
+        "tornadose_producer_blocked_seconds",
+        "histogram",
+        "Time producers waited for a saturated store.",
+    )
+    rejected = _Family(
+        "tornadose_messages_rejected_total",
+        "counter",
+        "Messages refused by a saturated store.",
+    )
+    depth = _Family(
+        "tornadose_queue_depth",
+        "histogram",
+        "Current number of queued messages per subscriber.",
+    )
+    stages = _Family(
+        "tornadose_trace_stage_seconds",
+        "histogram",
+        "Time sampled messages spent in each stage of delivery.",
+    )
+    for store in stores:
+        labels = (("store", store.name),)
+        subscribers.add(len(store.subscribers), labels)
+        submitted.add(store.metrics.submitted, labels)
+        delivered.add(store.metrics.delivered, labels)
+        evicted.add(store.metrics.evicted, labels)
+        for policy, count in sorted(store.overflows.items()):
+            overflows.add(count, labels + (("policy", policy),))
+        fanout.add_histogram(store.metrics.fanout, labels)
+        blocked.add_histogram(store.metrics.blocked, labels)
+        rejected.add(store.metrics.rejected, labels)
+        depths = Histogram(DEPTH_BUCKETS)
+        for subscriber in list(store.subscribers):
+            queue = getattr(subscriber, "messages", None)
+            if queue is not None:
+                depths.observe(len(queue))
+        depth.add_histogram(depths, labels)
+        tracer = getattr(store, "tracer", None)
+        if tracer is not None:
+            for stage, histogram in tracer.histograms.items():
+                stages.add_histogram(histogram, labels + (("stage", stage),))
+    families = (
+        subscribers,
+        submitted,
+        delivered,
+        evicted,
+        overflows,
+        fanout,
+        blocked,
+        rejected,
+        depth,
+        stages,
+    )
+    return "\n".join(line for family in families for line in family.lines) + "\n"
+
+
+class MetricsHandler(RequestHandler):
+    """Serve metrics in the Prometheus text format.
+
+    :param stores: stores to report; defaults to every store created in
+        this process
+
+    """
+
+    def initialize(self, stores=None):
+        self.stores = stores
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(collect(self.stores))
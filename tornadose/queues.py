@@ -0,0 +1,235 @@
+"""Bounded per-subscriber message queues."""
+
+from asyncio import QueueFull
+from collections import Counter, OrderedDict, deque
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .messages import BULK
+
+#: Discard the oldest queued message to make room for a new one.
+DROP_OLDEST = "drop-oldest"
+
+#: Discard the new message when the queue is full.
+DROP_NEWEST = "drop-newest"
+
+#: Discard everything queued and keep only the new message.
+KEEP_LATEST = "keep-latest"
+
+#: Close the queue so that the subscriber gets disconnected.
+DISCONNECT = "disconnect"
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, KEEP_LATEST, DISCONNECT)
+
+
+class QueueClosed(Exception):
+    """Raised when getting from a closed :class:`SubscriberQueue`."""
+
+
+class SubscriberQueue(object):
+    """A FIFO queue of messages waiting to be sent to a single subscriber.
+
+    Unlike :class:`asyncio.Queue`, putting never blocks. When ``maxsize``
+    is reached the overflow ``policy`` decides what happens to the new
+    message, so the memory used by a subscriber stays bounded however
+    slowly it reads. The number of times each policy fired is recorded
+    in :attr:`counts` and the number of discarded messages in
+    :attr:`dropped`.
+
+    Messages with a ``priority`` above :data:`tornadose.messages.BULK`
+    are kept in separate lanes, one per priority. They are returned
+    before any bulk messages, highest priority first, and do not count
+    towards ``maxsize``, so overflow policies only ever drop bulk data.
+
+    :param int maxsize: maximum number of queued messages; 0 means
+        unbounded
+    :param str policy: one of :data:`DROP_OLDEST`, :data:`DROP_NEWEST`,
+        :data:`KEEP_LATEST` or :data:`DISCONNECT`
+
+    """
+
+    def __init__(self, maxsize=0, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.counts = Counter()
+        self.dropped = 0
+        self.closed = False
+        self._items = deque()
+        self._lanes = {}
+        self._waiter = None
+
+    def __len__(self):
+        return len(self._items) + sum(len(lane) for lane in self._lanes.values())
+
+    def qsize(self):
+        """Number of messages currently queued."""
+        return len(self)
+
+    def empty(self):
+        return not self._items and not self._lanes
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._items)
+
+    def put_nowait(self, item):
+        """Queue a new message.
+
+        :returns: the overflow policy that was applied or ``None``
+        :raises asyncio.QueueFull: when the queue is full and the policy
+            is :data:`DISCONNECT`; the queue is closed in this case
+
+        """
+        if self.closed:
+            return None
+        priority = getattr(item, "priority", BULK)
+        if priority > BULK:
+            self._lanes.setdefault(priority, deque()).append(item)
+            self._wakeup()
+            return None
+        policy = None
+        if self.full():
+            policy = self.policy
+            self.counts[policy] += 1
+            if policy == DROP_OLDEST:
+                self._items.popleft()
+                self.dropped += 1
+            elif policy == DROP_NEWEST:
+                self.dropped += 1
+                return policy
+            elif policy == KEEP_LATEST:
+                self.dropped += len(self._items)
+                self._items.clear()
+            else:
+                self.close()
+                raise QueueFull()
+        self._items.append(item)
+        self._wakeup()
+        return policy
+
+    def get_nowait(self):
+        """Remove and return the next message.
+
+        :raises IndexError: if no message is queued
+
+        """
+        if self._lanes:
+            priority = max(self._lanes)
+            lane = self._lanes[priority]
+            item = lane.popleft()
+            if not lane:
+                del self._lanes[priority]
+            return item
+        return self._items.popleft()
+
+    async def get(self):
+        """Wait for and return the next message.
+
+        :raises QueueClosed: once the queue has been closed
+
+        """
+        while self.empty():
+            if self.closed:
+                raise QueueClosed()
+            self._waiter = Future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.get_nowait()
+
+    async def get_batch(self, max_items, delay=0):
+        """Wait for the next message and return a list of up to
+        ``max_items`` queued messages. If fewer are available, wait at
+        most ``delay`` seconds for more to arrive.
+
+        :raises QueueClosed: if the queue is closed while empty
+
+        """
+        batch = [await self.get()]
+        self._drain_into(batch, max_items)
+        if len(batch) < max_items and delay > 0:
+            io_loop = IOLoop.current()
+            deadline = io_loop.time() + delay
+            while len(batch) < max_items and not self.closed:
+                self._waiter = Future()
+                timeout = io_loop.call_at(deadline, self._wakeup)
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
+                    io_loop.remove_timeout(timeout)
+                if self.empty():
+                    break
+                self._drain_into(batch, max_items)
+        return batch
+
+    def _drain_into(self, batch, max_items):
+        while len(batch) < max_items and not self.empty():
+            batch.append(self.get_nowait())
+
+    def clear(self):
+        """Discard all queued bulk messages."""
+        self._items.clear()
+
+    def close(self):
+        """Discard all queued messages and wake up the consumer."""
+        self.closed = True
+        self._items.clear()
+        self._lanes.clear()
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+class _LatestByTopic(object):
+    """The subset of :class:`collections.deque` used by
+    :class:`SubscriberQueue`, holding one item per topic.
+
+    """
+
+    def __init__(self):
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return getattr(item, "topic", None) in self._items
+
+    def append(self, item):
+        self._items[getattr(item, "topic", None)] = item
+
+    def popleft(self):
+        return self._items.popitem(last=False)[1]
+
+    def clear(self):
+        self._items.clear()
+
+
+class ConflatingQueue(SubscriberQueue):
+    """A :class:`SubscriberQueue` keeping only the latest message per
+    topic. A new message replaces a queued one with the same topic and
+    takes its place in the queue, so however fast messages arrive at
+    most one per topic is waiting. Priority messages are never
+    conflated. Replaced messages are counted in
+    :attr:`conflated`.
+
+    """
+
+    def __init__(self, maxsize=0, policy=DROP_OLDEST):
+        super(ConflatingQueue, self).__init__(maxsize, policy)
+        self._items = _LatestByTopic()
+        self.conflated = 0
+
+    def put_nowait(self, item):
+        priority = getattr(item, "priority", BULK)
+        if not self.closed and priority == BULK and item in self._items:
+            self._items.append(item)
+            self.conflated += 1
+            return None
+        return super(ConflatingQueue, self).put_nowait(item)
@@ -0,0 +1,277 @@
+"""A minimal non-blocking Redis client built on Tornado's IOStream.
+
+Only what tornadose needs is implemented: pipelined commands and
+publish/subscribe. Replies are parsed in batches straight from the
+socket buffer, so no background threads are involved.
+
+"""
+
+import asyncio
+from collections import deque
+import logging
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+logger = logging.getLogger("tornadose.resp")
+
+#: Number of bytes to read from the socket at once.
+READ_CHUNK_SIZE = 65536
+
+_push_kinds = {b"subscribe", b"psubscribe", b"unsubscribe", b"punsubscribe"}
+
+
+class RedisError(Exception):
+    """An error reply from the Redis server."""
+
+
+class _Incomplete(Exception):
+    """Raised by the parser when the buffer ends mid-reply."""
+
+
+def encode_command(*args):
+    """Encode a command as a RESP array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif not isinstance(arg, (bytes, bytearray, memoryview)):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n" % len(arg))
+        parts.append(arg)
+        parts.append(b"\r\n")
+    return b"".join(parts)
+
+
+class RespParser(object):
+    """Incremental parser for RESP2 replies.
+
+    Feed it data as it arrives with :meth:`feed` and collect every
+    complete reply with :meth:`replies`. Error replies are returned as
+    :class:`RedisError` instances rather than raised.
+
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+
+    def replies(self):
+        """Return a list of all complete replies buffered so far."""
+        replies = []
+        pos = 0
+        while True:
+            try:
+                reply, pos = self._parse(pos)
+            except _Incomplete:
+                break
+            replies.append(reply)
+        if pos:
+            del self._buffer[:pos]
+        return replies
+
+    def _parse(self, pos):
+        buffer = self._buffer
+        end = buffer.find(b"\r\n", pos)
+        if end < 0:
+            raise _Incomplete()
+        kind = buffer[pos]
+        start, pos = pos + 1, end + 2
+        line = bytes(buffer[start:end])
+        if kind == 0x24:  # $
+            length = int(line)
+            if length < 0:
+                return None, pos
+            end = pos + length
+            if len(buffer) < end + 2:
+                raise _Incomplete()
+            return bytes(buffer[pos:end]), end + 2
+        elif kind == 0x2A:  # *
+            length = int(line)
+            if length < 0:
+                return None, pos
+            items = []
+            for _ in range(length):
+                item, pos = self._parse(pos)
+                items.append(item)
+            return items, pos
+        elif kind == 0x3A:  # :
+            return int(line), pos
+        elif kind == 0x2B:  # +
+            return line, pos
+        elif kind == 0x2D:  # -
+            return RedisError(line.decode("utf-8", "replace")), pos
+        raise RedisError("Protocol error: unexpected {!r}".format(chr(kind)))
+
+
+class RedisConnection(object):
+    """A single connection to a Redis server.
+
+    Commands are pipelined: :meth:`execute` and :meth:`execute_many`
+    write immediately and return futures which are resolved in order as
+    replies arrive.
+
+    :param str host: Redis host
+    :param int port: Redis port
+    :param str password: password to ``AUTH`` with, if any
+    :param int db: database to ``SELECT``
+
+    """
+
+    def __init__(self, host="localhost", port=6379, password=None, db=0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.stream = None
+        self._parser = None
+        self._pending = deque()
+        self._closed = None
+        self._connecting = None
+
+    @property
+    def connected(self):
+        return self.stream is not None and not self.stream.closed()
+
+    async def connect(self):
+        """Open the connection and authenticate if needed."""
+        self.stream = await TCPClient().connect(self.host, self.port)
+        self.stream.set_nodelay(True)
+        self._parser = RespParser()
+        self._closed = Future()
+        IOLoop.current().add_callback(self._read_loop)
+        if self.password is not None:
+            await self.execute("AUTH", self.password)
+        if self.db:
+            await self.execute("SELECT", self.db)
+
+    async def ensure_connected(self):
+        """Connect unless already connected. Concurrent callers share a
+        single connection attempt.
+
+        """
+        if self._connecting is None or (self._connecting.done() and not self.connected):
+            self._connecting = asyncio.ensure_future(self.connect())
+        await self._connecting
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    async def wait_closed(self):
+        """Wait until the connection is lost or closed."""
+        await self._closed
+
+    def execute(self, *args):
+        """Send a single command and return a future for its reply."""
+        return self.execute_many([args])[0]
+
+    def execute_many(self, commands):
+        """Send a sequence of commands with a single write.
+
+        :returns: a list of futures resolving to the replies
+        :raises StreamClosedError: if not connected
+
+        """
+        if not self.connected:
+            raise StreamClosedError()
+        futures = []
+        for _ in commands:
+            future = Future()
+            self._pending.append(future)
+            futures.append(future)
+        self.stream.write(b"".join(encode_command(*args) for args in commands))
+        return futures
+
+    def handle_replies(self, replies):
+        """Resolve pending futures with a batch of replies. Subclasses
+        may override this to handle unsolicited replies.
+
+        """
+        for reply in replies:
+            future = self._pending.popleft()
+            if future.done():
+                continue
+            if isinstance(reply, RedisError):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+    async def _read_loop(self):
+        stream = self.stream
+        try:
+            while True:
+                data = await stream.read_bytes(READ_CHUNK_SIZE, partial=True)
+                self._parser.feed(data)
+                replies = self._parser.replies()
+                if replies:
+                    self.handle_replies(replies)
+        except StreamClosedError:
+            logger.debug("Connection to Redis at %s:%d lost", self.host, self.port)
+        except Exception:
+            logger.exception("Error reading from Redis")
+            stream.close()
+        finally:
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(StreamClosedError())
+            self._closed.set_result(None)
+
+
+class RedisSubscription(RedisConnection):
+    """A connection in publish/subscribe mode.
+
+    Every batch of messages read from the socket is passed to
+    ``callback`` as a list of ``(channel, data)`` tuples, where
+    ``channel`` is a ``str`` and ``data`` is ``bytes``.
+
+    """
+
+    def __init__(self, callback, **kwargs):
+        super(RedisSubscription, self).__init__(**kwargs)
+        self.callback = callback
+
+    def subscribe(self, *channels):
+        if channels:
+            self._send("SUBSCRIBE", *channels)
+
+    def unsubscribe(self, *channels):
+        if channels:
+            self._send("UNSUBSCRIBE", *channels)
+
+    def psubscribe(self, *patterns):
+        if patterns:
+            self._send("PSUBSCRIBE", *patterns)
+
+    def punsubscribe(self, *patterns):
+        if patterns:
+            self._send("PUNSUBSCRIBE", *patterns)
+
+    def _send(self, *args):
+        # Subscription commands are confirmed with push messages rather
+        # than regular replies.
+        if not self.connected:
+            raise StreamClosedError()
+        self.stream.write(encode_command(*args))
+
+    def handle_replies(self, replies):
+        batch = []
+        for reply in replies:
+            if isinstance(reply, list) and reply:
+                kind = reply[0]
+                if kind == b"message":
+                    batch.append((reply[1].decode("utf-8"), reply[2]))
+                    continue
+                elif kind == b"pmessage":
+                    batch.append((reply[2].decode("utf-8"), reply[3]))
+                    continue
+                elif kind in _push_kinds or kind == b"pong":
+                    continue
+            super(RedisSubscription, self).handle_replies([reply])
+        if batch:
+            self.callback(batch)
@@ -0,0 +1,121 @@
+"""Shared timers for pacing deliveries to many subscribers."""
+
+import math
+import weakref
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+class TimerWheel(object):
+    """Base class for timers serving many entries with a single
+    :class:`tornado.ioloop.PeriodicCallback`.
+
+    The wheel advances one of its ``slots`` every ``resolution`` seconds
+    and passes the index of the slot reached to :meth:`expire`. The
+    timer is started with :meth:`start` and stops by itself once the
+    wheel is empty, as reported by ``len()``.
+
+    :param float resolution: seconds between ticks of the wheel
+    :param int slots: number of slots in the wheel
+
+    """
+
+    #: Type of the containers holding the entries of a slot.
+    slot_type = list
+
+    def __init__(self, resolution, slots):
+        self.resolution = resolution
+        self.slots = [self.slot_type() for _ in range(slots)]
+        self._position = 0
+        self._timer = None
+
+    def __len__(self):
+        raise NotImplementedError("__len__ must be implemented!")
+
+    def start(self):
+        """Start the timer unless it is already running."""
+        if self._timer is None:
+            self._timer = PeriodicCallback(self.tick, 1000 * self.resolution)
+            self._timer.start()
+
+    def stop(self):
+        """Stop the timer. It is restarted by :meth:`start`."""
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def tick(self):
+        """Advance the wheel and expire the slot reached."""
+        self._position = (self._position + 1) % len(self.slots)
+        self.expire(self._position)
+        if not len(self):
+            self.stop()
+
+    def expire(self, index):
+        """Handle the entries of the slot at ``index``, which the wheel
+        has just reached. This method must be implemented by child
+        classes.
+
+        """
+        raise NotImplementedError("expire must be implemented!")
+
+
+class Scheduler(TimerWheel):
+    """Resolves futures after a delay using one timer wheel instead of a
+    timeout per waiter.
+
+    The wheel only runs while something is waiting. Delays are rounded
+    up to a multiple of the resolution.
+
+    :param float resolution: seconds between ticks of the wheel
+    :param int slots: number of slots in the wheel
+
+    """
+
+    def __init__(self, resolution=0.01, slots=256):
+        super(Scheduler, self).__init__(resolution, slots)
+        self._waiting = 0
+
+    @classmethod
+    def current(cls):
+        """Return the scheduler shared by everything running on the
+        current IOLoop, creating it if needed.
+
+        """
+        io_loop = IOLoop.current()
+        scheduler = _schedulers.get(io_loop)
+        if scheduler is None:
+            scheduler = _schedulers[io_loop] = cls()
+        return scheduler
+
+    def __len__(self):
+        return self._waiting
+
+    def wait(self, delay):
+        """Return a future resolved after ``delay`` seconds."""
+        future = Future()
+        ticks = max(math.ceil(delay / self.resolution), 1)
+        index = (self._position + ticks) % len(self.slots)
+        rounds = (ticks - 1) // len(self.slots)
+        self.slots[index].append((rounds, future))
+        self._waiting += 1
+        self.start()
+        return future
+
+    def expire(self, index):
+        """Resolve the futures of the slot at ``index`` which are due."""
+        slot = self.slots[index]
+        if not slot:
+            return
+        remaining = []
+        for rounds, future in slot:
+            if rounds:
+                remaining.append((rounds - 1, future))
+            else:
+                self._waiting -= 1
+                if not future.done():
+                    future.set_result(None)
+        self.slots[index] = remaining
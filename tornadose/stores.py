@@ -2,12 +2,29 @@
 
 import asyncio
 from asyncio import Event, Queue
+from collections import Counter, deque
+from itertools import count, islice
 import logging
+import random
+import time
+from time import perf_counter
 from concurrent.futures import ThreadPoolExecutor
+from inspect import isawaitable
 
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 from tornado.web import RequestHandler
 
+from .diff import diff
+from .filters import FilterIndex
+from .messages import BULK, Message
+from .metrics import StoreMetrics, track
+from .queues import ConflatingQueue, DROP_OLDEST, KEEP_LATEST, SubscriberQueue
+from .resp import RedisConnection, RedisSubscription
+from .tracing import Tracer
+
 try:
     import redis
 except ImportError:
@@ -15,6 +32,90 @@ except ImportError:
 
 logger = logging.getLogger("tornadose.stores")
 
+_store_ids = count(1)
+
+
+class _PublishBuffer(object):
+    """Collects outgoing messages and flushes them in batches.
+
+    A batch is flushed once it holds ``max_size`` items or ``delay``
+    seconds after its first item was added, whichever comes first.
+    ``flush`` is a coroutine function taking a list of items and
+    returning a list with one result per item; results which are
+    exceptions are raised from the corresponding future.
+
+    """
+
+    def __init__(self, flush, max_size, delay):
+        self._flush = flush
+        self.max_size = max_size
+        self.delay = delay
+        self._items = []
+        self._futures = []
+        self._timeout = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        """Queue an item and return a future for its result."""
+        future = Future()
+        self._items.append(item)
+        self._futures.append(future)
+        if len(self._items) >= self.max_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.delay, self.flush)
+        return future
+
+    def flush(self):
+        """Start flushing everything queued so far.
+
+        :returns: the futures of the flushed items
+
+        """
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        items, futures = self._items, self._futures
+        if items:
+            self._items, self._futures = [], []
+            IOLoop.current().add_callback(self._run, items, futures)
+        return futures
+
+    async def _run(self, items, futures):
+        try:
+            results = await self._flush(items)
+        except Exception as e:
+            results = [e] * len(futures)
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class _Shard(object):
+    """A subset of a store's subscribers with its own fan-out worker."""
+
+    def __init__(self, metrics):
+        self.subscribers = set()
+        self.inbox = SubscriberQueue()
+        self.metrics = metrics
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    async def run(self):
+        while True:
+            message = await self.inbox.get()
+            start = perf_counter()
+            for subscriber in self.subscribers:
+                subscriber.submit(message)
+            self.metrics.fanout.observe(perf_counter() - start)
+            # Let other shards and I/O run between messages
+            await asyncio.sleep(0)
+
 
 class BaseStore(object):
     """Base class for all data store types.
@@ -22,10 +123,110 @@ class BaseStore(object):
     At a minimum, derived classes should implement ``submit`` and
     ``publish`` methods.
 
+    The ``max_queue_size`` and ``overflow_policy`` keyword arguments set
+    the defaults for the message queues of handlers subscribing to the
+    store (see :class:`tornadose.queues.SubscriberQueue`). The number
+    of times an overflow policy fired across all subscribers is
+    recorded in :attr:`overflows`.
+
+    Every broadcast message is given a new, increasing ``id``. The ids
+    start from the current time in microseconds so that they keep
+    increasing across restarts. The last ``replay_size`` messages are
+    kept in :attr:`history` so that reconnecting clients can be sent
+    just the messages they missed (see :meth:`replay`).
+
+    With a large number of subscribers, fan-out can be split into
+    ``shards``. Subscribers are then spread evenly over that many
+    shards, each with a long-lived worker. Broadcasting a message only
+    notifies the shard workers, which hand it to their subscribers in
+    turn, so a single broadcast never blocks the IOLoop for the whole
+    fan-out.
+
+    ``codec`` is the default :mod:`tornadose.codecs` codec (or its name)
+    for websocket subscribers.
+
+    Producers running in other threads must use
+    :meth:`submit_threadsafe`. Messages from all threads are buffered
+    and handed to :meth:`submit` in batches, waking the IOLoop at most
+    once per batch.
+
+    Counters for the store are kept in :attr:`metrics` (see
+    :mod:`tornadose.metrics`) and reported under ``name``, which
+    defaults to the class name followed by a number unique to the
+    process.
+
+    Subscribers with a ``filter`` (see :mod:`tornadose.filters`) are
+    kept in a :class:`tornadose.filters.FilterIndex` rather than the
+    fan-out shards, so that only subscribers whose filter may match a
+    message are considered when delivering it.
+
+    With a ``trace_rate``, that fraction of messages is timestamped at
+    each stage of delivery by the store's :attr:`tracer` (see
+    :mod:`tornadose.tracing`); otherwise :attr:`tracer` is ``None``.
+
     """
 
-    def __init__(self, *args, **kwargs):
+    #: Default maximum size of subscriber queues (0 means unbounded).
+    max_queue_size = 0
+
+    #: Default overflow policy of subscriber queues.
+    overflow_policy = DROP_OLDEST
+
+    #: Number of recent messages kept for replaying (0 disables replay).
+    replay_size = 100
+
+    #: Number of fan-out shards (0 delivers messages directly).
+    shards = 0
+
+    #: Default codec of websocket subscribers.
+    codec = "json"
+
+    #: Fraction of messages traced (0 disables tracing).
+    trace_rate = 0
+
+    def __init__(
+        self,
+        *args,
+        max_queue_size=None,
+        overflow_policy=None,
+        replay_size=None,
+        shards=None,
+        name=None,
+        codec=None,
+        trace_rate=None,
+        **kwargs
+    ):
         self.subscribers = set()
+        self.filters = FilterIndex()
+        self._unfiltered = set()
+        if name is None:
+            name = "{}-{}".format(type(self).__name__, next(_store_ids))
+        self.name = name
+        self.metrics = StoreMetrics()
+        if max_queue_size is not None:
+            self.max_queue_size = max_queue_size
+        if overflow_policy is not None:
+            self.overflow_policy = overflow_policy
+        if replay_size is not None:
+            self.replay_size = replay_size
+        if shards is not None:
+            self.shards = shards
+        if codec is not None:
+            self.codec = codec
+        if trace_rate is not None:
+            self.trace_rate = trace_rate
+        self.tracer = Tracer(self.trace_rate) if self.trace_rate else None
+        self._shards = [_Shard(self.metrics) for _ in range(self.shards)]
+        self._shard_of = {}
+        for shard in self._shards:
+            IOLoop.current().add_callback(shard.run)
+        self.overflows = Counter()
+        self.last_id = time.time_ns() // 1000
+        self.history = deque(maxlen=self.replay_size)
+        self._io_loop = IOLoop.current()
+        self._incoming = deque()
+        self._drain_scheduled = False
+        track(self)
         self.initialize(*args, **kwargs)
 
     def initialize(self, *args, **kwargs):
@@ -40,8 +241,22 @@ class BaseStore(object):
 
         """
         assert isinstance(subscriber, RequestHandler)
-        logger.debug("New subscriber")
-        self.subscribers.add(subscriber)
+        if subscriber not in self.subscribers:
+            logger.debug("New subscriber")
+            self.subscribers.add(subscriber)
+        filter = getattr(subscriber, "filter", None)
+        if filter is not None:
+            self._unfiltered.discard(subscriber)
+            self._unshard(subscriber)
+            if self.filters.filter_of(subscriber) is not filter:
+                self.filters.add(subscriber, filter)
+        else:
+            self.filters.discard(subscriber)
+            self._unfiltered.add(subscriber)
+            if self._shards and subscriber not in self._shard_of:
+                shard = min(self._shards, key=len)
+                shard.subscribers.add(subscriber)
+                self._shard_of[subscriber] = shard
 
     def deregister(self, subscriber):
         """Stop publishing to a subscriber."""
@@ -50,6 +265,83 @@ class BaseStore(object):
             self.subscribers.remove(subscriber)
         except KeyError:
             logger.debug("Error removing subscriber: " + str(subscriber))
+        self._unfiltered.discard(subscriber)
+        self.filters.discard(subscriber)
+        self._unshard(subscriber)
+
+    def _unshard(self, subscriber):
+        shard = self._shard_of.pop(subscriber, None)
+        if shard is not None:
+            shard.subscribers.discard(subscriber)
+
+    def recipients(self, message):
+        """Return an iterable of collections of subscribers which should
+        receive ``message``. By default this is every subscriber without
+        a filter and those whose filter matches the message data.
+
+        """
+        if self.filters:
+            return (self._unfiltered, self.filters.match(message.data))
+        return (self._unfiltered,)
+
+    def accepts(self, subscriber, message):
+        """Return whether ``subscriber`` should receive ``message``. This
+        is used when replaying and must agree with :meth:`recipients`.
+
+        """
+        return self.filters.accepts(subscriber, message.data)
+
+    def broadcast(self, message):
+        """Hand a :class:`tornadose.messages.Message` to its recipients.
+        The message is assigned the next id and recorded in the history
+        before being passed on to :meth:`deliver`.
+
+        """
+        self.last_id += 1
+        self.metrics.submitted += 1
+        message.id = self.last_id
+        if self.tracer is not None:
+            self.tracer.published(message)
+        if self.replay_size:
+            self.history.append(message)
+        self.deliver(message)
+
+    def deliver(self, message):
+        """Pass a message on to the shard workers or, if fan-out is not
+        sharded, directly to the recipients. Subscribers queue messages
+        without blocking so this returns as soon as every subscriber has
+        been notified. Filtered subscribers are never sharded.
+
+        """
+        if self._shards:
+            for shard in self._shards:
+                shard.inbox.put_nowait(message)
+            if self.filters:
+                for subscriber in self.filters.match(message.data):
+                    subscriber.submit(message)
+        else:
+            start = perf_counter()
+            for subscribers in self.recipients(message):
+                for subscriber in subscribers:
+                    subscriber.submit(message)
+            self.metrics.fanout.observe(perf_counter() - start)
+
+    def replay(self, subscriber, last_id):
+        """Return the recent messages with an id greater than ``last_id``
+        which ``subscriber`` would have received. If some of those have
+        already been dropped from the history, all recent messages are
+        returned.
+
+        """
+        missed = self.last_id - last_id
+        if missed <= 0:
+            return []
+        start = max(len(self.history) - missed, 0)
+        return [
+            message
+            for message in islice(self.history, start, None)
+            if self.accepts(subscriber, message)
+        ]
 
     def submit(self, message):
         """Add a new message to be pushed to subscribers. This method
@@ -61,6 +353,66 @@ class BaseStore(object):
         """
         raise NotImplementedError("submit must be implemented!")
 
+    def submit_threadsafe(self, *args):
+        """Submit a message from any thread. The arguments are those of
+        :meth:`submit`, which is called with them on the IOLoop.
+
+        This only appends to a buffer shared by all threads and never
+        blocks; the IOLoop is woken once for all messages buffered
+        until it gets to process them.
+
+        """
+        self._incoming.append(args)
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self._io_loop.add_callback(self._drain_incoming)
+
+    def _drain_incoming(self):
+        # Reset the flag first so that messages appended while draining
+        # either get drained now or schedule another call.
+        self._drain_scheduled = False
+        incoming = self._incoming
+        batch = []
+        while incoming:
+            batch.append(incoming.popleft())
+        self.submit_batch(batch)
+
+    def submit_batch(self, batch):
+        """Submit a list of argument tuples for :meth:`submit` at once.
+        Child classes may override this to queue messages more cheaply
+        than one :meth:`submit` call each.
+
+        """
+        pending = []
+        for args in batch:
+            result = self.submit(*args)
+            if isawaitable(result):
+                pending.append(result)
+        if pending:
+            done = asyncio.gather(*pending)
+            self._io_loop.add_future(done, lambda future: future.result())
+
+    async def drain(self, window=30.0, waves=10):
+        """Disconnect all subscribers gradually, e.g. before a restart.
+
+        Subscribers are split randomly into ``waves`` groups which are
+        disconnected at even intervals over ``window`` seconds. Each is
+        told to reconnect after a random delay shorter than the
+        interval between waves (see
+        :meth:`tornadose.handlers.BaseHandler.reconnect`), so that
+        reconnections are spread evenly over the whole window.
+
+        """
+        subscribers = list(self.subscribers)
+        random.shuffle(subscribers)
+        interval = window / waves
+        for index in range(min(waves, len(subscribers))):
+            if index:
+                await asyncio.sleep(interval)
+            for subscriber in subscribers[index::waves]:
+                if subscriber in self.subscribers:
+                    subscriber.reconnect(random.uniform(0, interval))
+
     def publish(self):
         """Push messages to all listeners. This method must be
         implemented by child classes. A recommended way to implement
@@ -80,15 +432,58 @@ class DataStore(BaseStore):
     instance so that the :class:`EventSource` can listen for
     updates.
 
+    Every change of the data increments :attr:`version`. The publishing
+    loop sleeps until the data changes and then hands the newest version
+    to all subscribers once; new subscribers immediately receive the
+    current version. Since only the latest data matters, subscriber
+    queues default to holding a single message with the
+    :data:`~tornadose.queues.KEEP_LATEST` policy.
+
     """
 
+    max_queue_size = 1
+    overflow_policy = KEEP_LATEST
+    replay_size = 0
+
     def initialize(self, initial_data=None):
-        self.set_data(initial_data)
-        self.publish()
+        self.version = 0
+        self._data = None
+        self._message = None
+        self._changed = Event()
+        if initial_data is not None:
+            self.set_data(initial_data)
+        IOLoop.current().add_callback(self.publish)
+
+    def replay(self, subscriber, last_id):
+        """Only the current data is replayed, if it is newer than
+        ``last_id``.
+
+        """
+        message = self._message
+        if message is not None and message.id is not None and message.id > last_id:
+            return [message]
+        return []
+
+    def register(self, subscriber):
+        new = subscriber not in self.subscribers
+        super(DataStore, self).register(subscriber)
+        # A pending change will be delivered by the publishing loop
+        if new and self._data is not None and not self._changed.is_set():
+            if self.accepts(subscriber, self._message):
+                subscriber.submit(self._message)
 
     def set_data(self, new_data):
-        """Update the store with new data."""
+        """Update the store with new data. Setting data equal to (but
+        not the same object as) the current data is not considered a
+        change.
+
+        """
+        if new_data is not self._data and new_data == self._data:
+            return
         self._data = new_data
+        self._message = Message(new_data)
+        self.version += 1
+        self._changed.set()
 
     @property
     def data(self):
@@ -99,13 +494,115 @@ class DataStore(BaseStore):
         self.set_data(new_data)
 
     def submit(self, message):
-        self.data = str(message)
+        self.data = message
 
     async def publish(self):
         while True:
-            await asyncio.gather(
-                *[subscriber.submit(self.data) for subscriber in self.subscribers]
-            )
+            await self._changed.wait()
+            self._changed.clear()
+            self.broadcast(self._message)
+
+
+class DeltaDataStore(DataStore):
+    """A :class:`DataStore` publishing only what changed.
+
+    Subscribers first receive a snapshot of the data and then, for
+    every change, a JSON Patch (see :mod:`tornadose.diff`) against the
+    previously published version. The patch is computed once per change
+    and shared by all subscribers. Messages have the form::
+
+        {"version": 1, "snapshot": {...}}
+        {"version": 3, "base": 1, "patch": [...]}
+
+    A client should apply a patch only if its ``base`` is the version it
+    has and otherwise reconnect to get a new snapshot. Subscribers which
+    have more than :attr:`max_lag` patches queued are sent a snapshot in
+    place of the queued patches. Rate-limited subscribers only keep the
+    latest message queued, so they are sent a snapshot in place of any
+    queued message. Clients reconnecting with an older ``Last-Event-ID``
+    are sent a snapshot.
+
+    Data must be replaced rather than modified in place; passing the
+    current data object to :meth:`set_data` again publishes a new
+    snapshot. Fan-out is never sharded and subscriber filters are
+    ignored, since every patch must be applied in turn.
+
+    """
+
+    max_queue_size = 0
+    overflow_policy = DROP_OLDEST
+
+    #: Number of queued patches after which a subscriber is resynced.
+    max_lag = 16
+
+    def initialize(self, initial_data=None):
+        self._published = None
+        self._published_version = 0
+        self._snapshot = None
+        self._resync = False
+        super(DeltaDataStore, self).initialize(initial_data)
+
+    def set_data(self, new_data):
+        if new_data is self._data and new_data is not None:
+            self._resync = True
+            self.version += 1
+            self._changed.set()
+        else:
+            super(DeltaDataStore, self).set_data(new_data)
+
+    def snapshot(self):
+        """Return a message with a snapshot of the last published
+        version. It has the same id as the message which published
+        that version.
+
+        """
+        if self._snapshot is None:
+            data = dict(version=self._published_version, snapshot=self._published)
+            self._snapshot = Message(data)
+            self._snapshot.id = self.last_id
+        return self._snapshot
+
+    def replay(self, subscriber, last_id):
+        if self._published is not None and self.last_id > last_id:
+            return [self.snapshot()]
+        return []
+
+    def register(self, subscriber):
+        new = subscriber not in self.subscribers
+        super(DataStore, self).register(subscriber)
+        if new and self._published is not None:
+            subscriber.submit(self.snapshot())
+
+    def deliver(self, message):
+        start = perf_counter()
+        for subscriber in self.subscribers:
+            queue = subscriber.messages
+            if len(queue) >= self.max_lag or queue.full():
+                queue.clear()
+                subscriber.submit(self.snapshot())
+            elif isinstance(queue, ConflatingQueue) and not queue.empty():
+                # A patch replacing the queued message would not apply
+                # to the version the client has
+                subscriber.submit(self.snapshot())
+            else:
+                subscriber.submit(message)
+        self.metrics.fanout.observe(perf_counter() - start)
+
+    async def publish(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            previous, base = self._published, self._published_version
+            self._published = self._data
+            self._published_version = self.version
+            self._snapshot = None
+            if previous is None or self._resync:
+                self._resync = False
+                self.broadcast(self.snapshot())
+            else:
+                patch = diff(previous, self._published)
+                data = dict(version=self.version, base=base, patch=patch)
+                self.broadcast(Message(data))
 
 
 class RedisStore(BaseStore):
@@ -123,7 +620,13 @@ class RedisStore(BaseStore):
     documentation for detais.
 
     New messages are read in a background thread via a
-    :class:`concurrent.futures.ThreadPoolExecutor`.
+    :class:`concurrent.futures.ThreadPoolExecutor`. See
+    :class:`AsyncRedisStore` for a store which does not need one.
+
+    Submitted messages are buffered and published in pipelined batches
+    of up to :attr:`publish_batch_size` messages, at most
+    :attr:`publish_delay` seconds after being submitted, on a second
+    background thread. Submitting never blocks the IOLoop.
 
     __ https://redis-py.readthedocs.org/en/latest/
 
@@ -131,6 +634,12 @@ class RedisStore(BaseStore):
 
     """
 
+    #: Maximum number of messages published in one pipeline.
+    publish_batch_size = 128
+
+    #: Maximum time in seconds a submitted message waits to be published.
+    publish_delay = 0.001
+
     def initialize(self, channel="tornadose", **kwargs):
         if redis is None:
             raise RuntimeError("The redis module is required to use RedisStore")
@@ -139,24 +648,63 @@ class RedisStore(BaseStore):
         self.channel = channel
         self.messages = Queue()
         self._done = Event()
+        self._publish_executor = ThreadPoolExecutor(max_workers=1)
+        self._outgoing = _PublishBuffer(
+            self._flush, self.publish_batch_size, self.publish_delay
+        )
 
         self._redis = redis.StrictRedis(**kwargs)
         self._redis.ping()
         self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
         self._pubsub.subscribe(self.channel)
 
-        self.publish()
+        IOLoop.current().add_callback(self.publish)
 
     def submit(self, message, debug=False):
-        self._redis.publish(self.channel, message)
+        """Queue a message to be published.
+
+        :returns: a future resolving to the number of Redis clients that
+            received the message once it has been published
+
+        """
         if debug:
             logger.debug(message)
-            self._redis.setex(self.channel, 5, message)
+        return self._outgoing.add((message, debug))
+
+    def _publish_batch(self, batch):
+        pipeline = self._redis.pipeline(transaction=False)
+        for message, debug in batch:
+            pipeline.publish(self.channel, message)
+            if debug:
+                pipeline.setex(self.channel, 5, message)
+        results = iter(pipeline.execute(raise_on_error=False))
+        receivers = []
+        for message, debug in batch:
+            receivers.append(next(results))
+            if debug:
+                next(results)
+        return receivers
+
+    async def _flush(self, batch):
+        return await IOLoop.current().run_in_executor(
+            self._publish_executor, self._publish_batch, batch
+        )
 
     def shutdown(self):
-        """Stop the publishing loop."""
+        """Stop the publishing loop. Messages already submitted are
+        still published.
+
+        """
         self._done.set()
         self.executor.shutdown(wait=False)
+        pending = self._outgoing.flush()
+        if pending:
+            flushed = asyncio.gather(*pending, return_exceptions=True)
+            IOLoop.current().add_future(
+                flushed, lambda f: self._publish_executor.shutdown(wait=False)
+            )
+        else:
+            self._publish_executor.shutdown(wait=False)
 
     def _get_message(self):
         data = self._pubsub.get_message(timeout=1)
@@ -170,7 +718,7 @@ class RedisStore(BaseStore):
         while not self._done.is_set():
             data = await loop.run_in_executor(self.executor, self._get_message)
             if len(self.subscribers) > 0 and data is not None:
-                [subscriber.submit(data) for subscriber in self.subscribers]
+                self.broadcast(Message(data))
 
 
 class QueueStore(BaseStore):
@@ -181,19 +729,390 @@ class QueueStore(BaseStore):
     messages to be broadcast to clients are put in a queue to be
     processed in order.
 
+    The queue can be bounded with a ``high_water_mark``. Once that many
+    messages are queued the store is :attr:`saturated`: :meth:`submit`
+    waits and :meth:`try_submit` fails until the queue has drained to
+    the ``low_water_mark``. The time producers spent waiting and the
+    number of rejected messages are recorded in :attr:`metrics`.
+
+    :param int high_water_mark: number of queued messages at which
+        producers are held back (0 means unbounded)
+    :param int low_water_mark: number of queued messages at which
+        producers may continue; defaults to half the high water mark
+
     """
 
-    def initialize(self):
+    #: Number of queued messages at which producers are held back.
+    high_water_mark = 0
+
+    #: Number of queued messages at which producers may continue.
+    low_water_mark = None
+
+    def initialize(self, high_water_mark=None, low_water_mark=None):
+        if high_water_mark is not None:
+            self.high_water_mark = high_water_mark
+        if low_water_mark is not None:
+            self.low_water_mark = low_water_mark
+        elif self.low_water_mark is None:
+            self.low_water_mark = self.high_water_mark // 2
+        if self.high_water_mark and self.low_water_mark >= self.high_water_mark:
+            raise ValueError("low_water_mark must be below high_water_mark")
         self.messages = Queue()
-        self.publish()
+        self._writable = Event()
+        self._writable.set()
+        IOLoop.current().add_callback(self.publish)
+
+    @property
+    def saturated(self):
+        """Whether producers are currently held back."""
+        return not self._writable.is_set()
 
-    async def submit(self, message):
-        await self.messages.put(message)
+    async def submit(self, message, priority=BULK):
+        """Queue a message for publishing, first waiting for the queue
+        to drain if the store is saturated.
+
+        :param int priority: messages with a priority above
+            :data:`tornadose.messages.BULK` are never held back and
+            skip ahead of bulk data queued for each subscriber
+
+        """
+        if priority == BULK:
+            await self._wait_writable()
+        self._put(self._message(message, priority))
+
+    def submit_batch(self, batch):
+        """Queue messages from :meth:`submit_threadsafe` without
+        waiting. They are accepted even when the store is saturated;
+        threaded producers can check :attr:`saturated` to slow down.
+
+        """
+        for args in batch:
+            self._put(self._message(*args))
+
+    def try_submit(self, message, priority=BULK):
+        """Queue a message for publishing unless the store is saturated.
+        Priority messages are always accepted.
+
+        :returns: ``True`` if the message was queued, ``False`` if it
+            was rejected
+
+        """
+        if priority == BULK and self.saturated:
+            self.metrics.rejected += 1
+            return False
+        self._put(self._message(message, priority))
+        return True
+
+    def _message(self, message, priority=BULK):
+        return Message(message, priority=priority)
+
+    async def _wait_writable(self):
+        if self._writable.is_set():
+            return
+        start = perf_counter()
+        # Producers woken together may fill the queue again
+        while not self._writable.is_set():
+            await self._writable.wait()
+        self.metrics.blocked.observe(perf_counter() - start)
+
+    def _put(self, message):
+        if self.tracer is not None:
+            self.tracer.sample(message, submitted=True)
+        self.messages.put_nowait(message)
+        if self.high_water_mark and self.messages.qsize() >= self.high_water_mark:
+            self._writable.clear()
+
+    async def _get(self):
+        message = await self.messages.get()
+        if self.saturated and self.messages.qsize() <= self.low_water_mark:
+            self._writable.set()
+        return message
 
     async def publish(self):
         while True:
-            message = await self.messages.get()
+            message = await self._get()
             if len(self.subscribers) > 0:
-                await asyncio.gather(
-                    *[subscriber.submit(message) for subscriber in self.subscribers]
-                )
+                self.broadcast(message)
+
+
+class TopicStore(QueueStore):
+    """Publish data to subscribers of individual topics.
+
+    A single :class:`TopicStore` can serve any number of streams such as
+    ``/stream/<ticker>``. Handlers subscribe to the topic returned by
+    :meth:`tornadose.handlers.BaseHandler.get_topic`, which by default
+    is taken from the URL arguments. A topic ending in ``*`` subscribes
+    to all topics starting with the preceding prefix, so ``prices.*``
+    matches ``prices.AAPL`` and a lone ``*`` matches every topic.
+
+    Subscribers are indexed by topic and prefix. Publishing a message
+    only looks up the exact topic and each distinct prefix length in
+    use, so the cost of a message depends on the number of matching
+    subscribers rather than the total number of subscribers.
+
+    Subscribers with a filter are kept out of the topic index; they are
+    found through the filter index and then checked against their topic.
+
+    Messages are published in order via :meth:`submit`, which takes the
+    topic as first argument. Since fan-out only touches matching
+    subscribers, it is never sharded.
+
+    """
+
+    wildcard = "*"
+
+    def initialize(self, **kwargs):
+        if self._shards:
+            raise ValueError("TopicStore does not support sharded fan-out")
+        self._topics = {}
+        self._prefixes = {}
+        self._prefix_lengths = Counter()
+        self._patterns = {}
+        self._filtered = set()
+        super(TopicStore, self).initialize(**kwargs)
+
+    def register(self, subscriber):
+        """Register a subscriber under its current ``topic``. Subscribers
+        without a topic are tracked but receive no messages until they
+        register again with one.
+
+        """
+        super(TopicStore, self).register(subscriber)
+        pattern = getattr(subscriber, "topic", None)
+        filtered = subscriber in self.filters
+        if (
+            self._patterns.get(subscriber) != pattern
+            or (subscriber in self._filtered) != filtered
+        ):
+            self._unindex(subscriber)
+            if pattern is not None:
+                self._index(subscriber, pattern)
+
+    def deregister(self, subscriber):
+        super(TopicStore, self).deregister(subscriber)
+        self._unindex(subscriber)
+
+    def _index(self, subscriber, pattern):
+        if subscriber in self.filters:
+            self._filtered.add(subscriber)
+        elif pattern.endswith(self.wildcard):
+            prefix = pattern[: -len(self.wildcard)]
+            self._prefixes.setdefault(prefix, set()).add(subscriber)
+            self._prefix_lengths[len(prefix)] += 1
+        else:
+            self._topics.setdefault(pattern, set()).add(subscriber)
+        self._patterns[subscriber] = pattern
+
+    def _unindex(self, subscriber):
+        pattern = self._patterns.pop(subscriber, None)
+        if pattern is None:
+            return
+        if subscriber in self._filtered:
+            self._filtered.discard(subscriber)
+            return
+        if pattern.endswith(self.wildcard):
+            prefix = pattern[: -len(self.wildcard)]
+            index = self._prefixes
+            self._prefix_lengths[len(prefix)] -= 1
+            if not self._prefix_lengths[len(prefix)]:
+                del self._prefix_lengths[len(prefix)]
+        else:
+            prefix = pattern
+            index = self._topics
+        subscribers = index[prefix]
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del index[prefix]
+
+    def _matches(self, pattern, topic):
+        if pattern.endswith(self.wildcard):
+            return topic.startswith(pattern[: -len(self.wildcard)])
+        return topic == pattern
+
+    def accepts(self, subscriber, message):
+        pattern = self._patterns.get(subscriber)
+        return (
+            pattern is not None
+            and self._matches(pattern, message.topic)
+            and self.filters.accepts(subscriber, message.data)
+        )
+
+    def recipients(self, message):
+        matches = self.match(message.topic)
+        if self.filters:
+            filtered = []
+            for subscriber in self.filters.match(message.data):
+                pattern = self._patterns.get(subscriber)
+                if pattern is not None and self._matches(pattern, message.topic):
+                    filtered.append(subscriber)
+            matches.append(filtered)
+        return matches
+
+    def match(self, topic):
+        """Return a list of the sets of subscribers matching ``topic``.
+        A subscriber appears in at most one of the sets.
+
+        """
+        matches = []
+        subscribers = self._topics.get(topic)
+        if subscribers:
+            matches.append(subscribers)
+        for length in self._prefix_lengths:
+            if length <= len(topic):
+                subscribers = self._prefixes.get(topic[:length])
+                if subscribers:
+                    matches.append(subscribers)
+        return matches
+
+    async def submit(self, topic, message, priority=BULK):
+        if priority == BULK:
+            await self._wait_writable()
+        self._put(self._message(topic, message, priority))
+
+    def try_submit(self, topic, message, priority=BULK):
+        if priority == BULK and self.saturated:
+            self.metrics.rejected += 1
+            return False
+        self._put(self._message(topic, message, priority))
+        return True
+
+    def _message(self, topic, message, priority=BULK):
+        return Message(message, topic=topic, priority=priority)
+
+
+class AsyncRedisStore(TopicStore):
+    """Publish data via a Redis backend without background threads.
+
+    Like :class:`RedisStore` this allows external programs to publish
+    data for clients, but it talks to Redis using the non-blocking
+    client in :mod:`tornadose.resp` instead of polling ``redis-py`` from
+    a thread. Any number of ``channels`` and glob-style ``patterns`` are
+    subscribed to over a single connection. Messages are read from the
+    socket in batches and handed directly to subscribers, using the
+    channel a message arrived on as its topic (see :class:`TopicStore`).
+
+    The connection is re-established automatically after waiting
+    ``reconnect_delay`` seconds if it is lost. Call :meth:`shutdown` to
+    stop the store.
+
+    Messages passed to :meth:`submit` are published over a second
+    connection. They are buffered and written as a single pipeline of
+    up to :attr:`publish_batch_size` commands at most
+    :attr:`publish_delay` seconds after being submitted.
+
+    :param channels: channel names to subscribe to
+    :param patterns: channel patterns to subscribe to
+    :param str host: Redis host
+    :param int port: Redis port
+    :param str password: optional password
+    :param int db: database used for publishing
+
+    """
+
+    reconnect_delay = 1.0
+
+    #: Maximum number of messages published in one pipeline.
+    publish_batch_size = 128
+
+    #: Maximum time in seconds a submitted message waits to be published.
+    publish_delay = 0.001
+
+    def initialize(
+        self,
+        channels=("tornadose",),
+        patterns=(),
+        host="localhost",
+        port=6379,
+        password=None,
+        db=0,
+    ):
+        self.channels = set(channels)
+        self.patterns = set(patterns)
+        options = dict(host=host, port=port, password=password)
+        self._subscription = RedisSubscription(self._dispatch, **options)
+        self._connection = RedisConnection(db=db, **options)
+        self._outgoing = _PublishBuffer(
+            self._flush, self.publish_batch_size, self.publish_delay
+        )
+        self._done = False
+        super(AsyncRedisStore, self).initialize()
+
+    def subscribe(self, *channels):
+        """Start listening to more channels."""
+        self.channels.update(channels)
+        if self._subscription.connected:
+            self._subscription.subscribe(*channels)
+
+    def unsubscribe(self, *channels):
+        """Stop listening to channels."""
+        self.channels.difference_update(channels)
+        if self._subscription.connected:
+            self._subscription.unsubscribe(*channels)
+
+    def psubscribe(self, *patterns):
+        """Start listening to channels matching more patterns."""
+        self.patterns.update(patterns)
+        if self._subscription.connected:
+            self._subscription.psubscribe(*patterns)
+
+    def punsubscribe(self, *patterns):
+        """Stop listening to channels matching patterns."""
+        self.patterns.difference_update(patterns)
+        if self._subscription.connected:
+            self._subscription.punsubscribe(*patterns)
+
+    def submit(self, topic, message):
+        """Queue a message to be published to the ``topic`` channel.
+
+        :returns: a future resolving to the number of Redis clients that
+            received the message once it has been published
+
+        """
+        return self._outgoing.add(("PUBLISH", topic, message))
+
+    def try_submit(self, topic, message):
+        """Queue a message like :meth:`submit`. Publishing to Redis is
+        never held back, so this always returns ``True``.
+
+        """
+        self.submit(topic, message)
+        return True
+
+    def submit_batch(self, batch):
+        # Publish to Redis rather than queueing locally like TopicStore
+        BaseStore.submit_batch(self, batch)
+
+    async def _flush(self, commands):
+        await self._connection.ensure_connected()
+        futures = self._connection.execute_many(commands)
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    def shutdown(self):
+        """Stop listening and close the connections to Redis once any
+        buffered messages have been published.
+
+        """
+        self._done = True
+        self._subscription.close()
+        pending = self._outgoing.flush()
+        if pending:
+            flushed = asyncio.gather(*pending, return_exceptions=True)
+            IOLoop.current().add_future(flushed, lambda f: self._connection.close())
+        else:
+            self._connection.close()
+
+    def _dispatch(self, batch):
+        for channel, data in batch:
+            self.broadcast(Message(data, topic=channel))
+
+    async def publish(self):
+        while not self._done:
+            try:
+                await self._subscription.connect()
+                self._subscription.subscribe(*self.channels)
+                self._subscription.psubscribe(*self.patterns)
+                await self._subscription.wait_closed()
+            except (StreamClosedError, OSError) as e:
+                logger.warning("Unable to connect to Redis: %s", e)
+            if not self._done:
+                await gen.sleep(self.reconnect_delay)
@@ -0,0 +1,158 @@
+"""Helpers for testing applications built with tornadose."""
+
+from fnmatch import fnmatchcase
+import logging
+
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import bind_unused_port
+
+from .resp import READ_CHUNK_SIZE, RedisError, RespParser
+
+logger = logging.getLogger("tornadose.testing")
+
+
+def encode_reply(reply):
+    """Encode a reply in RESP2."""
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, RedisError):
+        return b"-" + str(reply).encode("utf-8") + b"\r\n"
+    if isinstance(reply, bool):
+        reply = int(reply)
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, str):
+        reply = reply.encode("utf-8")
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(encode_reply(item) for item in reply)
+
+
+class FakeRedisServer(TCPServer):
+    """An in-process stand-in for a Redis server.
+
+    It understands enough commands to exercise the Redis-backed stores:
+    publish/subscribe including patterns, ``PING``, ``AUTH``,
+    ``SELECT``, ``GET``, ``SET`` and ``SETEX``. Every command received
+    is appended to :attr:`commands`.
+
+    ::
+
+        server = FakeRedisServer()
+        port = server.listen_unused()
+        store = AsyncRedisStore(port=port)
+
+    """
+
+    def __init__(self, **kwargs):
+        super(FakeRedisServer, self).__init__(**kwargs)
+        self.port = None
+        self.data = {}
+        self.commands = []
+        self.channels = {}
+        self.patterns = {}
+        self.streams = set()
+
+    def listen_unused(self):
+        """Listen on an unused local port and return it."""
+        sock, self.port = bind_unused_port()
+        self.add_sockets([sock])
+        return self.port
+
+    def disconnect_all(self):
+        """Close all client connections."""
+        for stream in list(self.streams):
+            stream.close()
+
+    async def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        parser = RespParser()
+        try:
+            while True:
+                parser.feed(await stream.read_bytes(READ_CHUNK_SIZE, partial=True))
+                commands = parser.replies()
+                stream.write(b"".join(self.execute(stream, c) for c in commands))
+        except StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+            for subscribers in list(self.channels.values()):
+                subscribers.discard(stream)
+            for subscribers in list(self.patterns.values()):
+                subscribers.discard(stream)
+
+    def execute(self, stream, command):
+        """Execute a command and return the encoded reply."""
+        self.commands.append(command)
+        name, args = command[0].upper().decode(), command[1:]
+        try:
+            method = getattr(self, "_" + name.lower())
+        except AttributeError:
+            return encode_reply(RedisError("ERR unknown command '{}'".format(name)))
+        return method(stream, *args)
+
+    def _ping(self, stream, *args):
+        return b"+PONG\r\n"
+
+    def _auth(self, stream, *args):
+        return b"+OK\r\n"
+
+    _select = _auth
+
+    def _get(self, stream, key):
+        return encode_reply(self.data.get(key))
+
+    def _set(self, stream, key, value):
+        self.data[key] = value
+        return b"+OK\r\n"
+
+    def _setex(self, stream, key, seconds, value):
+        return self._set(stream, key, value)
+
+    def _publish(self, stream, channel, message):
+        receivers = 0
+        for subscriber in self.channels.get(channel, ()):
+            if subscriber.closed():
+                continue
+            subscriber.write(encode_reply([b"message", channel, message]))
+            receivers += 1
+        for pattern, subscribers in self.patterns.items():
+            if fnmatchcase(channel.decode(), pattern.decode()):
+                for subscriber in subscribers:
+                    if subscriber.closed():
+                        continue
+                    reply = [b"pmessage", pattern, channel, message]
+                    subscriber.write(encode_reply(reply))
+                    receivers += 1
+        return encode_reply(receivers)
+
+    def _subscriptions(self, stream):
+        return sum(
+            stream in subscribers
+            for index in (self.channels, self.patterns)
+            for subscribers in index.values()
+        )
+
+    def _change(self, stream, kind, index, names, add):
+        replies = []
+        for name in names:
+            subscribers = index.setdefault(name, set())
+            if add:
+                subscribers.add(stream)
+            else:
+                subscribers.discard(stream)
+            replies.append(encode_reply([kind, name, self._subscriptions(stream)]))
+        return b"".join(replies)
+
+    def _subscribe(self, stream, *channels):
+        return self._change(stream, b"subscribe", self.channels, channels, True)
+
+    def _unsubscribe(self, stream, *channels):
+        return self._change(stream, b"unsubscribe", self.channels, channels, False)
+
+    def _psubscribe(self, stream, *patterns):
+        return self._change(stream, b"psubscribe", self.patterns, patterns, True)
+
+    def _punsubscribe(self, stream, *patterns):
+        return self._change(stream, b"punsubscribe", self.patterns, patterns, False)
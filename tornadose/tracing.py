@@ -0,0 +1,221 @@
+"""Sampled tracing of messages from submission to delivery.
+
+A store created with a ``trace_rate`` keeps a :class:`Tracer` as its
+``tracer`` attribute. The tracer picks a fraction of the messages and
+records when each of them reaches the stages of the delivery path:
+
+``store``
+    from :meth:`~tornadose.stores.QueueStore.submit` until the publish
+    loop broadcasts the message (only for stores with a publishing
+    queue)
+``fanout``
+    from the broadcast until the message is queued for a subscriber
+``queue``
+    from being queued until a handler writes it
+``flush``
+    from being written until the connection has sent it
+``total``
+    from submission (or the broadcast) until it has been sent
+
+The time spent in each stage is observed in a
+:class:`~tornadose.metrics.Histogram` per stage, which are exported with
+the other metrics, and the slowest deliveries are kept for inspection.
+Messages are picked at random intervals averaging ``1 / rate``, so a
+message which is not sampled costs a decrement and a few attribute
+checks.
+
+To query the traces of all stores, add a :class:`TraceHandler` to the
+application::
+
+    store = QueueStore(trace_rate=0.01)
+    app = Application([
+        (r"/stream", EventSource, {"store": store}),
+        (r"/traces", TraceHandler),
+    ])
+
+"""
+
+import heapq
+from itertools import count
+import math
+import random
+from time import perf_counter
+
+from tornado.escape import json_encode
+from tornado.web import RequestHandler
+
+from .metrics import Histogram, tracked
+
+#: Stages for which latencies are recorded.
+STAGES = ("store", "fanout", "queue", "flush", "total")
+
+#: Quantiles reported by :class:`TraceHandler`.
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Trace(object):
+    """Timestamps of a sampled message, from :func:`time.perf_counter`.
+
+    :ivar submitted: when the message was submitted to the store, or
+        ``None`` if it was sampled when broadcast
+    :ivar published: when the store broadcast the message
+    :ivar queued: when the message was queued, by subscriber
+
+    """
+
+    __slots__ = ("tracer", "submitted", "published", "queued")
+
+    def __init__(self, tracer, submitted=None):
+        self.tracer = tracer
+        self.submitted = submitted
+        self.published = None
+        self.queued = {}
+
+    def finish(self, subscriber, message, written, flushed):
+        """Record the delivery of the traced ``message`` to
+        ``subscriber``, which wrote it at ``written`` and finished
+        sending it at ``flushed``. Deliveries of messages queued before
+        the message was sampled, e.g. replays, are ignored.
+
+        """
+        queued = self.queued.pop(subscriber, None)
+        if queued is None or self.published is None:
+            return
+        stages = {
+            "fanout": queued - self.published,
+            "queue": written - queued,
+            "flush": flushed - written,
+            "total": flushed - (self.submitted or self.published),
+        }
+        if self.submitted is not None:
+            stages["store"] = self.published - self.submitted
+        self.tracer.record(subscriber, message, stages)
+
+
+class Tracer(object):
+    """Samples the messages of a store and records how long they spend
+    in each stage of delivery.
+
+    :param float rate: fraction of messages sampled
+    :param int slowest: number of slowest deliveries kept in
+        :attr:`slowest`
+
+    """
+
+    def __init__(self, rate, slowest=20):
+        if not 0 < rate <= 1:
+            raise ValueError("trace rate must be in (0, 1]")
+        self.rate = rate
+        self.size = slowest
+        self.sampled = 0
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._slowest = []
+        self._order = count()
+        self._countdown = self._gap()
+
+    def _gap(self):
+        # Geometric gaps give every message the same chance of being
+        # sampled without drawing a random number for each of them.
+        if self.rate >= 1:
+            return 1
+        return int(math.log(1.0 - random.random()) / math.log(1.0 - self.rate)) + 1
+
+    def sample(self, message, submitted=False):
+        """Decide whether to trace ``message``. Its ``trace`` attribute
+        is set to a new :class:`Trace` or to ``False``.
+
+        :param bool submitted: whether the message is being submitted,
+            rather than broadcast
+        :returns: the trace or ``False``
+
+        """
+        self._countdown -= 1
+        if self._countdown:
+            message.trace = False
+            return False
+        self._countdown = self._gap()
+        self.sampled += 1
+        trace = message.trace = Trace(self, perf_counter() if submitted else None)
+        return trace
+
+    def published(self, message):
+        """Sample ``message`` unless this was done when it was
+        submitted and timestamp its broadcast if it is traced.
+
+        """
+        trace = message.trace
+        if trace is None:
+            trace = self.sample(message)
+        if trace:
+            trace.published = perf_counter()
+
+    def record(self, subscriber, message, stages):
+        """Observe the ``stages`` latencies of one delivery."""
+        for stage, seconds in stages.items():
+            self.histograms[stage].observe(seconds)
+        entry = {
+            "id": message.id,
+            "topic": message.topic,
+            "subscriber": type(subscriber).__name__,
+            "stages": stages,
+        }
+        item = (stages["total"], next(self._order), entry)
+        if len(self._slowest) < self.size:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    @property
+    def slowest(self):
+        """The slowest deliveries recorded, slowest first."""
+        return [entry for _, _, entry in sorted(self._slowest, reverse=True)]
+
+    def clear(self):
+        """Forget all recorded latencies."""
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self._slowest = []
+
+    def summary(self):
+        """Return the recorded latencies as a JSON-serializable dict."""
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            quantiles = {}
+            for q in QUANTILES:
+                value = histogram.quantile(q)
+                quantiles[str(q)] = None if value == float("inf") else value
+            stages[stage] = {
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "quantiles": quantiles,
+            }
+        return {
+            "rate": self.rate,
+            "sampled": self.sampled,
+            "stages": stages,
+            "slowest": self.slowest,
+        }
+
+
+class TraceHandler(RequestHandler):
+    """Serve the latencies recorded by the tracers of stores as JSON,
+    keyed by store name. A ``store`` query argument restricts the
+    response to the named stores.
+
+    :param stores: stores to report; defaults to every store created in
+        this process
+
+    """
+
+    def initialize(self, stores=None):
+        self.stores = stores
+
+    def get(self):
+        stores = tracked() if self.stores is None else self.stores
+        names = self.get_query_arguments("store")
+        traces = {
+            store.name: store.tracer.summary()
+            for store in stores
+            if store.tracer is not None and (not names or store.name in names)
+        }
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json_encode(traces))